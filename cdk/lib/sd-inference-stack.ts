@@ -92,6 +92,20 @@ export class SdInferenceStack extends cdk.Stack {
           noncurrentVersionExpiration: cdk.Duration.days(30),
           expiredObjectDeleteMarker: true,
         },
+        {
+          // Requests too large for a DynamoDB item, kept as long as the dead-letter queue keeps messages
+          id: 'ExpireLargeRequests',
+          enabled: true,
+          prefix: 'sd/in/',
+          expiration: cdk.Duration.days(14),
+        },
+        {
+          // Result cache manifests, the scheduler ignores them after [cache] ttl (a day by default)
+          id: 'ExpireCacheManifests',
+          enabled: true,
+          prefix: 'sd/cache/',
+          expiration: cdk.Duration.days(1),
+        },
       ],
     });
 
@@ -144,6 +158,8 @@ export class SdInferenceStack extends cdk.Stack {
         QUEUE_URL: taskQueue.queueUrl,
         CLOUDFRONT_DOMAIN: distribution.distributionDomainName,
         DEPLOYMENT_ID: deploymentId,
+        REQUEST_BUCKET: imageBucket.bucketName,
+        REQUEST_PREFIX: 'sd/in/',
       },
       logGroup: lambdaLogGroup,
       tracing: lambda.Tracing.ACTIVE, // Enable X-Ray tracing
@@ -153,6 +169,7 @@ export class SdInferenceStack extends cdk.Stack {
     tasksTable.grantReadWriteData(taskHandlerLambda);
     taskQueue.grantSendMessages(taskHandlerLambda);
     imageBucket.grantRead(taskHandlerLambda);
+    imageBucket.grantPut(taskHandlerLambda, 'sd/in/*');
 
     // Create API Gateway with unique name
     const api = new apigateway.RestApi(this, 'SdApi', {
@@ -227,6 +244,12 @@ export class SdInferenceStack extends cdk.Stack {
       resources: [taskQueue.queueArn],
     }));
 
+    // The scheduler forwards permanently failed tasks to the DLQ itself
+    ec2Role.addToPolicy(new iam.PolicyStatement({
+      actions: ['sqs:SendMessage'],
+      resources: [deadLetterQueue.queueArn],
+    }));
+
     ec2Role.addToPolicy(new iam.PolicyStatement({
       actions: [
         'dynamodb:GetItem',
@@ -249,6 +272,9 @@ export class SdInferenceStack extends cdk.Stack {
         'ec2:DescribeTags',
         'ec2:DescribeInstances',
         'autoscaling:SetInstanceHealth',
+        'autoscaling:DescribeAutoScalingInstances',
+        'autoscaling:DescribeAutoScalingGroups',
+        'autoscaling:CompleteLifecycleAction',
       ],
       resources: ['*'],
     }));
@@ -416,6 +442,14 @@ export class SdInferenceStack extends cdk.Stack {
       cooldown: cdk.Duration.seconds(300),
     });
 
+    // Hold terminating instances until the scheduler drained, it completes the hook itself
+    asg.addLifecycleHook('DrainHook', {
+      lifecycleHookName: `sd-inference-drain-${deploymentId}`,
+      lifecycleTransition: autoscaling.LifecycleTransition.INSTANCE_TERMINATING,
+      heartbeatTimeout: cdk.Duration.minutes(5),
+      defaultResult: autoscaling.DefaultResult.CONTINUE,
+    });
+
     // Add tags to instances
     cdk.Tags.of(asg).add('DeploymentId', deploymentId);
     cdk.Tags.of(asg).add('Name', `sd-inference-${deploymentId}`);
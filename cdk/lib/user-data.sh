@@ -69,6 +69,8 @@ systemctl enable amazon-cloudwatch-agent
 # Create directories
 mkdir -p /opt/sd-inference
 mkdir -p /var/log/api-scheduler
+# Rendered images waiting for their upload, kept across container restarts
+mkdir -p /opt/sd-inference/spool
 
 # Get instance metadata
 TOKEN=$(curl -X PUT "http://169.254.169.254/latest/api/token" -H "X-aws-ec2-metadata-token-ttl-seconds: 21600")
@@ -112,6 +114,16 @@ bucket_name = sd-images-$DEPLOYMENT_ID-$(echo $ACCOUNT_ID | cut -c1-5)
 [api]
 port = 8080
 workers = 4
+
+[failures]
+# send_message needs the queue URL, not its name
+dlq_url = https://sqs.$REGION.amazonaws.com/$ACCOUNT_ID/sd-task-dlq-$DEPLOYMENT_ID
+
+[output]
+spool_dir = /app/spool
+
+[drain]
+lifecycle_hook = sd-inference-drain-$DEPLOYMENT_ID
 EOF
 
 # Create health check script
@@ -152,8 +164,10 @@ ExecStartPre=-/usr/bin/docker stop sd-api-scheduler
 ExecStartPre=-/usr/bin/docker rm sd-api-scheduler
 ExecStart=/usr/bin/docker run --name sd-api-scheduler \\
   --restart=unless-stopped \\
+  --stop-timeout 150 \\
   -p 8080:8080 \\
   -v /opt/sd-inference/config:/app/config \\
+  -v /opt/sd-inference/spool:/app/spool \\
   -e AWS_REGION=$REGION \\
   -e DEPLOYMENT_ID=$DEPLOYMENT_ID \\
   -e IMAGE_VERSION=$IMAGE_VERSION \\
@@ -162,7 +176,8 @@ ExecStart=/usr/bin/docker run --name sd-api-scheduler \\
   --log-opt awslogs-group=sd-inference-api-scheduler \\
   --log-opt awslogs-stream=$INSTANCE_ID \\
   $ECR_REPO:$IMAGE_VERSION
-ExecStop=/usr/bin/docker stop sd-api-scheduler
+ExecStop=/usr/bin/docker stop -t 150 sd-api-scheduler
+TimeoutStopSec=180
 Restart=always
 RestartSec=10
 StandardOutput=append:/var/log/api-scheduler/application.log
@@ -0,0 +1,115 @@
+"""Benchmark the peak memory of handling a webui response for growing batch sizes
+
+Compares parsing the whole response with response.json() and decoding every image
+into bytes, as the scheduler used to, with the path the pipeline takes: the
+streaming decode of sd_api.call_webui, sd_api.encode_files and the upload from
+the output spool. Each measurement runs in a fresh process talking to a fake webui and the local S3
+stand-in, and reports the peak RSS above the RSS after the imports.
+
+    python3 -m bench.decode_memory --batch-sizes 1 2 4 8 16 --size 1024
+"""
+import argparse
+import base64
+import json
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+
+MODES = ('buffered', 'streaming')
+
+
+def status_kb(field):
+    """A memory field of /proc/self/status in KB, VmRSS for the current RSS and VmHWM for its peak
+
+    ru_maxrss isn't used, it keeps the peak of the parent across fork and exec.
+    """
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(f'{field}:'):
+                return int(line.split()[1])
+    return 0
+
+
+def child(mode, webui_url, s3_url, batch, size):
+    """Handle one response of batch images, print the baseline and peak RSS in KB as JSON"""
+    import scheduler.clients as clients
+    import scheduler.sd_api as sd_api
+    import scheduler.sd_s3 as sd_s3
+    from bench.local_s3 import s3_client
+
+    clients.register('s3', s3_client(s3_url))
+    payload = {"prompt": "bench", "batch_size": batch, "width": size, "height": size, "steps": 1}
+    baseline = status_kb('VmRSS')
+    if mode == 'buffered':
+        response = clients.http_session('webui').post(f'{webui_url}/sdapi/v1/txt2img', json=payload).json()
+        bodies = [base64.b64decode(image) for image in response['images']]
+        for cnt, body in enumerate(bodies, 1):
+            sd_s3.put_object_to_s3(f"bench/buffered/{batch}-{cnt}.png", body, 'image/png')
+    else:
+        import scheduler.streaming as streaming
+        from scheduler.spool import OutputSpool
+        # a spool of its own, on the filesystem of the decoded images it takes over
+        directory = tempfile.mkdtemp(dir=streaming.spool_directory())
+        output_spool = OutputSpool(directory, 1 << 40, workers=sd_api.upload_concurrency)
+        output_spool.start()
+        done = threading.Event()
+        try:
+            response = sd_api.call_webui('/sdapi/v1/txt2img', payload, webui_url)
+            files, thumbnails = sd_api.encode_files(response['images'], f"bench/streaming/{batch}", None,
+                                                    sd_api.infotexts(response))
+            output_spool.add(f"bench-{batch}", files, thumbnails, {}, lambda record: done.set(),
+                             lambda error: done.set())
+            done.wait()
+        finally:
+            output_spool.stop()
+            shutil.rmtree(directory, ignore_errors=True)
+    print(json.dumps({"baseline": baseline, "peak": status_kb('VmHWM')}))
+
+
+def measure(mode, webui, s3, batch, size):
+    out = subprocess.run(
+        [sys.executable, '-m', 'bench.decode_memory', '--child', mode,
+         '--webui', webui.url, '--s3', s3.endpoint_url, '--batch-sizes', str(batch), '--size', str(size)],
+        check=True, capture_output=True, text=True
+    ).stdout
+    result = json.loads(out.strip().splitlines()[-1])
+    # the stand-in keeps what was uploaded, it isn't part of the measurement
+    s3.objects.clear()
+    return (result["peak"] - result["baseline"]) / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 2, 4, 8, 16])
+    parser.add_argument('--size', type=int, default=1024, help='image width and height in pixels')
+    parser.add_argument('--child', choices=MODES, help=argparse.SUPPRESS)
+    parser.add_argument('--webui', help=argparse.SUPPRESS)
+    parser.add_argument('--s3', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child(args.child, args.webui, args.s3, args.batch_sizes[0], args.size)
+        return
+
+    from bench.fake_webui import FakeWebui
+    from bench.local_s3 import LocalS3Server
+    webui = FakeWebui(step_latency=0, base_latency=0).start()
+    s3 = LocalS3Server(latency=0).start()
+    try:
+        import scheduler.sd_api as sd_api
+        image = webui._image(args.size, args.size)
+        # the streaming peak grows with the uploads in flight, not with the batch size
+        print(f"image size {len(image) * 3 // 4 / 1024 / 1024:.2f} MB, base64 {len(image) / 1024 / 1024:.2f} MB, "
+              f"upload_concurrency {sd_api.upload_concurrency}")
+        print(f"{'batch':>5} {'buffered MB':>12} {'streaming MB':>13}")
+        for batch in args.batch_sizes:
+            peaks = [measure(mode, webui, s3, batch, args.size) for mode in MODES]
+            print(f"{batch:>5} {peaks[0]:>12.1f} {peaks[1]:>13.1f}")
+    finally:
+        webui.stop()
+        s3.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+"""Fake Stable Diffusion webui for benchmarks
+
+Implements the endpoints the scheduler uses: txt2img/img2img, options and progress.
+Inference runs one call at a time like the real webui and sleeps for a configurable
+time per image and step; the images are real base64 PNGs of the requested size.
+
+    python3 -m bench.fake_webui --port 7860 --step-latency 0.01 --image-size 512
+"""
+import argparse
+import base64
+import io
+import json
+import os
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse
+
+from PIL import Image
+
+
+class FakeWebuiHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def _reply(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return json.loads(self.rfile.read(length) or b'{}')
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == '/sdapi/v1/options':
+            self._reply(200, self.server.options())
+        elif path == '/sdapi/v1/progress':
+            self._reply(200, self.server.progress())
+        else:
+            self._reply(404, {"detail": "Not Found"})
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        payload = self._body()
+        if path in ('/sdapi/v1/txt2img', '/sdapi/v1/img2img'):
+            self._reply(200, self.server.render(payload))
+        elif path == '/sdapi/v1/options':
+            self.server.set_options(payload)
+            self._reply(200, None)
+        else:
+            self._reply(404, {"detail": "Not Found"})
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeWebui(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port=0, step_latency=0.01, base_latency=0.05, swap_latency=1.0, image_size=None):
+        super().__init__(('127.0.0.1', port), FakeWebuiHandler)
+        self.step_latency = step_latency
+        self.base_latency = base_latency
+        self.swap_latency = swap_latency
+        self.image_size = image_size
+        self.model = "fake-model.safetensors"
+        self.vae = "Automatic"
+        self.gpu = threading.Lock()
+        self.lock = threading.Lock()
+        self.images = {}
+        self.current = None
+        self.stats = {"calls": 0, "images": 0, "swaps": 0, "busy_seconds": 0.0}
+        self.thread = None
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def _image(self, width, height):
+        """Base64 PNG of random noise, generated once per size"""
+        key = (width, height)
+        with self.lock:
+            if key not in self.images:
+                image = Image.frombytes('RGB', key, os.urandom(width * height * 3))
+                buf = io.BytesIO()
+                image.save(buf, format='PNG')
+                self.images[key] = base64.b64encode(buf.getvalue()).decode()
+            return self.images[key]
+
+    def options(self):
+        return {"sd_model_checkpoint": self.model, "sd_vae": self.vae}
+
+    def set_options(self, options):
+        with self.gpu:
+            model = options.get("sd_model_checkpoint")
+            if model and model != self.model:
+                time.sleep(self.swap_latency)
+                self.model = model
+                self.stats["swaps"] += 1
+            if options.get("sd_vae"):
+                self.vae = options["sd_vae"]
+
+    def progress(self):
+        current = self.current
+        if current is None:
+            return {"progress": 0, "eta_relative": 0, "state": {"job_count": 0}, "current_image": None}
+        elapsed = time.time() - current["start"]
+        done = min(elapsed / current["duration"], 1) if current["duration"] else 1
+        return {"progress": done, "eta_relative": max(current["duration"] - elapsed, 0),
+                "state": {"job_count": 1}, "current_image": None}
+
+    def render(self, payload):
+        count = int(payload.get("batch_size", 1)) * int(payload.get("n_iter", 1))
+        width = self.image_size or int(payload.get("width", 512))
+        height = self.image_size or int(payload.get("height", 512))
+        steps = int(payload.get("steps", 20))
+        # cost grows with steps, batch and pixels relative to 512x512
+        duration = self.base_latency + self.step_latency * steps * count * (width * height) / (512 * 512)
+        image = self._image(width, height)
+        with self.gpu:
+            self.current = {"start": time.time(), "duration": duration}
+            time.sleep(duration)
+            self.current = None
+            self.stats["calls"] += 1
+            self.stats["images"] += count
+            self.stats["busy_seconds"] += duration
+        infotext = f'{payload.get("prompt", "")}\nSteps: {steps}, Seed: {payload.get("seed", -1)}, Size: {width}x{height}'
+        info = {"seed": payload.get("seed", -1), "infotexts": [infotext] * count}
+        return {"images": [image] * count, "parameters": payload, "info": json.dumps(info)}
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=7860)
+    parser.add_argument('--step-latency', type=float, default=0.01, help='seconds per step and 512x512 image')
+    parser.add_argument('--base-latency', type=float, default=0.05, help='fixed seconds per call')
+    parser.add_argument('--swap-latency', type=float, default=1.0, help='seconds to load another checkpoint')
+    parser.add_argument('--image-size', type=int, default=None, help='return images of this size instead of the payload size')
+    args = parser.parse_args()
+    server = FakeWebui(args.port, args.step_latency, args.base_latency, args.swap_latency, args.image_size)
+    print(f"Fake webui listening on {server.url}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+"""Minimal in-memory S3 stand-in for benchmarks
+
+Supports PutObject, GetObject, HeadObject and the multipart upload calls used by
+the boto3 transfer manager. Every request sleeps for a configurable latency to
+mimic the S3 round trip.
+"""
+import hashlib
+import threading
+import time
+import uuid
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+
+class LocalS3Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def _key(self):
+        return urlparse(self.path).path.lstrip('/')
+
+    def _query(self):
+        return parse_qs(urlparse(self.path).query, keep_blank_values=True)
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return self.rfile.read(length) if length else b''
+
+    def _reply(self, status=200, body=b'', headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if body and self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def do_PUT(self):
+        time.sleep(self.server.latency)
+        data = self._body()
+        query = self._query()
+        etag = f'"{hashlib.md5(data).hexdigest()}"'
+        if 'uploadId' in query:
+            upload = self.server.uploads[query['uploadId'][0]]
+            upload['parts'][int(query['partNumber'][0])] = data
+        else:
+            self.server.put(self._key(), data, self.headers.get('Content-Type'), etag)
+        self._reply(200, headers={'ETag': etag})
+
+    def do_POST(self):
+        time.sleep(self.server.latency)
+        self._body()
+        key = self._key()
+        query = self._query()
+        if 'uploads' in query:
+            upload_id = uuid.uuid4().hex
+            self.server.uploads[upload_id] = {'parts': {}, 'content_type': self.headers.get('Content-Type')}
+            bucket, _, name = key.partition('/')
+            body = (f'<InitiateMultipartUploadResult><Bucket>{bucket}</Bucket><Key>{name}</Key>'
+                    f'<UploadId>{upload_id}</UploadId></InitiateMultipartUploadResult>').encode()
+            self._reply(200, body, {'Content-Type': 'application/xml'})
+        elif 'uploadId' in query:
+            upload = self.server.uploads.pop(query['uploadId'][0])
+            data = b''.join(upload['parts'][n] for n in sorted(upload['parts']))
+            etag = f'"{hashlib.md5(data).hexdigest()}-{len(upload["parts"])}"'
+            self.server.put(key, data, upload['content_type'], etag)
+            body = f'<CompleteMultipartUploadResult><ETag>{etag}</ETag></CompleteMultipartUploadResult>'.encode()
+            self._reply(200, body, {'Content-Type': 'application/xml'})
+        else:
+            self._reply(400)
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        obj = self.server.objects.get(self._key())
+        if obj is None:
+            self._reply(404, b'<Error><Code>NoSuchKey</Code></Error>', {'Content-Type': 'application/xml'})
+            return
+        data, content_type, etag = obj
+        self._reply(200, data, {'Content-Type': content_type or 'binary/octet-stream', 'ETag': etag})
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class LocalS3Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port=0, latency=0.03):
+        super().__init__(('127.0.0.1', port), LocalS3Handler)
+        self.latency = latency
+        self.objects = {}
+        self.uploads = {}
+        self.lock = threading.Lock()
+        self.thread = None
+
+    @property
+    def endpoint_url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def put(self, key, data, content_type, etag):
+        with self.lock:
+            self.objects[key] = (data, content_type, etag)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def s3_client(endpoint_url):
+    """boto3 S3 client that talks to the stand-in"""
+    import boto3
+    from botocore.config import Config
+    return boto3.client(
+        's3',
+        endpoint_url=endpoint_url,
+        aws_access_key_id='bench',
+        aws_secret_access_key='bench',
+        config=Config(
+            s3={'addressing_style': 'path'},
+            request_checksum_calculation='when_required',
+            max_pool_connections=32
+        )
+    )
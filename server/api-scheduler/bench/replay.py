@@ -0,0 +1,264 @@
+"""Replay a task trace through the scheduler pipeline against local stand-ins
+
+Starts the fake webui and a moto server for SQS, DynamoDB and S3, submits tasks the
+way the task Lambda does (a waiting row plus an SQS message) and runs the real
+pipeline from sqs.build_pipeline() until every task is finished. Prints the
+throughput, end-to-end latency percentiles and the mean time of each pipeline stage.
+
+    python3 -m bench.replay --tasks 50 --rate 5
+    python3 -m bench.replay --trace trace.jsonl --output result.json
+    python3 -m bench.replay --tasks 50 --baseline result.json --tolerance 0.1
+    python3 -m bench.replay --tasks 100 --rate 20 --backends 4
+
+A trace has one task per line, {"requestData": {"api": ..., "payload": ...}} with an
+optional "at" offset in seconds from the start of the replay. Tasks without it are
+submitted at --rate per second. With --backends N the pipeline drives N fake
+webuis, like one scheduler on a multi-GPU instance. Scheduler options come from
+--config, the aws section and webui endpoints are always pointed at the
+stand-ins. Needs moto[server] installed.
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import sys
+import time
+import uuid
+from datetime import datetime
+
+from bench.fake_webui import FakeWebui
+
+PROMPTS = ["puppy dog", "a cat on a sofa", "mountain lake at sunrise", "city street at night"]
+
+
+def start_moto():
+    try:
+        from moto.server import ThreadedMotoServer
+    except ImportError:
+        sys.exit("bench.replay needs moto, install it with: pip install 'moto[server]'")
+    # moto logs every request through werkzeug
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = ThreadedMotoServer(ip_address='127.0.0.1', port=0, verbose=False)
+    server.start()
+    host, port = server.get_host_and_port()
+    return server, f'http://{host}:{port}'
+
+
+def configure(endpoint_url, config_path):
+    """Point the scheduler config at the stand-ins, before any scheduler module reads it"""
+    # moto accepts any credentials, make sure no real ones are picked up
+    os.environ['AWS_ACCESS_KEY_ID'] = 'testing'
+    os.environ['AWS_SECRET_ACCESS_KEY'] = 'testing'
+    os.environ.pop('AWS_SESSION_TOKEN', None)
+    os.environ.pop('AWS_PROFILE', None)
+
+    from scheduler.conf import schedulerConfig
+    if config_path:
+        schedulerConfig.read(config_path)
+    schedulerConfig.read_dict({
+        'aws': {
+            'region': 'us-east-1',
+            'queue_url': f'{endpoint_url}/123456789012/sd_task_queue',
+            'dynamodb_table_name': 'sd_tasks',
+            'bucket_name': 'sd-bench',
+            'cloudfront': 'https://bench.invalid/',
+            's3_endpoint_url': endpoint_url,
+            'sqs_endpoint_url': endpoint_url,
+            'dynamodb_endpoint_url': endpoint_url,
+        }
+    })
+    for section in [s for s in schedulerConfig.sections() if s.startswith('queue.')]:
+        schedulerConfig.remove_section(section)
+    if not schedulerConfig.has_section('scheduler'):
+        schedulerConfig.add_section('scheduler')
+    # short polls so the pipeline stops promptly at the end of the run
+    schedulerConfig.set('scheduler', 'wait_time', '1')
+    return schedulerConfig
+
+
+def create_resources(config):
+    import scheduler.clients as clients
+    clients.client('sqs').create_queue(QueueName='sd_task_queue')
+    clients.client('dynamodb').create_table(
+        TableName=config.get('aws', 'dynamodb_table_name'),
+        KeySchema=[{'AttributeName': 'taskId', 'KeyType': 'HASH'}],
+        AttributeDefinitions=[{'AttributeName': 'taskId', 'AttributeType': 'S'}],
+        BillingMode='PAY_PER_REQUEST'
+    )
+    clients.client('s3').create_bucket(Bucket=config.get('aws', 'bucket_name'))
+
+
+def load_trace(path, tasks, rate):
+    """[(offset seconds, requestData)] sorted by offset"""
+    if path:
+        with open(path) as f:
+            entries = [json.loads(line) for line in f if line.strip()]
+    else:
+        entries = [{"requestData": {
+            "api": "/sdapi/v1/txt2img",
+            "payload": {"prompt": random.choice(PROMPTS), "steps": random.choice([10, 20, 30]), "seed": -1}
+        }} for _ in range(tasks)]
+    trace = []
+    for n, entry in enumerate(entries):
+        trace.append((entry.get("at", n / rate), entry["requestData"]))
+    return sorted(trace, key=lambda t: t[0])
+
+
+def submit(config, requestData, storage):
+    """Submit a task like the task Lambda: a waiting row, then the SQS message"""
+    import scheduler.clients as clients
+    taskId = str(uuid.uuid4())
+    clients.client('dynamodb').put_item(
+        TableName=config.get('aws', 'dynamodb_table_name'),
+        Item={
+            'taskId': {'S': taskId},
+            'requestData': {'S': json.dumps(requestData)},
+            'taskStatus': {'S': 'waiting'},
+            'submitTime': {'S': datetime.now().isoformat()}
+        }
+    )
+    message = {"taskId": taskId, "storage": storage}
+    if storage == "inline":
+        message["requestData"] = json.dumps(requestData)
+    clients.client('sqs').send_message(
+        QueueUrl=config.get('aws', 'queue_url'),
+        MessageBody=json.dumps(message)
+    )
+    return taskId
+
+
+def wait_finished(config, submitted, timeout):
+    """{taskId: latency in seconds} of the tasks finished within timeout"""
+    import scheduler.clients as clients
+    dynamodb = clients.client('dynamodb')
+    latencies = {}
+    deadline = time.time() + timeout
+    while len(latencies) < len(submitted) and time.time() < deadline:
+        for taskId, submitted_at in submitted.items():
+            if taskId in latencies:
+                continue
+            item = dynamodb.get_item(TableName=config.get('aws', 'dynamodb_table_name'), Key={'taskId': {'S': taskId}}).get('Item')
+            if item and item.get('taskStatus', {}).get('S') == 'finished':
+                processed_at = datetime.fromisoformat(item['processTime']['S']).timestamp()
+                latencies[taskId] = processed_at - submitted_at
+        time.sleep(0.5)
+    return latencies
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    return ordered[min(int(len(ordered) * pct / 100), len(ordered) - 1)]
+
+
+def stage_means():
+    import scheduler.metrics as metrics
+    means = {}
+    with metrics.stage_seconds.lock:
+        children = list(metrics.stage_seconds.children.items())
+    for stage, child in children:
+        total = child.value()
+        if total[-1]:
+            means[stage] = total[-2] / total[-1]
+    return means
+
+
+def compare(result, baseline, tolerance):
+    """Regressions of result against baseline, as messages"""
+    regressions = []
+    if result["throughput"] < baseline["throughput"] * (1 - tolerance):
+        regressions.append(f"throughput {result['throughput']:.2f}/s < baseline {baseline['throughput']:.2f}/s")
+    for key in ("p50", "p95", "p99"):
+        if result["latency"][key] > baseline["latency"][key] * (1 + tolerance):
+            regressions.append(f"{key} {result['latency'][key]:.2f}s > baseline {baseline['latency'][key]:.2f}s")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--trace', help='JSONL trace of requestData to replay')
+    parser.add_argument('--tasks', type=int, default=50, help='number of synthetic tasks without --trace')
+    parser.add_argument('--rate', type=float, default=5, help='tasks submitted per second')
+    parser.add_argument('--storage', choices=['dynamodb', 'inline'], default='inline', help='task storage of the messages')
+    parser.add_argument('--config', help='conf.ini with the scheduler, cache and queue settings to benchmark')
+    parser.add_argument('--backends', type=int, default=1, help='number of fake webuis')
+    parser.add_argument('--step-latency', type=float, default=0.005, help='fake webui seconds per step and 512x512 image')
+    parser.add_argument('--swap-latency', type=float, default=1.0, help='fake webui seconds to load another checkpoint')
+    parser.add_argument('--image-size', type=int, default=None, help='fake webui image size instead of the payload size')
+    parser.add_argument('--timeout', type=float, default=600, help='seconds to wait for the tasks to finish')
+    parser.add_argument('--output', help='write the result as JSON')
+    parser.add_argument('--baseline', help='result JSON of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='allowed relative regression against --baseline')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    moto, endpoint_url = start_moto()
+    webuis = [FakeWebui(step_latency=args.step_latency, swap_latency=args.swap_latency,
+                        image_size=args.image_size).start() for _ in range(args.backends)]
+    config = configure(endpoint_url, args.config)
+    create_resources(config)
+
+    import scheduler.sd_api as sd_api
+    import scheduler.backends as backends
+    import scheduler.sqs as sqs
+    sd_api.webui_api_url = webuis[0].url
+    backends.endpoints = [webui.url for webui in webuis]
+
+    trace = load_trace(args.trace, args.tasks, args.rate)
+    pipeline = sqs.build_pipeline()
+    pipeline.start()
+    try:
+        submitted = {}
+        start = time.time()
+        for offset, requestData in trace:
+            delay = start + offset - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            submitted[submit(config, requestData, args.storage)] = time.time()
+        latencies = wait_finished(config, submitted, args.timeout)
+        elapsed = time.time() - start
+    finally:
+        pipeline.stop()
+        for webui in webuis:
+            webui.stop()
+        moto.stop()
+
+    values = list(latencies.values())
+    result = {
+        "tasks": len(trace),
+        "finished": len(values),
+        "seconds": elapsed,
+        "throughput": len(values) / elapsed if elapsed else 0.0,
+        "latency": {"p50": percentile(values, 50), "p95": percentile(values, 95), "p99": percentile(values, 99)},
+        "stages": stage_means(),
+        "webui": {key: sum(webui.stats[key] for webui in webuis) for key in webuis[0].stats},
+        "backends": [webui.stats for webui in webuis],
+    }
+    busy = ', '.join(f"{webui.stats['busy_seconds'] / elapsed * 100:.0f}%" for webui in webuis)
+    print(f"{result['finished']}/{result['tasks']} tasks in {elapsed:.1f}s, {result['throughput']:.2f} tasks/s, "
+          f"webui busy {busy}, {result['webui']['swaps']} model swaps")
+    print(f"latency p50 {result['latency']['p50']:.2f}s p95 {result['latency']['p95']:.2f}s "
+          f"p99 {result['latency']['p99']:.2f}s")
+    for stage, mean in sorted(result["stages"].items()):
+        print(f"  {stage:<12} {mean * 1000:>9.1f} ms")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+
+    failed = result["finished"] < result["tasks"]
+    if failed:
+        print(f"{result['tasks'] - result['finished']} tasks did not finish within {args.timeout:.0f}s")
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(result, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        failed = failed or bool(regressions)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""Benchmark image uploads of sd_api against the local S3 stand-in
+
+Compares uploading the files of sd_api.encode_files one after another with the
+uploader threads of the output spool for growing batch sizes and prints the task
+latency and the latency per image. --format,
+--quality and --thumbnails override the [output] encoding.
+
+    python3 -m bench.s3_upload --batch-sizes 1 2 4 8 --size 1024 --latency 0.05
+"""
+import argparse
+import io
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from PIL import Image
+
+import scheduler.clients as clients
+import scheduler.encoding as encoding
+import scheduler.sd_api as sd_api
+import scheduler.sd_s3 as sd_s3
+import scheduler.streaming as streaming
+from scheduler.spool import OutputSpool
+from bench.local_s3 import LocalS3Server, s3_client
+
+
+def make_image(size):
+    """Random noise PNG, compresses about as badly as a detailed render"""
+    image = Image.frombytes('RGB', (size, size), os.urandom(size * size * 3))
+    buf = io.BytesIO()
+    image.save(buf, format='PNG')
+    return buf.getvalue()
+
+
+def upload_serial(images, imagekey, output=None):
+    files, _ = sd_api.encode_files(images, imagekey, output)
+    try:
+        return [sd_s3.upload_file_to_s3(f["key"], f["path"], f["content_type"]) for f in files]
+    finally:
+        sd_api.discard_files(files)
+
+
+class SpoolUpload:
+    """Uploads through an output spool of its own, like the pipeline"""
+    def __init__(self):
+        self.directory = tempfile.mkdtemp(dir=streaming.spool_directory())
+        self.spool = OutputSpool(self.directory, 1 << 40, workers=sd_api.upload_concurrency)
+        self.spool.start()
+
+    def __call__(self, images, imagekey, output=None):
+        files, thumbnails = sd_api.encode_files(images, imagekey, output)
+        done = threading.Event()
+        record = self.spool.add(imagekey.replace('/', '-'), files, thumbnails, {},
+                                lambda record: done.set(), lambda error: done.set())
+        done.wait()
+        self.spool.remove(record)
+        return record.res
+
+    def close(self):
+        self.spool.stop()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def timed(fn, image, batch, imagekey, rounds, output):
+    best = None
+    for n in range(rounds):
+        # encoding takes over the spooled images, like the webui response they come from
+        images = [streaming.spool(image) for _ in range(batch)]
+        start = time.perf_counter()
+        fn(images, f"{imagekey}/{n}", output)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--size', type=int, default=1024, help='image width and height in pixels')
+    parser.add_argument('--latency', type=float, default=0.05, help='simulated S3 latency per request in seconds')
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--format', default=None, help='output format, png, jpeg, webp or avif, default from conf.ini')
+    parser.add_argument('--quality', type=int, default=None)
+    parser.add_argument('--thumbnails', type=int, nargs='*', default=None, help='thumbnail sizes')
+    args = parser.parse_args()
+
+    server = LocalS3Server(latency=args.latency).start()
+    clients.register('s3', s3_client(server.endpoint_url))
+    output = {k: v for k, v in (("format", args.format), ("quality", args.quality),
+                                ("thumbnails", args.thumbnails)) if v is not None}
+    pooled_upload = SpoolUpload()
+    try:
+        image = make_image(args.size)
+        print(f"image size {len(image) / 1024 / 1024:.2f} MB, S3 latency {args.latency * 1000:.0f} ms, "
+              f"upload_concurrency {sd_api.upload_concurrency}, output {encoding.options(output)}")
+        print(f"{'batch':>5} {'serial s':>9} {'pooled s':>9} {'serial/img':>11} {'pooled/img':>11} {'speedup':>8}")
+        for batch in args.batch_sizes:
+            serial = timed(upload_serial, image, batch, f'bench/serial/{batch}', args.rounds, output)
+            pooled = timed(pooled_upload, image, batch, f'bench/pooled/{batch}', args.rounds, output)
+            print(f"{batch:>5} {serial:>9.3f} {pooled:>9.3f} {serial / batch:>11.3f} {pooled / batch:>11.3f} "
+                  f"{serial / pooled:>7.1f}x")
+    finally:
+        pooled_upload.close()
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
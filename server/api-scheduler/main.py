@@ -1,7 +1,13 @@
+import time
+# time-to-ready is measured from here, before the imports
+started = time.time()
+
 import signal
 import sys
 import logging
 from scheduler import sqs
+from scheduler import warmup
+from scheduler.drain import get_drainer
 from scheduler.health_check import init_health_check
 from scheduler.api_server import init_api_server
 from scheduler.conf import schedulerConfig
@@ -16,11 +22,15 @@ logger = logging.getLogger('main')
 # Global variables for graceful shutdown
 health_checker = None
 api_server = None
+drainer = None
+
+def shutdown():
+    """Stop the services and exit"""
+    logger.info("Shutting down...")
+
+    if drainer:
+        drainer.stop()
 
-def signal_handler(sig, frame):
-    """Handle termination signals for graceful shutdown"""
-    logger.info("Received termination signal, shutting down...")
-    
     # Stop health checker
     if health_checker:
         health_checker.stop()
@@ -31,6 +41,18 @@ def signal_handler(sig, frame):
         
     sys.exit(0)
 
+def signal_handler(sig, frame):
+    """Handle termination signals for graceful shutdown
+
+    The first signal drains the running pipeline, the process exits once that
+    is done. A second signal, or one before the pipeline started, exits at once.
+    """
+    if drainer and drainer.active and not drainer.requested.is_set():
+        drainer.request(signal.Signals(sig).name)
+        return
+    logger.info("Received termination signal")
+    shutdown()
+
 if __name__ == "__main__":
     # Register signal handlers for graceful shutdown
     signal.signal(signal.SIGINT, signal_handler)
@@ -40,15 +62,30 @@ if __name__ == "__main__":
         # Initialize and start health check service
         health_checker = init_health_check()
         health_checker.start()
+
+        # Drain on a spot interruption notice or an Auto Scaling termination
+        drainer = get_drainer(health_checker)
+        drainer.start()
         
         # Initialize and start API server for health checks
         api_port = int(schedulerConfig.get('api', 'port', fallback='8080'))
         api_server = init_api_server(api_port)
         api_server.start()
-        
+
+        # Wait for the webui, load the default checkpoint and run a warm-up inference
+        # before taking messages, so the first tasks don't fail back to the queue
+        warmup.run(started)
+
         # Start processing SQS messages
         logger.info("Starting SQS message processing...")
-        sqs.receiveAndProcess()
+        sqs.receiveAndProcess(drainer)
+
+        # After a termination notice the instance is about to go away; stay drained
+        # and keep serving /health instead of exiting and being restarted
+        if drainer.reason in ("spot", "lifecycle"):
+            while True:
+                signal.pause()
+        shutdown()
     except Exception as e:
         logger.error(f"Error in main process: {e}")
         sys.exit(1)
\ No newline at end of file
@@ -1,8 +1,10 @@
 import threading
 import logging
 import json
-from http.server import HTTPServer, BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 from scheduler.health_check import get_health_checker
+from scheduler.warmup import get_readiness
+import scheduler.metrics as metrics
 
 # Configure logging
 logging.basicConfig(
@@ -31,6 +33,18 @@ class HealthCheckHandler(BaseHTTPRequestHandler):
                 
             # Return health status as JSON
             self.wfile.write(json.dumps(status).encode())
+        elif self.path == '/ready':
+            # 200 once the webui is warm and the queue is being polled
+            readiness = get_readiness()
+            self._set_headers(200 if readiness.is_ready() else 503)
+            self.wfile.write(json.dumps(readiness.status()).encode())
+        elif self.path == '/metrics':
+            body = metrics.render().encode()
+            self.send_response(200)
+            self.send_header('Content-type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
         else:
             self._set_headers(404)
             self.wfile.write(json.dumps({"error": "Not found"}).encode())
@@ -57,7 +71,9 @@ class ApiServer:
     def _run_server(self):
         """Run the HTTP server"""
         try:
-            self.server = HTTPServer(('0.0.0.0', self.port), HealthCheckHandler)
+            # threaded so a slow scrape or health probe never blocks the others
+            self.server = ThreadingHTTPServer(('0.0.0.0', self.port), HealthCheckHandler)
+            self.server.daemon_threads = True
             logger.info(f"Server running on port {self.port}")
             self.server.serve_forever()
         except Exception as e:
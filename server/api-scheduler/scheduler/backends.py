@@ -0,0 +1,168 @@
+import threading
+import time
+import logging
+from contextlib import contextmanager
+
+import scheduler.sd_api as sd_api
+import scheduler.failures as failures
+import scheduler.metrics as metrics
+from scheduler.conf import schedulerConfig
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger('backends')
+
+# webui 地址, 逗号分隔, 多GPU实例每个GPU运行一个webui; 为空时使用 sd_api.webui_api_url
+endpoints = [e.strip().rstrip('/') for e in schedulerConfig.get('webui', 'endpoints', fallback='').split(',') if e.strip()]
+# 推理调用连续失败多少次后暂停使用该 webui, 暂停多少秒后再试
+failure_threshold = schedulerConfig.getint('webui', 'failure_threshold', fallback=2)
+cooldown = schedulerConfig.getint('webui', 'cooldown', fallback=30)
+
+
+class Backend:
+    """One webui endpoint and the work running on it"""
+    def __init__(self, url):
+        self.url = url
+        self.outstanding = 0
+        # set by the warm-up and the health check probes
+        self.healthy = True
+        # whether the backend passed its warm-up, True when there is none
+        self.warmed = True
+        # consecutive failed calls, and until when the backend is out of rotation because of them
+        self.failures = 0
+        self.down_until = 0
+        self.last_used = 0
+        self.stats = {"calls": 0, "errors": 0}
+
+    def available(self, now):
+        return self.healthy and now >= self.down_until
+
+    def status(self):
+        return {
+            "url": self.url,
+            "available": self.available(time.time()),
+            "healthy": self.healthy,
+            "warmed": self.warmed,
+            "outstanding": self.outstanding,
+            "consecutive_failures": self.failures,
+            "calls": self.stats["calls"],
+            "errors": self.stats["errors"],
+        }
+
+
+class BackendPool:
+    """Routes webui calls to the least loaded available backend
+
+    A backend is out of rotation until its warm-up finished, while the health
+    check finds it unreachable or stuck, and for cooldown seconds after
+    failure_threshold calls in a row failed on it; after the cooldown the next
+    call tries it again. Among the available
+    backends the one with the fewest calls outstanding wins, ties go to a backend
+    prefer() accepts (e.g. the one with the task's model loaded) and then to the
+    one idle the longest. When no backend is available the one coming back first
+    is used, so the tasks fail and retry like they would with a single webui.
+    """
+    def __init__(self, urls, failure_threshold=2, cooldown=30):
+        self.backends = [Backend(url) for url in urls]
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.backends)
+
+    def __iter__(self):
+        return iter(self.backends)
+
+    def acquire(self, prefer=None):
+        """Reserve a backend for one call, release() it when the call is done"""
+        with self.lock:
+            now = time.time()
+            candidates = [b for b in self.backends if b.available(now)]
+            if not candidates:
+                candidates = [min(self.backends, key=lambda b: (not b.healthy, b.down_until))]
+
+            def rank(b):
+                preferred = prefer is not None and prefer(b)
+                return (b.outstanding, not preferred, b.last_used)
+            backend = min(candidates, key=rank)
+            backend.outstanding += 1
+            backend.last_used = now
+            backend.stats["calls"] += 1
+            return backend
+
+    def release(self, backend, ok):
+        """A call on backend finished, ok is False if it failed"""
+        with self.lock:
+            backend.outstanding -= 1
+            if ok:
+                backend.failures = 0
+                return
+            backend.failures += 1
+            backend.stats["errors"] += 1
+            if backend.failures >= self.failure_threshold:
+                backend.down_until = time.time() + self.cooldown
+                logger.warning(f"Webui {backend.url} failed {backend.failures} calls in a row, "
+                               f"out of rotation for {self.cooldown}s")
+
+    @contextmanager
+    def lease(self, prefer=None):
+        """Context manager reserving a backend, a raised exception counts as a failed call
+
+        A PermanentError is the task's fault, e.g. a rejected payload, and doesn't
+        count against the backend.
+        """
+        backend = self.acquire(prefer)
+        try:
+            yield backend
+        except failures.PermanentError:
+            self.release(backend, True)
+            raise
+        except Exception:
+            self.release(backend, False)
+            raise
+        self.release(backend, True)
+
+    def set_warmed(self, url, warmed):
+        """Record the warm-up result of the backend at url, it is in rotation only if it passed"""
+        for backend in self.backends:
+            if backend.url == url:
+                backend.warmed = warmed
+        self.set_healthy(url, warmed)
+
+    def set_healthy(self, url, healthy):
+        """Put the backend at url in or out of rotation, set by the warm-up and the health check
+
+        A backend that hasn't passed its warm-up stays out of rotation.
+        """
+        for backend in self.backends:
+            if backend.url == url and healthy and not backend.warmed:
+                continue
+            if backend.url == url and backend.healthy != healthy:
+                backend.healthy = healthy
+                if healthy:
+                    logger.info(f"Webui {url} is in rotation")
+                else:
+                    logger.warning(f"Webui {url} is out of rotation")
+
+    def status(self):
+        return [b.status() for b in self.backends]
+
+    def register_metrics(self):
+        for backend in self.backends:
+            metrics.backend_outstanding.set_function(lambda b=backend: b.outstanding, backend.url)
+            metrics.backend_up.set_function(lambda b=backend: b.available(time.time()), backend.url)
+
+
+# Singleton instance
+backend_pool = None
+
+def get_backends():
+    """The webui backends of [webui] endpoints, sd_api.webui_api_url if none are configured"""
+    global backend_pool
+    if backend_pool is None:
+        backend_pool = BackendPool(endpoints or [sd_api.webui_api_url], failure_threshold, cooldown)
+    return backend_pool
@@ -0,0 +1,99 @@
+import threading
+import boto3
+import requests
+from botocore.config import Config
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from scheduler.conf import schedulerConfig
+import scheduler.metrics as metrics
+
+# 所有模块共享的 AWS 客户端和 HTTP 会话, 复用连接避免每个任务重新建连和 TLS 握手
+# boto3 客户端创建后是线程安全的, 创建过程不是, 所以统一加锁创建
+
+_lock = threading.Lock()
+_aws_session = None
+_clients = {}
+_http_sessions = {}
+
+# 每个 webui 后端(主机:端口)一个连接池, 路由在后端之间切换时不丢弃长连接
+_webui_hosts = max(len([e for e in schedulerConfig.get('webui', 'endpoints', fallback='').split(',') if e.strip()]), 1)
+
+# HTTP 会话的主机连接池数量, 每个连接池的大小和重试策略
+HTTP_SESSIONS = {
+    # webui 推理请求只在连接失败时重试, 不重发已经发出的推理
+    'webui': {'pool_connections': _webui_hosts, 'pool_maxsize': 8,
+              'retry': Retry(connect=3, read=0, status=0, backoff_factor=0.5)},
+    # 本机 IMDS, 幂等请求可以重试
+    'imds': {'pool_maxsize': 2, 'retry': Retry(total=3, backoff_factor=0.2, allowed_methods=None)},
+    # 健康检查探测 webui, 不重试, 测量真实延迟
+    'probe': {'pool_connections': _webui_hosts, 'pool_maxsize': 1, 'retry': Retry(total=0)},
+}
+
+
+def _count_retries(parsed=None, model=None, **kwargs):
+    attempts = (parsed or {}).get('ResponseMetadata', {}).get('RetryAttempts', 0)
+    if attempts and model is not None:
+        metrics.retries_total.labels(model.service_model.service_name).inc(attempts)
+
+
+def _session():
+    global _aws_session
+    if _aws_session is None:
+        _aws_session = boto3.session.Session(region_name=schedulerConfig.get('aws', 'region'))
+    return _aws_session
+
+
+def client(service):
+    """Shared boto3 client for an AWS service
+
+    Endpoints can be overridden with {service}_endpoint_url in the [aws] section,
+    e.g. to point the scheduler at local stand-ins.
+    """
+    c = _clients.get(service)
+    if c is not None:
+        return c
+    with _lock:
+        if service not in _clients:
+            config = Config(
+                max_pool_connections=schedulerConfig.getint('aws', 'max_pool_connections', fallback=32),
+                retries={
+                    'max_attempts': schedulerConfig.getint('aws', 'max_retries', fallback=5),
+                    'mode': 'standard'
+                },
+                connect_timeout=5,
+                tcp_keepalive=True
+            )
+            _clients[service] = _session().client(
+                service,
+                endpoint_url=schedulerConfig.get('aws', f'{service}_endpoint_url', fallback=None),
+                config=config
+            )
+            _clients[service].meta.events.register('after-call', _count_retries)
+        return _clients[service]
+
+
+def register(service, c):
+    """Replace the shared client of a service, used by benchmarks with local stand-ins"""
+    with _lock:
+        _clients[service] = c
+
+
+def http_session(name):
+    """Shared keep-alive requests session with a tuned pool and retry with backoff"""
+    s = _http_sessions.get(name)
+    if s is not None:
+        return s
+    with _lock:
+        if name not in _http_sessions:
+            options = HTTP_SESSIONS.get(name, {'pool_maxsize': 4, 'retry': Retry(total=3, backoff_factor=0.5)})
+            adapter = HTTPAdapter(
+                pool_connections=options.get('pool_connections', 1),
+                pool_maxsize=options['pool_maxsize'],
+                max_retries=options['retry']
+            )
+            s = requests.Session()
+            s.mount('http://', adapter)
+            s.mount('https://', adapter)
+            _http_sessions[name] = s
+        return _http_sessions[name]
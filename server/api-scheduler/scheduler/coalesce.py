@@ -0,0 +1,84 @@
+import copy
+import json
+
+import scheduler.sd_api as sd_api
+
+# Only txt2img renders are independent per image, img2img and scripts are sent as they are
+COALESCE_APIS = ('/sdapi/v1/txt2img',)
+
+# Fields that differ between tasks of the same batch
+BATCH_FIELDS = ('seed', 'batch_size', 'n_iter')
+
+
+def image_count(payload):
+    return int(payload.get('batch_size', 1)) * int(payload.get('n_iter', 1))
+
+
+def seed(payload):
+    return int(payload.get('seed', -1))
+
+
+def group_key(task):
+    """Key shared by tasks that can be rendered in one webui batch, None if the task can't be merged
+
+    Two tasks are compatible when their payloads are identical apart from the seed and
+    batch size. The webui API takes one prompt per call, so the prompt has to match too.
+    """
+    if task.get('api') not in COALESCE_APIS:
+        return None
+    payload = task.get('payload', {})
+    if int(payload.get('n_iter', 1)) != 1:
+        return None
+    # scripts and variation seeds don't map images back to tasks one by one
+    if payload.get('script_name') or payload.get('alwayson_scripts'):
+        return None
+    if float(payload.get('subseed_strength', 0) or 0) > 0:
+        return None
+    rest = {k: v for k, v in payload.items() if k not in BATCH_FIELDS}
+    return task['api'] + json.dumps(rest, sort_keys=True)
+
+
+def can_join(payloads, payload, max_batch_size):
+    """Whether payload can be appended to the batch built from payloads
+
+    Random seeds (-1) merge freely. The webui gives image i of a batch the seed
+    seed + i, so a fixed seed task only joins when its seed continues the batch.
+    """
+    if sum(image_count(p) for p in payloads) + image_count(payload) > max_batch_size:
+        return False
+    first = seed(payloads[0])
+    if first == -1 or seed(payload) == -1:
+        return first == -1 and seed(payload) == -1
+    return seed(payload) == first + sum(image_count(p) for p in payloads)
+
+
+def merge(payloads):
+    """Single webui payload rendering the images of all payloads"""
+    merged = copy.deepcopy(payloads[0])
+    merged['batch_size'] = sum(image_count(p) for p in payloads)
+    merged['n_iter'] = 1
+    return merged
+
+
+def split(response, payloads):
+    """Split the images of a merged webui response back into one response per payload"""
+    images = response['images']
+    texts = sd_api.infotexts(response)
+    total = sum(image_count(p) for p in payloads)
+    # the webui puts a grid image in front of batches when return_grid is enabled
+    if len(images) == total + 1:
+        sd_api.release_images(images[:1])
+        images = images[1:]
+        texts = texts[1:] if texts else None
+    if len(images) != total:
+        raise Exception(f"merged batch returned {len(images)} images, expected {total}")
+    responses = []
+    offset = 0
+    for p in payloads:
+        count = image_count(p)
+        r = {'images': images[offset:offset + count]}
+        if texts:
+            r['info'] = json.dumps({'infotexts': texts[offset:offset + count]})
+        responses.append(r)
+        offset += count
+    return responses
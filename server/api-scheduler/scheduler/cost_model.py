@@ -0,0 +1,154 @@
+import threading
+import logging
+
+import scheduler.metrics as metrics
+from scheduler.conf import schedulerConfig
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger('cost_model')
+
+# 预取缓冲区中按预测的 GPU 时间短任务优先; 一个任务最多被 max_bypass 个更短的任务超过
+shortest_first = schedulerConfig.getboolean('cost', 'shortest_first', fallback=False)
+max_bypass = schedulerConfig.getint('cost', 'max_bypass', fallback=5)
+# 按预测时间设置每条消息的可见性超时: margin 倍预测时间, 限制在 [visibility_min, visibility_max] 秒
+adaptive_visibility = schedulerConfig.getboolean('cost', 'adaptive_visibility', fallback=False)
+visibility_margin = schedulerConfig.getfloat('cost', 'visibility_margin', fallback=3)
+visibility_min = schedulerConfig.getint('cost', 'visibility_min', fallback=60)
+visibility_max = schedulerConfig.getint('cost', 'visibility_max', fallback=3600)
+# 校准前的初始模型: 每个 512x512 采样步的秒数, 每次 webui 调用的固定开销(秒)
+seconds_per_step = schedulerConfig.getfloat('cost', 'seconds_per_step', fallback=0.05)
+overhead = schedulerConfig.getfloat('cost', 'overhead', fallback=1)
+# 在线校准的平滑系数, 越大越跟随最近的任务; 每个 ControlNet 单元增加的计算量比例
+smoothing = schedulerConfig.getfloat('cost', 'smoothing', fallback=0.05)
+controlnet_weight = schedulerConfig.getfloat('cost', 'controlnet_weight', fallback=0.3)
+
+# size the step cost is expressed in
+REFERENCE_PIXELS = 512 * 512
+
+
+def _number(payload, key, default):
+    try:
+        return float(payload.get(key) or default)
+    except (TypeError, ValueError):
+        return default
+
+
+def controlnet_units(payload):
+    """Enabled ControlNet units of a payload"""
+    scripts = payload.get("alwayson_scripts") or {}
+    args = (scripts.get("controlnet") or scripts.get("ControlNet") or {}).get("args") or []
+    return sum(1 for unit in args if isinstance(unit, dict) and unit.get("enabled", True))
+
+
+def work(task, controlnet_weight=0.3):
+    """Denoising steps of a task in 512x512 equivalents
+
+    Counts every image of batch_size x n_iter, scales img2img steps by the
+    denoising strength like the webui does, adds the hires second pass at its
+    upscaled size and weighs each enabled ControlNet unit as controlnet_weight
+    of the UNet.
+    """
+    payload = task.get("payload", {})
+    images = max(_number(payload, "batch_size", 1), 1) * max(_number(payload, "n_iter", 1), 1)
+    width, height = _number(payload, "width", 512), _number(payload, "height", 512)
+    steps = _number(payload, "steps", 20)
+    denoising = _number(payload, "denoising_strength", 0.75)
+    if payload.get("init_images"):
+        steps = max(steps * denoising, 1)
+    units = steps * width * height / REFERENCE_PIXELS
+    if payload.get("enable_hr"):
+        scale = _number(payload, "hr_scale", 2)
+        hr_width = _number(payload, "hr_resize_x", 0) or width * scale
+        hr_height = _number(payload, "hr_resize_y", 0) or height * scale
+        hr_steps = _number(payload, "hr_second_pass_steps", 0) or steps
+        units += max(hr_steps * _number(payload, "denoising_strength", 0.7), 1) * hr_width * hr_height / REFERENCE_PIXELS
+    return images * units * (1 + controlnet_weight * controlnet_units(payload))
+
+
+class CostModel:
+    """Predicts the webui seconds of a task from its payload, calibrated online
+
+    The prediction is overhead + rate * work(task), fitted per api by least
+    squares over the observed webui calls with exponential forgetting, so it
+    follows a GPU or model change within a few dozen calls. A merged call is one
+    observation of the summed work of its tasks. Until calls are observed the
+    configured seconds_per_step and overhead hold; they are seeded as two
+    observations that fade out like any other.
+    """
+    def __init__(self, seconds_per_step=0.05, overhead=1, smoothing=0.05, controlnet_weight=0.3):
+        self.seconds_per_step = seconds_per_step
+        self.overhead = overhead
+        self.smoothing = smoothing
+        self.controlnet_weight = controlnet_weight
+        # api -> weighted [n, x, y, xx, xy] of the observations
+        self.sums = {}
+        # rolling relative error of the predictions, before each observation
+        self.error = None
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def api(task):
+        return task.get("api", "").rsplit("/", 1)[-1]
+
+    def _sums(self, api):
+        sums = self.sums.get(api)
+        if sums is None:
+            sums = [0.0] * 5
+            for x in (20, 200):
+                self._add(sums, x, self.overhead + self.seconds_per_step * x)
+            self.sums[api] = sums
+            metrics.cost_model.set_function(lambda: self.coefficients(api)[0], f'{api}_seconds_per_step')
+            metrics.cost_model.set_function(lambda: self.coefficients(api)[1], f'{api}_overhead')
+        return sums
+
+    @staticmethod
+    def _add(sums, x, y, weight=1.0):
+        for i, value in enumerate((1, x, y, x * x, x * y)):
+            sums[i] += weight * value
+
+    def _fit(self, sums):
+        n, sx, sy, sxx, sxy = sums
+        mx, my = sx / n, sy / n
+        variance = sxx / n - mx * mx
+        if variance > 1e-9 * mx * mx:
+            rate = (sxy / n - mx * my) / variance
+            intercept = my - rate * mx
+            if rate > 0 and intercept >= 0:
+                return rate, intercept
+        # all calls of about the same size, or a fit that makes no sense: proportional
+        return (sxy / sxx if sxx else self.seconds_per_step), 0.0
+
+    def coefficients(self, api):
+        """(seconds per step, seconds of overhead) currently fitted for api"""
+        with self.lock:
+            return self._fit(self._sums(api))
+
+    def predict(self, task):
+        """Predicted webui seconds of a task run on its own"""
+        x = work(task, self.controlnet_weight)
+        with self.lock:
+            rate, intercept = self._fit(self._sums(self.api(task)))
+        return intercept + rate * x
+
+    def record(self, tasks, seconds):
+        """One webui call rendered tasks in seconds"""
+        if not tasks or seconds <= 0:
+            return
+        x = sum(work(task, self.controlnet_weight) for task in tasks)
+        with self.lock:
+            sums = self._sums(self.api(tasks[0]))
+            rate, intercept = self._fit(sums)
+            error = abs(intercept + rate * x - seconds) / seconds
+            self.error = error if self.error is None else self.error + self.smoothing * (error - self.error)
+            for i in range(len(sums)):
+                sums[i] *= 1 - self.smoothing
+            self._add(sums, x, seconds)
+
+
+def visibility(seconds):
+    """Visibility timeout for a task predicted to take seconds on the webui"""
+    return int(min(max(seconds * visibility_margin, visibility_min), visibility_max))
@@ -0,0 +1,122 @@
+import threading
+import logging
+
+import scheduler.clients as clients
+from scheduler.warmup import get_readiness
+from scheduler.conf import schedulerConfig
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger('drain')
+
+# 排空时等待正在运行的推理完成的最长时间(秒), 之后其消息立即放回队列; Spot 中断只提前两分钟通知
+deadline = schedulerConfig.getint('drain', 'deadline', fallback=60)
+# 检查 IMDS 中 Spot 中断通知和 ASG 生命周期状态的间隔(秒), 0 表示不检查
+interval = schedulerConfig.getint('drain', 'interval', fallback=5)
+# ASG 终止生命周期钩子名称, 排空完成后通知 ASG 继续终止实例; 为空不通知
+lifecycle_hook = schedulerConfig.get('drain', 'lifecycle_hook', fallback='')
+
+
+class Drainer:
+    """Drains the pipeline once the instance is going away
+
+    A drain is requested by request(), which the signal handler calls, or by
+    the watcher thread when the health checker finds a spot interruption notice
+    or an Auto Scaling termination in the instance metadata. run() blocks until
+    then and drains the pipeline with deadline seconds for the running
+    inferences. After a lifecycle termination it completes lifecycle_hook so the
+    Auto Scaling group doesn't wait for the hook to time out.
+    """
+    def __init__(self, health_checker, deadline=60, interval=5, lifecycle_hook=''):
+        self.health_checker = health_checker
+        self.deadline = deadline
+        self.interval = interval
+        self.lifecycle_hook = lifecycle_hook
+        self.requested = threading.Event()
+        self.reason = None
+        self.pipeline = None
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.running = False
+
+    @property
+    def active(self):
+        """Whether there is a pipeline to drain"""
+        return self.pipeline is not None
+
+    def request(self, reason):
+        """Start draining, reason is the signal name, "spot" or "lifecycle"; later requests are ignored"""
+        with self.lock:
+            if self.requested.is_set():
+                return
+            self.reason = reason
+            self.requested.set()
+        logger.warning(f"Draining requested by {reason}")
+
+    def run(self, pipeline):
+        """Block until a drain is requested, then drain pipeline"""
+        self.pipeline = pipeline
+        # a signal interrupts a plain wait() only between timeouts
+        while not self.requested.wait(1):
+            pass
+        get_readiness().draining()
+        pipeline.drain(self.deadline)
+        get_readiness().drained()
+        logger.info(f"Drained after {self.reason}")
+        if self.reason == "lifecycle" and self.lifecycle_hook:
+            self._complete_lifecycle_action()
+
+    def _complete_lifecycle_action(self):
+        instance_id = self.health_checker.instance_id
+        try:
+            autoscaling = clients.client('autoscaling')
+            instances = autoscaling.describe_auto_scaling_instances(InstanceIds=[instance_id])['AutoScalingInstances']
+            autoscaling.complete_lifecycle_action(
+                LifecycleHookName=self.lifecycle_hook,
+                AutoScalingGroupName=instances[0]['AutoScalingGroupName'],
+                LifecycleActionResult='CONTINUE',
+                InstanceId=instance_id
+            )
+            logger.info(f"Completed lifecycle action {self.lifecycle_hook} of instance {instance_id}")
+        except Exception as e:
+            # the group terminates the instance once the hook times out
+            logger.error(f"Failed to complete lifecycle action {self.lifecycle_hook}: {e}")
+
+    def _loop(self):
+        while self.running and not self.requested.is_set():
+            try:
+                reason = self.health_checker.termination_notice()
+                if reason:
+                    self.request(reason)
+            except Exception as e:
+                logger.error(f"Error checking for a termination notice: {e}")
+            self.wakeup.wait(self.interval)
+
+    def start(self):
+        """Watch the instance metadata for termination notices, nothing if interval is 0"""
+        if not self.running and self.interval > 0:
+            self.running = True
+            self.thread = threading.Thread(target=self._loop)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self):
+        if self.running:
+            self.running = False
+            self.wakeup.set()
+            if self.thread:
+                self.thread.join(timeout=5)
+
+
+# Singleton instance
+drainer = None
+
+def get_drainer(health_checker):
+    global drainer
+    if drainer is None:
+        drainer = Drainer(health_checker, deadline, interval, lifecycle_hook)
+    return drainer
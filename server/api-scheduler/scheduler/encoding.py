@@ -0,0 +1,218 @@
+import io
+import os
+import struct
+import zlib
+import threading
+import multiprocessing
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image
+
+from scheduler.conf import schedulerConfig
+
+try:
+    # registers AVIF with Pillow versions that can't encode it natively
+    import pillow_avif  # noqa: F401
+except ImportError:
+    pass
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger('encoding')
+
+FORMATS = {
+    "png": ("PNG", "png", "image/png"),
+    "jpeg": ("JPEG", "jpg", "image/jpeg"),
+    "webp": ("WEBP", "webp", "image/webp"),
+    "avif": ("AVIF", "avif", "image/avif"),
+}
+
+# 输出图片格式 png/jpeg/webp/avif 和有损格式的质量, 任务可在 requestData 的 output 中覆盖
+default_format = schedulerConfig.get('output', 'format', fallback='png')
+default_quality = schedulerConfig.getint('output', 'quality', fallback=90)
+# 额外生成的缩略图最长边像素, 逗号分隔, 为空不生成
+default_thumbnails = [int(s) for s in schedulerConfig.get('output', 'thumbnails', fallback='').split(',') if s.strip()]
+thumbnail_format = schedulerConfig.get('output', 'thumbnail_format', fallback='webp')
+# 生成参数写入图片: png 的 parameters 文本, 其他格式的 EXIF UserComment
+keep_metadata = schedulerConfig.getboolean('output', 'metadata', fallback=True)
+# 编码进程数
+encode_workers = schedulerConfig.getint('output', 'encode_workers', fallback=2)
+
+# PNG chunks that start with a keyword: tEXt, zTXt and iTXt
+PNG_TEXT_CHUNKS = (b'tEXt', b'zTXt', b'iTXt')
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def supported(fmt):
+    """Whether Pillow can write fmt here"""
+    Image.init()
+    return fmt in FORMATS and FORMATS[fmt][0] in Image.SAVE
+
+
+def options(output=None):
+    """Encoding options of a task, its output overrides on top of the [output] defaults
+
+    Raises ValueError for an unknown format, a quality that isn't a number or a
+    thumbnail size that isn't positive. A known format Pillow can't write here
+    is stored as png.
+    """
+    output = output or {}
+    if not isinstance(output, dict):
+        raise ValueError("output must be an object")
+    fmt = str(output.get("format", default_format)).lower()
+    if fmt == "jpg":
+        fmt = "jpeg"
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown output format {fmt}, use one of {', '.join(FORMATS)}")
+    if not supported(fmt):
+        logger.warning(f"Output format {fmt} is not available, storing png")
+        fmt = "png"
+    thumbnails = sorted({int(size) for size in output.get("thumbnails", default_thumbnails) or []})
+    if thumbnails and thumbnails[0] <= 0:
+        raise ValueError(f"Thumbnail sizes must be positive, got {thumbnails[0]}")
+    return {
+        "format": fmt,
+        "quality": max(1, min(int(output.get("quality", default_quality)), 100)),
+        "thumbnails": thumbnails,
+        "thumbnail_format": thumbnail_format if supported(thumbnail_format) else "png",
+    }
+
+
+def pool():
+    """Process pool for encoding, created on first use"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # spawn, forking a process that runs boto3 and pool threads is not safe
+            _pool = ProcessPoolExecutor(max_workers=encode_workers, mp_context=multiprocessing.get_context('spawn'))
+        return _pool
+
+
+def png_text_chunk(key, text):
+    """PNG text chunk, iTXt if text isn't latin-1"""
+    try:
+        kind, body = b'tEXt', key.encode('latin-1') + b'\0' + text.encode('latin-1')
+    except UnicodeEncodeError:
+        kind, body = b'iTXt', key.encode('latin-1') + b'\0\0\0\0\0' + text.encode('utf-8')
+    return struct.pack('>I', len(body)) + kind + body + struct.pack('>I', zlib.crc32(kind + body))
+
+
+def png_with_text(data, key, text):
+    """PNG data with the text chunk key set to text, without decoding it"""
+    f = io.BytesIO(data)
+    _replace_png_text(f, key, text)
+    return f.getvalue()
+
+
+def append_png_text(path, key, text):
+    """Set the text chunk key of the PNG file at path to text in place, in front of its IEND"""
+    with open(path, 'r+b') as f:
+        _replace_png_text(f, key, text)
+
+
+def _png_chunks(f):
+    """(offset, size, keyword) of each chunk of the PNG file f, keyword None if it isn't a text chunk"""
+    offset = f.seek(8)
+    while True:
+        head = f.read(8)
+        if len(head) < 8:
+            return
+        length, kind = struct.unpack('>I4s', head)
+        keyword = None
+        if kind in PNG_TEXT_CHUNKS:
+            # the keyword is 1-79 latin-1 bytes followed by a null
+            keyword = f.read(min(length, 80)).split(b'\0', 1)[0]
+        yield offset, length + 12, keyword
+        offset = f.seek(offset + length + 12)
+
+
+def _replace_png_text(f, key, text):
+    """Drop the text chunks named key from the PNG file f and add one with text before IEND"""
+    name = key.encode('latin-1')
+    # IEND is always the last 12 bytes
+    iend = f.seek(-12, os.SEEK_END)
+    end = f.read(12)
+    chunks = [(offset, size, keyword) for offset, size, keyword in _png_chunks(f) if offset < iend]
+    stale = [offset for offset, size, keyword in chunks if keyword == name]
+    position = stale[0] if stale else iend
+    # shift the chunks after the first stale one down over the removed ones
+    for offset, size, keyword in chunks:
+        if offset < position or keyword == name:
+            continue
+        for start in range(0, size, 1 << 20):
+            f.seek(offset + start)
+            piece = f.read(min(1 << 20, size - start))
+            f.seek(position)
+            position += f.write(piece)
+    f.seek(position)
+    f.write(png_text_chunk(key, text) + end)
+    f.truncate()
+
+
+def _exif(infotext):
+    exif = Image.Exif()
+    # UserComment in the Exif IFD, where the webui itself stores the parameters
+    exif.get_ifd(0x8769)[0x9286] = b'UNICODE\0' + infotext.encode('utf-16-be')
+    return exif.tobytes()
+
+
+def _save(image, fmt, quality, infotext):
+    pil_format, _, _ = FORMATS[fmt]
+    buf = io.BytesIO()
+    if fmt == "png":
+        image.save(buf, format=pil_format)
+        data = buf.getvalue()
+        return png_with_text(data, "parameters", infotext) if infotext else data
+    kwargs = {"quality": quality}
+    if infotext:
+        kwargs["exif"] = _exif(infotext)
+    if fmt == "jpeg":
+        image = image.convert('RGB')
+    image.save(buf, format=pil_format, **kwargs)
+    return buf.getvalue()
+
+
+def encode(path, opts, infotext=None):
+    """Encode the PNG file at path as the output and thumbnails of opts
+
+    Runs in the encoding processes. Returns [(suffix, extension, body, content_type)],
+    the full size image first with an empty suffix, then one entry per thumbnail.
+    PNG output isn't re-encoded and left out, the caller uploads the file itself.
+    """
+    image = Image.open(path)
+    image.load()
+    renditions = []
+    fmt = opts["format"]
+    if fmt != "png":
+        body = _save(image, fmt, opts["quality"], infotext)
+        renditions.append(("", FORMATS[fmt][1], body, FORMATS[fmt][2]))
+    thumb_format = opts["thumbnail_format"]
+    for size in opts["thumbnails"]:
+        thumb = image.copy()
+        thumb.thumbnail((size, size))
+        body = _save(thumb, thumb_format, opts["quality"], None)
+        renditions.append((f"-{size}", FORMATS[thumb_format][1], body, FORMATS[thumb_format][2]))
+    return renditions
+
+
+def renditions(image, opts, infotext=None):
+    """Renditions of a spooled webui image, encode() in the process pool
+
+    PNG output is the spooled file itself, annotated in place and uploaded from
+    disk, so only re-encoded images and thumbnails are held in memory.
+    """
+    if not keep_metadata:
+        infotext = None
+    result = []
+    if opts["format"] == "png":
+        if infotext:
+            append_png_text(image.path, "parameters", infotext)
+        result.append(("", "png", image, "image/png"))
+        if not opts["thumbnails"]:
+            return result
+    return result + pool().submit(encode, image.path, opts, infotext).result()
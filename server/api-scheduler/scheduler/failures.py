@@ -0,0 +1,85 @@
+import random
+
+import requests
+from botocore.exceptions import ClientError
+
+from scheduler.conf import schedulerConfig
+
+# 瞬时错误的重试退避: 第 n 次接收失败后消息 base * 2^(n-1) 秒后再可见, 最多 max 秒
+backoff_base = schedulerConfig.getint('failures', 'backoff_base', fallback=10)
+backoff_max = schedulerConfig.getint('failures', 'backoff_max', fallback=900)
+# 消息第 max_receives 次接收仍失败时按永久错误处理, 不大于队列重驱策略的 maxReceiveCount
+max_receives = schedulerConfig.getint('failures', 'max_receives', fallback=3)
+# 永久失败的消息转发到该死信队列, 为空则直接删除
+dlq_url = schedulerConfig.get('failures', 'dlq_url', fallback='')
+
+# SQS limit for the visibility timeout of a message
+SQS_MAX_VISIBILITY = 43200
+
+# AWS error codes that a retry can not fix
+PERMANENT_CODES = ('NoSuchKey', 'NoSuchBucket', 'InvalidObjectState', 'ValidationException')
+# webui statuses worth retrying: request timeout, conflict and rate limiting
+TRANSIENT_STATUSES = (408, 409, 429)
+
+
+class TransientError(Exception):
+    """A failure another attempt may not hit: webui busy or unreachable, throttling"""
+
+
+class PermanentError(Exception):
+    """A failure every attempt will hit: malformed request, rejected payload, out of memory"""
+
+
+def webui_error(response):
+    """Exception for an error response of the webui, classified by status and detail"""
+    detail = response.text[:500]
+    try:
+        body = response.json()
+        detail = body.get("errors") or body.get("detail") or body.get("error") or detail
+    except (ValueError, AttributeError):
+        pass
+    message = f"webui returned {response.status_code}: {detail}"
+    # the same resolution runs out of memory on every GPU of the same kind; the pipeline
+    # runs the tasks of a merged call that fails like this alone before giving up on them
+    if 'out of memory' in str(detail).lower() or 'OutOfMemoryError' in response.text:
+        return PermanentError(message)
+    if response.status_code >= 500 or response.status_code in TRANSIENT_STATUSES:
+        return TransientError(message)
+    return PermanentError(message)
+
+
+def _causes(error):
+    """error and the exceptions it was raised from"""
+    while error is not None:
+        yield error
+        error = error.__cause__
+
+
+def is_permanent(error):
+    """Whether retrying the task of error can not succeed
+
+    Only what is known to fail again is permanent: a PermanentError, raised where
+    a message, its requestData or a webui 4xx response rejects the task, and
+    missing S3 objects. Everything else, a webui response cut short or not JSON
+    included, is transient and bounded by max_receives.
+    """
+    for e in _causes(error):
+        if isinstance(e, PermanentError):
+            return True
+        if isinstance(e, (TransientError, requests.ConnectionError, requests.Timeout)):
+            return False
+        if isinstance(e, ClientError):
+            return e.response.get('Error', {}).get('Code') in PERMANENT_CODES
+    return False
+
+
+def backoff(receives):
+    """Seconds before a message that failed on its receives-th delivery is retried"""
+    delay = min(backoff_base * 2 ** max(receives - 1, 0), backoff_max)
+    # jitter, so tasks failing together don't all come back at the same moment
+    return int(min(delay * random.uniform(0.5, 1.0), SQS_MAX_VISIBILITY))
+
+
+def receive_count(message):
+    """How often SQS delivered the message, this delivery included"""
+    return int(message.get('Attributes', {}).get('ApproximateReceiveCount', 1))
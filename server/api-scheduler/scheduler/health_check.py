@@ -1,12 +1,14 @@
-import boto3
 import os
 import time
 import threading
 import logging
 from datetime import datetime
 import socket
-import requests
 from scheduler.conf import schedulerConfig
+import scheduler.clients as clients
+import scheduler.metrics as metrics
+from scheduler.backends import get_backends
+from scheduler.warmup import get_readiness
 
 # Configure logging
 logging.basicConfig(
@@ -15,45 +17,94 @@ logging.basicConfig(
 )
 logger = logging.getLogger('health_check')
 
+# 健康检查间隔(秒)
+health_check_interval = schedulerConfig.getint('health', 'interval', fallback=15)
+# webui 探测超时(秒), 连续失败多少次才判定不健康
+probe_timeout = schedulerConfig.getfloat('health', 'probe_timeout', fallback=5)
+failure_threshold = schedulerConfig.getint('health', 'failure_threshold', fallback=3)
+# webui 有任务运行但进度超过这么多秒没有变化, 判定推理卡住
+stuck_seconds = schedulerConfig.getint('health', 'stuck_seconds', fallback=600)
+
+class WebuiProbe:
+    """Probe state of one webui backend, only touched by the health thread"""
+    def __init__(self, url):
+        self.url = url
+        self.failures = 0
+        self.latency = None
+        self.progress_state = None
+        self.progress_changed = time.time()
+        self.reachable = True
+        self.stuck = False
+
 class HealthCheck:
+    """Periodic instance health checks, served from an immutable snapshot
+
+    Every webui backend is probed through its progress endpoint, which answers
+    while an inference is running, and is only considered down after
+    failure_threshold probes in a row failed. A backend that is down or whose
+    inference hasn't moved for stuck_seconds is taken out of rotation; the
+    instance is unhealthy once no backend is usable. While the scheduler warms up
+    a webui that isn't up yet doesn't count against the instance. All checks run on the health
+    thread; get_status() only returns the last snapshot, so /health never waits
+    on the webui, IMDS or AWS.
+    """
     def __init__(self):
         self.region = schedulerConfig.get('aws', 'region')
-        # Get instance metadata
-        self.instance_id = self._get_instance_metadata('instance-id')
-        # Get deployment ID from instance tags
-        self.deployment_id = self._get_deployment_id()
-        self.autoscaling_client = boto3.client('autoscaling', region_name=self.region)
-        self.ec2_client = boto3.client('ec2', region_name=self.region)
-        self.health_check_interval = 60  # seconds
+        # instance metadata and tags are looked up by the health thread, the clients created there
+        self.instance_id = None
+        self.deployment_id = None
+        self.health_check_interval = health_check_interval
         self.health_check_thread = None
+        self.wakeup = threading.Event()
         self.running = False
         self.last_health_check_time = None
         self.health_status = "HEALTHY"
-        
-        logger.info(f"Health check initialized for instance {self.instance_id} in deployment {self.deployment_id}")
+        self.backends = get_backends()
+        self.probes = [WebuiProbe(backend.url) for backend in self.backends]
+        self.snapshot = self._snapshot({})
 
     def _get_instance_metadata(self, metadata_path):
-        """Get EC2 instance metadata"""
+        """Get EC2 instance metadata, None if the path doesn't exist"""
         try:
             # First get a token
             token_url = "http://169.254.169.254/latest/api/token"
             token_headers = {"X-aws-ec2-metadata-token-ttl-seconds": "21600"}
-            token_response = requests.put(token_url, headers=token_headers, timeout=2)
+            token_response = clients.http_session('imds').put(token_url, headers=token_headers, timeout=2)
             token = token_response.text
             
             # Then use the token to get metadata
             url = f"http://169.254.169.254/latest/meta-data/{metadata_path}"
             headers = {"X-aws-ec2-metadata-token": token}
-            response = requests.get(url, headers=headers, timeout=2)
+            response = clients.http_session('imds').get(url, headers=headers, timeout=2)
+            if response.status_code == 404:
+                return None
+            response.raise_for_status()
             return response.text
         except Exception as e:
             logger.error(f"Error getting instance metadata: {e}")
             return None
 
+    def termination_notice(self):
+        """Why the instance is about to go away, None if it isn't or not on EC2
+
+        "spot" once EC2 scheduled the spot instance to be interrupted, about two
+        minutes ahead, "lifecycle" once Auto Scaling is terminating the instance
+        and waits for a termination lifecycle hook.
+        """
+        if self.instance_id is None:
+            return None
+        action = self._get_instance_metadata('spot/instance-action')
+        if action:
+            logger.warning(f"Spot interruption notice: {action}")
+            return "spot"
+        if self._get_instance_metadata('autoscaling/target-lifecycle-state') == "Terminated":
+            return "lifecycle"
+        return None
+
     def _get_deployment_id(self):
         """Get deployment ID from instance tags"""
         try:
-            response = self.ec2_client.describe_tags(
+            response = clients.client('ec2').describe_tags(
                 Filters=[
                     {
                         'Name': 'resource-id',
@@ -72,15 +123,60 @@ class HealthCheck:
             logger.error(f"Error getting deployment ID: {e}")
             return None
 
-    def _check_api_health(self):
-        """Check if the API is responding correctly"""
+    def _probe_webui(self, probe):
+        """Progress of the webui, None if it didn't answer"""
+        start = time.perf_counter()
         try:
-            # Check local API health endpoint
-            response = requests.get("http://localhost:8080/health", timeout=5)
-            return response.status_code == 200
+            response = clients.http_session('probe').get(
+                f"{probe.url}/sdapi/v1/progress",
+                params={"skip_current_image": "true"},
+                timeout=(2, probe_timeout)
+            )
+            response.raise_for_status()
+            state = response.json()
         except Exception as e:
-            logger.error(f"API health check failed: {e}")
-            return False
+            logger.warning(f"Webui probe of {probe.url} failed: {e}")
+            return None
+        finally:
+            probe.latency = time.perf_counter() - start
+        return state
+
+    def _check_backend_health(self, probe):
+        """Check if one webui answers and isn't stuck, return (reachable, stuck)"""
+        state = self._probe_webui(probe)
+        if state is None:
+            probe.failures += 1
+            return probe.failures < failure_threshold, False
+        probe.failures = 0
+        job = state.get("state") or {}
+        running = (job.get("job_count") or 0) > 0 or (state.get("progress") or 0) > 0
+        current = (state.get("progress"), job.get("job_no"), job.get("sampling_step"), job.get("job_timestamp"))
+        now = time.time()
+        if not running or current != probe.progress_state:
+            probe.progress_state = current
+            probe.progress_changed = now
+            return True, False
+        stuck = now - probe.progress_changed > stuck_seconds
+        if stuck:
+            logger.error(f"Webui {probe.url} inference made no progress for {now - probe.progress_changed:.0f}s")
+        return True, stuck
+
+    def _check_webui_health(self):
+        """Probe every webui backend, return (any reachable, none usable although reachable)
+
+        Backends that are down or stuck are taken out of rotation until a probe
+        answers and finds them working again. Only a backend that passed its
+        warm-up is put back, a failed probe never does.
+        """
+        for probe in self.probes:
+            probe.reachable, probe.stuck = self._check_backend_health(probe)
+            if not probe.reachable or probe.stuck:
+                self.backends.set_healthy(probe.url, False)
+            elif probe.failures == 0:
+                self.backends.set_healthy(probe.url, True)
+        reachable = any(p.reachable for p in self.probes)
+        usable = any(p.reachable and not p.stuck for p in self.probes)
+        return reachable, reachable and not usable
 
     def _check_gpu_health(self):
         """Check if GPU is available and functioning"""
@@ -138,10 +234,13 @@ class HealthCheck:
                 logger.info(f"Instance {self.instance_id} is healthy")
             else:
                 self.health_status = "UNHEALTHY"
+                if self.instance_id is None:
+                    logger.warning("Instance is unhealthy, not running on EC2 so nothing is reported")
+                    return
                 logger.warning(f"Instance {self.instance_id} is unhealthy, reporting to AutoScaling")
                 
                 # Report unhealthy status to AutoScaling
-                self.autoscaling_client.set_instance_health(
+                clients.client('autoscaling').set_instance_health(
                     InstanceId=self.instance_id,
                     HealthStatus='Unhealthy',
                     ShouldRespectGracePeriod=True
@@ -153,7 +252,7 @@ class HealthCheck:
         """Perform a comprehensive health check"""
         try:
             # Perform various health checks
-            api_healthy = self._check_api_health()
+            api_healthy, stuck = self._check_webui_health()
             
             # These checks might fail in some environments, so we make them optional
             try:
@@ -171,18 +270,30 @@ class HealthCheck:
             except:
                 memory_healthy = True  # Skip if not applicable
             
+            # the webui is still loading while the scheduler warms up
+            warming = get_readiness().state in ("starting", "warming")
+
             # Instance is healthy only if all checks pass
-            is_healthy = api_healthy and gpu_healthy and disk_healthy and memory_healthy
+            is_healthy = (api_healthy or warming) and not stuck and gpu_healthy and disk_healthy and memory_healthy
             
             # Update instance health status
             self._update_instance_health(is_healthy)
             
             # Update last health check time
             self.last_health_check_time = datetime.now()
+
+            # Publish the results in one assignment, readers never see a partial update
+            self.snapshot = self._snapshot({
+                "webui": api_healthy,
+                "stuck": stuck,
+                "gpu": gpu_healthy,
+                "disk": disk_healthy,
+                "memory": memory_healthy,
+            })
             
             # Log health check results
-            logger.info(f"Health check results: API: {api_healthy}, GPU: {gpu_healthy}, "
-                       f"Disk: {disk_healthy}, Memory: {memory_healthy}")
+            logger.info(f"Health check results: Webui: {api_healthy} ({self._webui_latency() * 1000:.0f} ms), "
+                       f"Stuck: {stuck}, GPU: {gpu_healthy}, Disk: {disk_healthy}, Memory: {memory_healthy}")
             
             return is_healthy
         except Exception as e:
@@ -191,6 +302,12 @@ class HealthCheck:
 
     def _health_check_loop(self):
         """Background thread for periodic health checks"""
+        if self.instance_id is None:
+            # Get instance metadata and the deployment ID from instance tags
+            self.instance_id = self._get_instance_metadata('instance-id')
+            if self.instance_id:
+                self.deployment_id = self._get_deployment_id()
+            logger.info(f"Health check initialized for instance {self.instance_id} in deployment {self.deployment_id}")
         while self.running:
             try:
                 self.perform_health_check()
@@ -198,12 +315,15 @@ class HealthCheck:
                 logger.error(f"Error in health check loop: {e}")
             
             # Sleep for the specified interval
-            time.sleep(self.health_check_interval)
+            self.wakeup.wait(self.health_check_interval)
 
     def start(self):
         """Start the health check background thread"""
         if not self.running:
             self.running = True
+            metrics.webui.set_function(self._webui_latency, 'probe_seconds')
+            metrics.webui.set_function(lambda: self.snapshot["checks"].get("webui", True), 'up')
+            metrics.webui.set_function(lambda: self.snapshot["checks"].get("stuck", False), 'stuck')
             self.health_check_thread = threading.Thread(target=self._health_check_loop)
             self.health_check_thread.daemon = True
             self.health_check_thread.start()
@@ -213,19 +333,36 @@ class HealthCheck:
         """Stop the health check background thread"""
         if self.running:
             self.running = False
+            self.wakeup.set()
             if self.health_check_thread:
                 self.health_check_thread.join(timeout=5)
             logger.info("Health check service stopped")
 
-    def get_status(self):
-        """Get current health status"""
+    def _webui_latency(self):
+        """Slowest probe of the last check"""
+        return max((p.latency for p in self.probes if p.latency is not None), default=0.0)
+
+    def _snapshot(self, checks):
         return {
             "status": self.health_status,
             "instance_id": self.instance_id,
             "deployment_id": self.deployment_id,
-            "last_check": self.last_health_check_time.isoformat() if self.last_health_check_time else None
+            "last_check": self.last_health_check_time.isoformat() if self.last_health_check_time else None,
+            "ready": get_readiness().state,
+            "checks": checks,
+            "webui": [dict(
+                backend.status(),
+                latency_ms=round(probe.latency * 1000, 1) if probe.latency is not None else None,
+                probe_failures=probe.failures,
+                stuck=probe.stuck,
+                progress_changed=datetime.fromtimestamp(probe.progress_changed).isoformat(),
+            ) for backend, probe in zip(self.backends, self.probes)],
         }
 
+    def get_status(self):
+        """Get current health status, the snapshot of the last check"""
+        return self.snapshot
+
 
 # Singleton instance
 health_checker = None
@@ -0,0 +1,131 @@
+import threading
+import time
+import logging
+
+import scheduler.sd_dynamodb as sd_dynamodb
+import scheduler.metrics as metrics
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger('heartbeat')
+
+# SQS limit for change_message_visibility_batch
+SQS_MAX_BATCH = 10
+
+
+class VisibilityHeartbeat:
+    """Keeps received messages invisible while they wait in the buffer or run on the webui
+
+    Every tracked job whose visibility runs out within half a timeout is extended by
+    another visibility_timeout seconds, and the DynamoDB lease of claimed tasks is
+    renewed along with it. A long hires job therefore never reappears on the queue
+    while it is still rendering, but a crashed worker's messages come back within
+    one timeout.
+
+    A job with its own visibility_timeout, e.g. from its predicted duration, is
+    extended by that instead; retime() applies a new one on the next beat. Pass an
+    interval below a fifth of the shortest timeout used.
+    """
+    def __init__(self, sqs_client, owner, visibility_timeout=300, interval=None):
+        self.sqs_client = sqs_client
+        self.owner = owner
+        self.visibility_timeout = visibility_timeout
+        self.interval = interval or max(visibility_timeout / 5, 1)
+        self.jobs = {}
+        # ids of jobs whose timeout changed since the last beat
+        self.retimed = set()
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.running = False
+
+    def track(self, job):
+        job.visible_at = time.time() + self.visibility_timeout
+        with self.lock:
+            self.jobs[id(job)] = job
+
+    def untrack(self, job):
+        with self.lock:
+            self.jobs.pop(id(job), None)
+            self.retimed.discard(id(job))
+
+    def timeout(self, job):
+        """Seconds the visibility of job is extended by"""
+        return job.visibility_timeout or self.visibility_timeout
+
+    def retime(self, job, timeout):
+        """Extend the visibility of a tracked job by timeout from now on, starting right away"""
+        job.visibility_timeout = timeout
+        with self.lock:
+            if id(job) in self.jobs:
+                self.retimed.add(id(job))
+        self.wakeup.set()
+
+    def beat(self):
+        """Extend the visibility of every job that is close to reappearing"""
+        now = time.time()
+        with self.lock:
+            due = [job for key, job in self.jobs.items()
+                   if key in self.retimed or job.visible_at - now < self.timeout(job) / 2]
+            self.retimed.clear()
+        by_queue = {}
+        for job in due:
+            by_queue.setdefault(job.queue_url, []).append(job)
+        for queue_url, jobs in by_queue.items():
+            for start in range(0, len(jobs), SQS_MAX_BATCH):
+                self._extend(queue_url, jobs[start:start + SQS_MAX_BATCH])
+        for job in due:
+            if not job.claimed:
+                continue
+            # one failed renewal must not keep the other leases from being renewed
+            try:
+                if not sd_dynamodb.renewLease(job.taskId, self.owner, self.timeout(job)):
+                    logger.warning(f"Lost the lease of task {job.taskId}")
+            except Exception as e:
+                metrics.errors_total.labels('renew_lease').inc()
+                logger.error(f"Failed to renew the lease of task {job.taskId}: {e}")
+
+    def _extend(self, queue_url, jobs):
+        entries = [
+            {'Id': str(i), 'ReceiptHandle': job.receipt_handle, 'VisibilityTimeout': self.timeout(job)}
+            for i, job in enumerate(jobs)
+        ]
+        try:
+            response = self.sqs_client.change_message_visibility_batch(QueueUrl=queue_url, Entries=entries)
+            now = time.time()
+            failed = set()
+            for entry in response.get('Failed', []):
+                failed.add(int(entry['Id']))
+                logger.error(f"Failed to extend visibility of task {jobs[int(entry['Id'])].taskId}: {entry.get('Message')}")
+            for i, job in enumerate(jobs):
+                if i not in failed:
+                    job.visible_at = now + self.timeout(job)
+        except Exception as e:
+            logger.error(f"change_message_visibility_batch error: {e}")
+
+    def _loop(self):
+        while self.running:
+            try:
+                self.beat()
+            except Exception as e:
+                logger.error(f"Error in heartbeat loop: {e}")
+            self.wakeup.wait(self.interval)
+            if self.running:
+                self.wakeup.clear()
+
+    def start(self):
+        if not self.running:
+            self.running = True
+            self.thread = threading.Thread(target=self._loop)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self):
+        if self.running:
+            self.running = False
+            self.wakeup.set()
+            if self.thread:
+                self.thread.join(timeout=self.interval + 1)
@@ -0,0 +1,190 @@
+import base64
+import os
+import re
+import threading
+import time
+import logging
+from collections import OrderedDict
+
+import scheduler.sd_s3 as sd_s3
+import scheduler.metrics as metrics
+from scheduler.conf import schedulerConfig
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger('inputs')
+
+# 输入图片(init_images, ControlNet 等)可以是 s3://bucket/key 或 cloudfront 地址, 推理前下载
+# 下载的图片按 ETag 缓存在本地磁盘, 超过 cache_size_mb 时淘汰最久未使用的
+cache_dir = schedulerConfig.get('inputs', 'cache_dir', fallback='/tmp/sd-inputs')
+cache_size_mb = schedulerConfig.getint('inputs', 'cache_size_mb', fallback=2048)
+# 在这段时间内(秒)直接使用本地缓存, 不再向 S3 确认 ETag
+revalidate = schedulerConfig.getint('inputs', 'revalidate', fallback=60)
+
+# Payload fields holding input images at any depth: init_images and mask of img2img, and
+# input_image, image, mask and mask_image of ControlNet units. Other strings are never fetched.
+IMAGE_FIELDS = ('init_images', 'mask', 'input_image', 'image', 'mask_image')
+
+
+def parse_ref(value):
+    """(bucket, key) of an s3:// or CloudFront reference, None for anything else"""
+    if value.startswith('s3://'):
+        bucket, _, key = value[5:].partition('/')
+        return (bucket, key) if bucket and key else None
+    if sd_s3.cloudfront and value.startswith(sd_s3.cloudfront):
+        key = value[len(sd_s3.cloudfront):]
+        return (sd_s3.bucket_name, key) if key else None
+    return None
+
+
+class InputCache:
+    """Bounded on-disk LRU of input images fetched from S3, keyed by ETag
+
+    The same reference and pose images are used by many tasks, so every object is
+    downloaded once and kept under cache_dir as long as it is used. A reference is
+    revalidated with a conditional GET at most every revalidate seconds, which only
+    transfers the object again when it was overwritten.
+    """
+    def __init__(self, cache_dir, max_bytes, revalidate=60):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.revalidate = revalidate
+        self.files = OrderedDict()
+        self.size = 0
+        self.etags = {}
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+        os.makedirs(cache_dir, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        """Index the files left by a previous run, least recently used first"""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name.endswith('.tmp'):
+                os.remove(path)
+                continue
+            st = os.stat(path)
+            entries.append((st.st_mtime, name, st.st_size))
+        for _, name, size in sorted(entries):
+            self.files[name] = size
+            self.size += size
+        self._evict()
+
+    def _name(self, etag):
+        return re.sub(r'[^0-9A-Za-z-]', '', etag)
+
+    def _evict(self):
+        while self.size > self.max_bytes and len(self.files) > 1:
+            name, size = self.files.popitem(last=False)
+            self.size -= size
+            self.stats["evictions"] += 1
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except FileNotFoundError:
+                pass
+
+    def _read(self, name):
+        """Cached data of name, None if it isn't cached"""
+        with self.lock:
+            if name not in self.files:
+                return None
+            self.files.move_to_end(name)
+        path = os.path.join(self.cache_dir, name)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)
+            return data
+        except FileNotFoundError:
+            with self.lock:
+                self.size -= self.files.pop(name, 0)
+            return None
+
+    def _write(self, name, data):
+        path = os.path.join(self.cache_dir, name)
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+        with self.lock:
+            if name not in self.files:
+                self.files[name] = len(data)
+                self.size += len(data)
+            self.files.move_to_end(name)
+            self._evict()
+
+    def fetch(self, bucket, key):
+        """Content of s3://bucket/key, from the disk cache when it is still current"""
+        with self.lock:
+            known = self.etags.get((bucket, key))
+        etag = None
+        if known is not None:
+            if time.time() - known[1] < self.revalidate:
+                data = self._read(self._name(known[0]))
+                if data is not None:
+                    self.stats["hits"] += 1
+                    return data
+            with self.lock:
+                # only ask for a 304 when the cached copy is still there
+                if self._name(known[0]) in self.files:
+                    etag = known[0]
+        with metrics.stage('input_fetch'):
+            data, etag = sd_s3.get_object_if_changed(bucket, key, etag)
+        with self.lock:
+            self.etags[(bucket, key)] = (etag, time.time())
+        if data is None:
+            data = self._read(self._name(etag))
+            if data is not None:
+                self.stats["hits"] += 1
+                return data
+            # evicted between the check and the read
+            data, etag = sd_s3.get_object_if_changed(bucket, key)
+            with self.lock:
+                self.etags[(bucket, key)] = (etag, time.time())
+        self.stats["misses"] += 1
+        logger.info(f"Fetched input s3://{bucket}/{key} ({len(data)} bytes)")
+        self._write(self._name(etag), data)
+        return data
+
+    def resolve(self, task):
+        """Replace the S3 references in a task's payload with base64 images, return how many"""
+        return self._resolve(task.get("payload", {}))
+
+    def _resolve(self, node, image=False):
+        """image is set when node is the value of one of the IMAGE_FIELDS"""
+        count = 0
+        items = node.items() if isinstance(node, dict) else enumerate(node)
+        for k, value in list(items):
+            is_image = image or k in IMAGE_FIELDS
+            if isinstance(value, str):
+                if not is_image:
+                    continue
+                ref = parse_ref(value)
+                if ref is None:
+                    continue
+                try:
+                    node[k] = base64.b64encode(self.fetch(*ref)).decode()
+                except Exception as e:
+                    raise Exception(f"failed to fetch input image {value}: {e}") from e
+                count += 1
+            elif isinstance(value, (dict, list)):
+                count += self._resolve(value, is_image)
+        return count
+
+
+# Singleton instance
+input_cache = None
+_lock = threading.Lock()
+
+def get_input_cache():
+    """Get the input image cache"""
+    global input_cache
+    with _lock:
+        if input_cache is None:
+            input_cache = InputCache(cache_dir, cache_size_mb * 1024 * 1024, revalidate)
+        return input_cache
@@ -0,0 +1,219 @@
+import threading
+import time
+
+# Prometheus 指标, 无第三方依赖
+# 计数器和直方图按线程分片: 热路径上每个线程只改自己的分片, 不加锁; 抓取时再汇总所有分片
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+_registry = []
+_registry_lock = threading.Lock()
+
+
+class _Sharded:
+    """Per-thread shards of a metric value, created once per thread"""
+    def __init__(self):
+        self._local = threading.local()
+        self._shards = []
+        self._lock = threading.Lock()
+
+    def _shard(self):
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = self._new_shard()
+            self._local.shard = shard
+            with self._lock:
+                self._shards.append(shard)
+        return shard
+
+    def _all_shards(self):
+        with self._lock:
+            return list(self._shards)
+
+
+class _CounterValue(_Sharded):
+    def _new_shard(self):
+        return [0.0]
+
+    def inc(self, amount=1):
+        self._shard()[0] += amount
+
+    def value(self):
+        return sum(shard[0] for shard in self._all_shards())
+
+
+class _HistogramValue(_Sharded):
+    def __init__(self, buckets):
+        super().__init__()
+        self.buckets = buckets
+
+    def _new_shard(self):
+        # bucket counts, then sum and count
+        return [0] * len(self.buckets) + [0.0, 0]
+
+    def observe(self, value):
+        shard = self._shard()
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                shard[i] += 1
+                break
+        shard[-2] += value
+        shard[-1] += 1
+
+    def time(self):
+        return _Timer(self)
+
+    def value(self):
+        total = [0] * len(self.buckets) + [0.0, 0]
+        for shard in self._all_shards():
+            for i, v in enumerate(shard):
+                total[i] += v
+        return total
+
+
+class _Timer:
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start)
+        return False
+
+
+class _Family:
+    """A metric with an optional label, one child value per label value"""
+    def __init__(self, name, help, kind, label=None):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.label = label
+        self.children = {}
+        self.lock = threading.Lock()
+        with _registry_lock:
+            _registry.append(self)
+
+    def labels(self, value):
+        child = self.children.get(value)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(value, self._new_child())
+        return child
+
+    def _label(self, value, extra=''):
+        parts = []
+        if self.label is not None:
+            parts.append(f'{self.label}="{value}"')
+        if extra:
+            parts.append(extra)
+        return '{' + ','.join(parts) + '}' if parts else ''
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        with self.lock:
+            children = list(self.children.items())
+        for value, child in children:
+            lines.extend(self._render_child(value, child))
+        return lines
+
+
+class Counter(_Family):
+    def __init__(self, name, help, label=None):
+        super().__init__(name, help, 'counter', label)
+
+    def _new_child(self):
+        return _CounterValue()
+
+    def inc(self, amount=1):
+        self.labels(None).inc(amount)
+
+    def _render_child(self, value, child):
+        return [f'{self.name}{self._label(value)} {child.value()}']
+
+
+class Histogram(_Family):
+    def __init__(self, name, help, label=None, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        super().__init__(name, help, 'histogram', label)
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, amount):
+        self.labels(None).observe(amount)
+
+    def time(self):
+        return self.labels(None).time()
+
+    def _render_child(self, value, child):
+        total = child.value()
+        lines = []
+        cumulative = 0
+        for i, bound in enumerate(self.buckets):
+            cumulative += total[i]
+            le = 'le="%s"' % bound
+            lines.append(f'{self.name}_bucket{self._label(value, le)} {cumulative}')
+        le = 'le="+Inf"'
+        lines.append(f'{self.name}_bucket{self._label(value, le)} {total[-1]}')
+        lines.append(f'{self.name}_sum{self._label(value)} {total[-2]}')
+        lines.append(f'{self.name}_count{self._label(value)} {total[-1]}')
+        return lines
+
+
+class Gauge(_Family):
+    """Gauge read from callbacks when scraped, one callback per label value"""
+    def __init__(self, name, help, label=None):
+        super().__init__(name, help, 'gauge', label)
+
+    def set_function(self, fn, value=None):
+        with self.lock:
+            self.children[value] = fn
+
+    def _render_child(self, value, fn):
+        try:
+            return [f'{self.name}{self._label(value)} {float(fn())}']
+        except Exception:
+            return []
+
+
+def render():
+    """All registered metrics in the Prometheus text format"""
+    with _registry_lock:
+        families = list(_registry)
+    lines = []
+    for family in families:
+        lines.extend(family.render())
+    return '\n'.join(lines) + '\n'
+
+
+# Scheduler metrics
+stage_seconds = Histogram(
+    'sd_scheduler_stage_seconds',
+    'Time spent in each pipeline stage',
+    label='stage'
+)
+tasks_total = Counter('sd_scheduler_tasks_total', 'Tasks handled by result', label='result')
+images_total = Counter('sd_scheduler_images_total', 'Images generated and uploaded')
+errors_total = Counter('sd_scheduler_errors_total', 'Errors by pipeline stage', label='stage')
+retries_total = Counter('sd_scheduler_retries_total', 'AWS API retries by service', label='service')
+in_flight = Gauge('sd_scheduler_in_flight', 'Work in progress by pipeline stage', label='stage')
+queue_backlog = Gauge('sd_scheduler_queue_backlog', 'Approximate visible messages by queue', label='queue')
+model_swaps = Gauge('sd_scheduler_model_swaps', 'Checkpoint swaps since start', label='measure')
+result_cache = Gauge('sd_scheduler_result_cache', 'Result cache lookups and evictions since start', label='event')
+scaling = Gauge('sd_scheduler_scaling', 'Backlog scaling signal published by this instance', label='measure')
+throughput = Gauge('sd_scheduler_images_per_second', 'Rolling webui throughput by task class', label='class')
+webui = Gauge('sd_scheduler_webui', 'Webui liveness probe of the health check', label='measure')
+backend_outstanding = Gauge('sd_scheduler_backend_outstanding', 'Webui calls in flight by backend', label='backend')
+backend_up = Gauge('sd_scheduler_backend_up', 'Whether a webui backend is in rotation', label='backend')
+time_to_ready = Gauge('sd_scheduler_time_to_ready_seconds', 'Seconds from process start until the queue was polled')
+spool_bytes = Gauge('sd_scheduler_spool_bytes', 'Bytes of rendered images waiting in the output spool')
+input_cache = Gauge('sd_scheduler_input_cache', 'Input image cache lookups and evictions since start', label='event')
+cost_model = Gauge('sd_scheduler_cost_model', 'Fitted task cost model coefficients and rolling prediction error', label='measure')
+
+
+def stage(name):
+    """Context manager timing one pipeline stage"""
+    return stage_seconds.labels(name).time()
@@ -0,0 +1,148 @@
+import threading
+import time
+import logging
+from collections import deque
+from contextlib import contextmanager
+
+import scheduler.sd_api as sd_api
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger('model_affinity')
+
+
+def requested_model(task):
+    """(checkpoint, vae) a task overrides, None for the parts it leaves to the default"""
+    override = task.get("payload", {}).get("override_settings") or {}
+    return (override.get("sd_model_checkpoint"), override.get("sd_vae"))
+
+
+class ModelTracker:
+    """Tracks the checkpoint and VAE loaded in each webui and orders work around it
+
+    Swapping weights takes 10-40 s, so the prefetch buffer prefers tasks that render
+    with a model some backend has loaded, and the router sends them to that
+    backend. Swaps are done explicitly through the options endpoint before the
+    inference, which keeps the webui from restoring the previous model after an
+    override and lets us time every swap. Tasks without an override render with
+    the model the first backend had loaded at startup.
+
+    A backend can run several calls at once, so use() keeps the model loaded for
+    the whole call: calls with the loaded model run side by side, and a call that
+    needs another model waits until they are done before it swaps.
+    """
+    def __init__(self, default_url=None):
+        self.default_url = default_url
+        self.default = None
+        # webui url -> loaded (checkpoint, vae)
+        self.loaded = {}
+        self.lock = threading.Lock()
+        # webui url -> condition guarding its swaps, the calls running on its loaded model,
+        # whether a swap is in progress and the calls waiting in arrival order
+        self.conditions = {}
+        self.users = {}
+        self.swapping = {}
+        self.waiting = {}
+        self.stats = {"swaps": 0, "swap_seconds": 0.0}
+
+    def _load_state(self, url):
+        """Loaded model of the webui at url, read from its options the first time"""
+        with self.lock:
+            if url in self.loaded:
+                return self.loaded[url]
+        options = sd_api.get_options(url)
+        model = (options.get("sd_model_checkpoint"), options.get("sd_vae"))
+        with self.lock:
+            self.loaded.setdefault(url, model)
+            logger.info(f"Webui {url or sd_api.webui_api_url} has model {self.loaded[url]} loaded")
+            return self.loaded[url]
+
+    def model_of(self, task):
+        """Full (checkpoint, vae) a task renders with"""
+        if self.default is None:
+            self.default = self._load_state(self.default_url)
+        checkpoint, vae = requested_model(task)
+        return (checkpoint or self.default[0], vae or self.default[1])
+
+    def loaded_on(self, url):
+        """Model loaded in the webui at url, None if not known yet"""
+        with self.lock:
+            return self.loaded.get(url)
+
+    def matches(self, job):
+        """Whether job renders with a model one of the webuis has loaded"""
+        with self.lock:
+            return job.model in self.loaded.values()
+
+    @contextmanager
+    def use(self, model, url=None):
+        """Context manager running the enclosed call with model loaded in the webui at url
+
+        Swaps the model in if needed and keeps other calls from swapping it out
+        until the call is done. Calls are let in in arrival order, so a call that
+        needs another model isn't overtaken by later calls on the loaded one, and
+        the swap runs outside the lock while the calls behind it wait.
+        """
+        if model is None:
+            yield
+            return
+        with self.lock:
+            cond = self.conditions.setdefault(url, threading.Condition())
+        # reads the options the first time, before taking the lock
+        self._load_state(url)
+        ticket = object()
+        with cond:
+            waiting = self.waiting.setdefault(url, deque())
+            waiting.append(ticket)
+            while True:
+                if waiting[0] is ticket and not self.swapping.get(url):
+                    loaded = self.loaded_on(url)
+                    if model == loaded:
+                        swap = False
+                        break
+                    if not self.users.get(url):
+                        swap = True
+                        break
+                cond.wait()
+            waiting.popleft()
+            if swap:
+                self.swapping[url] = True
+            else:
+                self.users[url] = self.users.get(url, 0) + 1
+            cond.notify_all()
+        if swap:
+            try:
+                self._swap(model, loaded, url)
+            finally:
+                with cond:
+                    self.swapping[url] = False
+                    if self.loaded_on(url) == model:
+                        self.users[url] = self.users.get(url, 0) + 1
+                    cond.notify_all()
+        try:
+            yield
+        finally:
+            with cond:
+                self.users[url] -= 1
+                cond.notify_all()
+
+    def _swap(self, model, loaded, url):
+        """Load model in the webui at url, called with no call running on it"""
+        start = time.time()
+        try:
+            sd_api.set_options({"sd_model_checkpoint": model[0], "sd_vae": model[1]}, url)
+        except Exception:
+            # the webui may have loaded part of it, read the options again next time
+            with self.lock:
+                self.loaded.pop(url, None)
+            raise
+        elapsed = time.time() - start
+        with self.lock:
+            self.loaded[url] = model
+            self.stats["swaps"] += 1
+            self.stats["swap_seconds"] += elapsed
+            logger.info(f"Swapped model {loaded} -> {model} on {url or sd_api.webui_api_url} in {elapsed:.1f}s "
+                        f"({self.stats['swaps']} swaps, {self.stats['swap_seconds']:.1f}s total)")
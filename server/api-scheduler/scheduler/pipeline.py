@@ -0,0 +1,928 @@
+import os
+import queue
+import socket
+import threading
+import time
+import logging
+from contextlib import nullcontext
+
+import scheduler.sd_api as sd_api
+import scheduler.sd_task_detail as sd_task_detail
+import scheduler.sd_dynamodb as sd_dynamodb
+import scheduler.coalesce as coalesce
+import scheduler.failures as failures
+import scheduler.metrics as metrics
+from scheduler.heartbeat import VisibilityHeartbeat
+from scheduler.status_writer import StatusWriter
+from scheduler.result_cache import get_result_cache
+from scheduler.inputs import get_input_cache
+import scheduler.spool as spool
+import scheduler.profiling as profiling
+from scheduler.model_affinity import ModelTracker
+from scheduler.queues import sent_time
+from scheduler.progress import ProgressReporter
+from scheduler.health_check import get_health_checker
+from scheduler.backends import get_backends
+import scheduler.scaling as scaling
+import scheduler.cost_model as cost_model
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger('pipeline')
+
+# SQS limit for both receive_message and delete_message_batch
+SQS_MAX_BATCH = 10
+
+
+class Job:
+    """A received SQS message moving through the pipeline stages"""
+    def __init__(self, message, queue_url, priority=0):
+        self.message = message
+        self.queue_url = queue_url
+        self.priority = priority
+        self.receipt_handle = message['ReceiptHandle']
+        self.body = message['Body']
+        self.received_at = time.time()
+        self.sent_at = sent_time(message, self.received_at)
+        self.taskId = None
+        self.requestData = None
+        self.task = None
+        self.group_key = None
+        self.cache_key = None
+        self.model = None
+        self.response = None
+        self.visible_at = None
+        # seconds the heartbeat extends the visibility by, its default if None
+        self.visibility_timeout = None
+        self.claimed = False
+        # owner of the task row when a previous run claimed it, see _resume
+        self.owner = None
+        # predicted webui seconds, and how often a shorter job was run first
+        self.cost = 0.0
+        self.bypassed = 0
+        # set when a drain gave the message back while the job was still rendering
+        self.returned = False
+        # seconds spent in each stage, stored with the task status
+        self.timings = {'queueAge': self.received_at - self.sent_at}
+        # backend, batch and sizes, stored in processRes with the timings
+        self.trace = {}
+        # set if the profiler sampled the task
+        self.profile = None
+
+
+class PrefetchBuffer:
+    """Bounded buffer of resolved jobs waiting for a free inference slot
+
+    select(jobs) picks the index of the job to run next, FIFO if not given.
+    """
+    def __init__(self, capacity, select=None):
+        self.capacity = capacity
+        self.select = select
+        self.items = []
+        self.cond = threading.Condition()
+
+    def __len__(self):
+        with self.cond:
+            return len(self.items)
+
+    def wait_for_space(self, timeout):
+        """Block until at least one slot is free, return the number of free slots"""
+        with self.cond:
+            self.cond.wait_for(lambda: len(self.items) < self.capacity, timeout=timeout)
+            return max(self.capacity - len(self.items), 0)
+
+    def put(self, job):
+        with self.cond:
+            self.items.append(job)
+            self.cond.notify_all()
+
+    def take(self, timeout=1):
+        """Remove and return the next job to run, or None on timeout"""
+        with self.cond:
+            if not self.cond.wait_for(lambda: len(self.items) > 0, timeout=timeout):
+                return None
+            job = self.items.pop(self._select())
+            self.cond.notify_all()
+            return job
+
+    def jobs(self):
+        """The buffered jobs, a copy"""
+        with self.cond:
+            return list(self.items)
+
+    def take_matching(self, match):
+        """Remove and return the first buffered job accepted by match, or None"""
+        with self.cond:
+            for index, job in enumerate(self.items):
+                if match(job):
+                    self.items.pop(index)
+                    self.cond.notify_all()
+                    return job
+            return None
+
+    def _select(self):
+        """Index of the job to run next, FIFO by default"""
+        if self.select is None:
+            return 0
+        try:
+            return self.select(self.items)
+        except Exception as e:
+            logger.error(f"Job selection failed, falling back to FIFO: {e}")
+            return 0
+
+    def drain(self):
+        """Remove and return every buffered job"""
+        with self.cond:
+            items = self.items
+            self.items = []
+            self.cond.notify_all()
+            return items
+
+
+class BatchDeleter:
+    """Collects finished messages and removes them with delete_message_batch"""
+    def __init__(self, sqs_client, flush_interval=1.0):
+        self.sqs_client = sqs_client
+        self.flush_interval = flush_interval
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.thread = None
+        self.running = False
+
+    def add(self, job):
+        with self.lock:
+            self.pending.setdefault(job.queue_url, []).append(job)
+            full = len(self.pending[job.queue_url]) >= SQS_MAX_BATCH
+        if full:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            pending = self.pending
+            self.pending = {}
+        for queue_url, jobs in pending.items():
+            for start in range(0, len(jobs), SQS_MAX_BATCH):
+                self._delete_batch(queue_url, jobs[start:start + SQS_MAX_BATCH])
+
+    def _delete_batch(self, queue_url, jobs):
+        entries = [
+            {'Id': str(i), 'ReceiptHandle': job.receipt_handle}
+            for i, job in enumerate(jobs)
+        ]
+        try:
+            with metrics.stage('delete'):
+                response = self.sqs_client.delete_message_batch(QueueUrl=queue_url, Entries=entries)
+            for failed in response.get('Failed', []):
+                job = jobs[int(failed['Id'])]
+                metrics.errors_total.labels('delete').inc()
+                logger.error(f"Failed to delete message for task {job.taskId}: {failed.get('Message')}")
+        except Exception as e:
+            metrics.errors_total.labels('delete').inc()
+            logger.error(f"delete_message_batch error: {e}")
+
+    def _loop(self):
+        while self.running:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def start(self):
+        if not self.running:
+            self.running = True
+            self.thread = threading.Thread(target=self._loop)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self):
+        if self.running:
+            self.running = False
+            if self.thread:
+                self.thread.join(timeout=self.flush_interval + 1)
+        self.flush()
+
+
+class Pipeline:
+    """Staged worker: prefetch -> inference -> upload/finish -> batched delete
+
+    The poller keeps the prefetch buffer filled with messages whose task details
+    are already resolved, so the inference workers never wait on SQS or DynamoDB.
+    The post workers encode the images into the output spool while the next
+    inference is already running on the webui; the spool uploads them in the
+    background with retries, and only then the task is finished and the message
+    deleted. Tasks spooled before a restart are finished once their images are up.
+    Compatible txt2img tasks waiting in the buffer are rendered in one webui batch
+    of up to max_batch_size images.
+
+    A heartbeat keeps every received message invisible until it is deleted or
+    dropped, and each task is claimed in DynamoDB right before it renders so a
+    duplicate delivery is skipped instead of rendered twice. A task that fails
+    with a transient error is retried after an exponential backoff, one that
+    fails for good is marked failed and its message dead-lettered at once. Finished and failed
+    statuses are written behind the pipeline by a StatusWriter, and a message is
+    only deleted once the finished status of its task is durable. Deterministic tasks
+    already in the result cache are finished by the poller without rendering.
+
+    Each webui call goes to the backend with the fewest calls outstanding, see
+    BackendPool; there is at least one inference worker per backend so every GPU
+    stays busy. The buffer runs jobs from the highest priority queue first and,
+    with model_affinity, prefers jobs that render with a model some backend has
+    loaded and routes them to that backend, so checkpoints are not swapped back
+    and forth. With shortest_first the job predicted to take the least webui time
+    by the CostModel runs next, unless a job was passed over max_bypass times. A
+    job that waited longer than max_wait runs next regardless, so nothing starves.
+    With adaptive_visibility each message is kept invisible for a multiple of its
+    predicted time instead of visibility_timeout, so a short task of a crashed
+    worker comes back soon and a long one isn't extended over and over.
+
+    drain() takes the instance out of service: polling stops, buffered messages
+    go back to the queue right away, the running inferences get a deadline to
+    finish and their results are uploaded and written before the pipeline stops.
+
+    With report_progress the webui progress of the running call is written to the
+    task rows, at most once every progress_interval seconds per task. With
+    scaling_signal the rolling webui time per task turns the queue backlog into
+    seconds of work per instance for the Auto Scaling policy.
+    """
+    def __init__(self, sqs_client, poller, prefetch_size=10, inference_workers=1,
+                 post_workers=2, max_batch_size=1, visibility_timeout=300,
+                 model_affinity=False, max_wait=120, report_progress=False, progress_interval=10,
+                 progress_previews=False, scaling_signal=False, shortest_first=False, max_bypass=5,
+                 adaptive_visibility=False):
+        self.sqs_client = sqs_client
+        self.poller = poller
+        self.max_wait = max_wait
+        self.shortest_first = shortest_first
+        self.max_bypass = max_bypass
+        self.adaptive_visibility = adaptive_visibility
+        self.max_batch_size = max_batch_size
+        self.backends = get_backends()
+        self.inference_workers = max(inference_workers, len(self.backends))
+        self.post_workers = post_workers
+        self.models = ModelTracker(self.backends.backends[0].url) if model_affinity else None
+        self.buffer = PrefetchBuffer(prefetch_size, self._select)
+        # bounded so a slow S3 pushes back on the inference stage instead of piling up images
+        self.post_queue = queue.Queue(maxsize=max(post_workers * 2, 1))
+        self.deleter = BatchDeleter(sqs_client)
+        self.status = StatusWriter()
+        self.spool = spool.get_output_spool()
+        self.profiler = profiling.get_task_profiler()
+        self.owner = f"{socket.gethostname()}-{os.getpid()}"
+        self.visibility_timeout = visibility_timeout
+        interval = None
+        if adaptive_visibility:
+            interval = max(min(visibility_timeout, cost_model.visibility_min) / 5, 1)
+        self.heartbeat = VisibilityHeartbeat(sqs_client, self.owner, visibility_timeout, interval)
+        self.cache = get_result_cache()
+        self.inputs = get_input_cache()
+        self.progress = None
+        if report_progress:
+            self.progress = ProgressReporter(self.owner, write_interval=progress_interval, previews=progress_previews)
+        self.throughput = scaling.ThroughputEstimator(scaling.smoothing, scaling.default_seconds_per_task)
+        self.costs = cost_model.CostModel(cost_model.seconds_per_step, cost_model.overhead,
+                                          cost_model.smoothing, cost_model.controlnet_weight)
+        self.scaling = None
+        if scaling_signal:
+            self.scaling = scaling.ScalingSignal(
+                poller,
+                self.throughput,
+                instance_id=lambda: get_health_checker().instance_id,
+                sink_names=scaling.sink_names,
+                interval=scaling.interval,
+                backends=len(self.backends),
+                pending=lambda: [job.task for job in self.buffer.jobs()]
+            )
+        self.inferring = 0
+        self.inferring_lock = threading.Lock()
+        # id -> job of the jobs taken by an inference worker and not yet posted
+        self.inflight = {}
+        # results an inference worker is putting on post_queue
+        self.posting = 0
+        # set once no more results will be put on post_queue, the post workers exit when it is empty
+        self.posts_closed = False
+        self.threads = []
+        self.poll_threads = []
+        self.inference_threads = []
+        self.post_threads = []
+        self.running = False
+        self.draining = False
+
+    def _register_metrics(self):
+        metrics.in_flight.set_function(lambda: len(self.buffer), 'prefetched')
+        metrics.in_flight.set_function(lambda: self.inferring, 'inference')
+        metrics.in_flight.set_function(lambda: self.post_queue.qsize(), 'post')
+        metrics.in_flight.set_function(lambda: len(self.status), 'status_write')
+        metrics.in_flight.set_function(lambda: len(self.spool), 'spooled')
+        metrics.spool_bytes.set_function(lambda: self.spool.bytes)
+        metrics.cost_model.set_function(lambda: self.costs.error, 'error')
+        self.backends.register_metrics()
+        if self.models:
+            metrics.model_swaps.set_function(lambda: self.models.stats["swaps"], 'swaps')
+            metrics.model_swaps.set_function(lambda: self.models.stats["swap_seconds"], 'seconds')
+        if self.cache:
+            for event in self.cache.stats:
+                metrics.result_cache.set_function(lambda event=event: self.cache.stats[event], event)
+        for event in self.inputs.stats:
+            metrics.input_cache.set_function(lambda event=event: self.inputs.stats[event], event)
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self._register_metrics()
+        self.deleter.start()
+        self.status.start()
+        self.heartbeat.start()
+        self.spool.start(self._resume)
+        if self.progress:
+            self.progress.start()
+        if self.scaling:
+            self.scaling.start()
+        targets = [self._poll_loop]
+        targets += [self._inference_loop] * self.inference_workers
+        targets += [self._post_loop] * self.post_workers
+        for target in targets:
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+            {
+                self._poll_loop: self.poll_threads,
+                self._inference_loop: self.inference_threads,
+                self._post_loop: self.post_threads,
+            }[target].append(thread)
+        logger.info(f"Pipeline started: prefetch={self.buffer.capacity}, backends={len(self.backends)}, "
+                    f"inference_workers={self.inference_workers}, post_workers={self.post_workers}")
+
+    def join(self):
+        for thread in self.threads:
+            thread.join()
+
+    def stop(self):
+        self.running = False
+        # the inference workers post the results they are still rendering before the post workers exit
+        self._wait_posted()
+        self.posts_closed = True
+        # finish the queued uploads and status writes, so their messages get deleted
+        for thread in self.post_threads:
+            thread.join()
+        if not self.spool.drain(spool.drain_timeout):
+            logger.warning(f"{len(self.spool)} tasks left in the output spool, they are uploaded after the restart")
+        self.spool.stop()
+        self.status.stop()
+        self.heartbeat.stop()
+        if self.progress:
+            self.progress.stop()
+        if self.scaling:
+            self.scaling.stop()
+        self.deleter.stop()
+
+    def drain(self, deadline):
+        """Stop taking work, give the running inferences deadline seconds and stop
+
+        Messages waiting in the buffer, and those of inferences still running at
+        the deadline, are made visible again at once so another instance picks
+        them up. Finished inferences are uploaded and written as in stop().
+        """
+        logger.info(f"Draining: waiting up to {deadline}s for {len(self.inflight)} running tasks")
+        end = time.time() + deadline
+        self.draining = True
+        # a receive in progress returns its messages itself
+        for thread in self.poll_threads:
+            thread.join(timeout=max(end - time.time(), 0))
+        self._return(self.buffer.drain())
+        for thread in self.inference_threads:
+            thread.join(timeout=max(end - time.time(), 0))
+        self._return(self.buffer.drain())
+        with self.inferring_lock:
+            running = list(self.inflight.values())
+            for job in running:
+                job.returned = True
+        if running:
+            logger.warning(f"Tasks {[j.taskId for j in running]} still rendering after {deadline}s, returning them")
+            self._return(running)
+        self.stop()
+
+    def _wait_posted(self):
+        """Wait until the inference workers put every result that isn't returned on post_queue"""
+        while True:
+            with self.inferring_lock:
+                if not self.posting and all(job.returned for job in self.inflight.values()):
+                    return
+            time.sleep(0.1)
+
+    def _return(self, jobs):
+        """Release the claims of jobs and make their messages visible again right away"""
+        by_queue = {}
+        for job in jobs:
+            self.heartbeat.untrack(job)
+            if job.claimed:
+                job.claimed = False
+                try:
+                    sd_dynamodb.releaseTask(job.taskId, self.owner)
+                except Exception as e:
+                    logger.error(f"Failed to release task {job.taskId}: {e}")
+            by_queue.setdefault(job.queue_url, []).append(job)
+        for queue_url, queued in by_queue.items():
+            for start in range(0, len(queued), SQS_MAX_BATCH):
+                batch = queued[start:start + SQS_MAX_BATCH]
+                try:
+                    response = self.sqs_client.change_message_visibility_batch(
+                        QueueUrl=queue_url,
+                        Entries=[{'Id': str(i), 'ReceiptHandle': job.receipt_handle, 'VisibilityTimeout': 0}
+                                 for i, job in enumerate(batch)]
+                    )
+                    failed = response.get('Failed', [])
+                except Exception as e:
+                    failed = [{'Id': str(i), 'Message': str(e)} for i in range(len(batch))]
+                for entry in failed:
+                    # it reappears once the current visibility runs out
+                    metrics.errors_total.labels('drain').inc()
+                    logger.error(f"Failed to return the message of task {batch[int(entry['Id'])].taskId}: {entry.get('Message')}")
+        if jobs:
+            logger.info(f"Returned {len(jobs)} messages to their queues")
+
+    def _receive(self, max_messages):
+        """Fetch up to max_messages from the queues as jobs"""
+        received = self.poller.receive(max_messages, self.visibility_timeout)
+        priority = self.poller.mode == 'priority'
+        jobs = [Job(message, q.url, q.priority if priority else 0) for message, q in received]
+        for job in jobs:
+            self.heartbeat.track(job)
+        return jobs
+
+    def _select(self, jobs):
+        """Index of the buffered job to run next"""
+        if time.time() - jobs[0].received_at > self.max_wait:
+            return 0
+        best = min(job.priority for job in jobs)
+        candidates = [index for index, job in enumerate(jobs) if job.priority == best]
+        if self.shortest_first:
+            for index in candidates:
+                if jobs[index].bypassed >= self.max_bypass:
+                    return index
+
+        def rank(index):
+            job = jobs[index]
+            # a loaded model saves a swap that costs more than the difference between most tasks
+            swap = self.models is not None and not self.models.matches(job)
+            return (swap, job.cost if self.shortest_first else 0, index)
+        chosen = min(candidates, key=rank)
+        if self.shortest_first:
+            for index in candidates:
+                if index < chosen:
+                    jobs[index].bypassed += 1
+        return chosen
+
+    def _resolve(self, job):
+        """Load the task details of a job, return False if it can not be processed"""
+        start = time.time()
+        with metrics.stage('task_fetch'):
+            task = sd_task_detail.get(job.body)
+        job.timings['taskFetch'] = time.time() - start
+        if task is None or task["errno"] != 200:
+            metrics.errors_total.labels('task_fetch').inc()
+            error = task and task['error']
+            logger.error(f"Failed to resolve task for message {job.body}: {error}")
+            # a malformed message never resolves, a missing row may not be readable yet
+            if task is None or task["errno"] == 400:
+                self._drop(job, failures.PermanentError(error))
+            else:
+                self._drop(job, failures.TransientError(error))
+            return False
+        job.taskId = task["taskId"]
+        if task.get("taskStatus") in ("finished", "failed"):
+            logger.info(f"Task {job.taskId} is already {task['taskStatus']}, deleting duplicate message")
+            metrics.tasks_total.labels('duplicate').inc()
+            self._complete(job)
+            return False
+        job.requestData = task["requestData"]
+        job.task = sd_api.parse_task(job.requestData)
+        job.trace['payloadBytes'] = len(job.requestData.encode())
+        # fetch the referenced input images now, so the webui never waits on S3
+        start = time.time()
+        self.inputs.resolve(job.task)
+        job.timings['inputs'] = time.time() - start
+        job.group_key = coalesce.group_key(job.task)
+        if self.models:
+            try:
+                job.model = self.models.model_of(job.task)
+            except Exception as e:
+                logger.error(f"Failed to resolve the model of task {job.taskId}: {e}")
+        if self._finish_from_cache(job):
+            return False
+        job.cost = self.costs.predict(job.task)
+        job.trace['predicted'] = round(job.cost, 3)
+        if self.adaptive_visibility:
+            self.heartbeat.retime(job, cost_model.visibility(job.cost))
+        return True
+
+    def _finish_from_cache(self, job):
+        """Finish a job with a cached result, return False on a cache miss"""
+        if self.cache is None:
+            return False
+        try:
+            job.cache_key = self.cache.key(job.task, job.model and job.model[0])
+            res = self.cache.get(job.cache_key) if job.cache_key else None
+        except Exception as e:
+            logger.error(f"Result cache lookup failed for task {job.taskId}: {e}")
+            return False
+        if res is None:
+            return False
+        logger.info(f"Task {job.taskId} served from the result cache")
+
+        def durable():
+            metrics.tasks_total.labels('cached').inc()
+            self._complete(job)
+            self.profiler.dump(job.taskId, job.profile)
+        job.timings['total'] = time.time() - job.sent_at
+        res = dict(res, cached=True, trace=self._trace(job))
+        self.status.finish(job.taskId, self._owner(job), res, job.timings, on_durable=durable,
+                           on_failed=lambda: self._drop(job), on_lost=lambda: self._lost(job))
+        return True
+
+    def _poll_loop(self):
+        while self.running and not self.draining:
+            free = self.buffer.wait_for_space(timeout=1)
+            if free == 0:
+                continue
+            try:
+                jobs = self._receive(min(free, SQS_MAX_BATCH))
+            except Exception as e:
+                metrics.errors_total.labels('sqs_receive').inc()
+                logger.error(f"receive_message error: {e}")
+                time.sleep(1)
+                continue
+            if not jobs:
+                logger.info("No messages received. Waiting for next poll...")
+                continue
+            for job in jobs:
+                job.profile = self.profiler.sample()
+                try:
+                    with profiling.active(job.profile):
+                        resolved = self._resolve(job)
+                    if resolved and self.draining:
+                        self._return([job])
+                    elif resolved:
+                        self.buffer.put(job)
+                except Exception as e:
+                    metrics.errors_total.labels('task_fetch').inc()
+                    logger.error(f"Error resolving message {job.body}: {e}")
+                    self._drop(job, e)
+
+    def _hold(self, job):
+        """Count a job taken from the buffer as in flight, return it to its queue if the pipeline is stopping"""
+        with self.inferring_lock:
+            if self.running and not self.draining:
+                self.inflight[id(job)] = job
+                return True
+        self._return([job])
+        return False
+
+    def _inference_loop(self):
+        while self.running and not self.draining:
+            job = self.buffer.take(timeout=1)
+            if job is None or not self._hold(job):
+                continue
+            jobs = [job]
+            try:
+                if not self._claim(job):
+                    continue
+                self._take_compatible(jobs)
+                try:
+                    self._infer(jobs)
+                except Exception as e:
+                    if len(jobs) == 1 or not failures.is_permanent(e):
+                        raise
+                    # the merge itself may be what failed, e.g. a batch too large for the GPU
+                    logger.warning(f"Merged call for tasks {[j.taskId for j in jobs]} failed, running them alone: {e}")
+                    self._infer_alone(jobs)
+            except Exception as e:
+                metrics.errors_total.labels('inference').inc()
+                logger.error(f"Inference error for tasks {[j.taskId for j in jobs]}: {e}")
+                for j in jobs:
+                    if not j.returned:
+                        self._drop(j, e)
+            finally:
+                with self.inferring_lock:
+                    for j in jobs:
+                        self.inflight.pop(id(j), None)
+
+    def _infer_alone(self, jobs):
+        """Run each of jobs in its own webui call, so only the tasks that fail alone are given up"""
+        for job in jobs:
+            if job.returned:
+                continue
+            try:
+                self._infer([job])
+            except Exception as e:
+                metrics.errors_total.labels('inference').inc()
+                logger.error(f"Inference error for task {job.taskId}: {e}")
+                if not job.returned:
+                    self._drop(job, e)
+
+    def _take_compatible(self, jobs):
+        """Add the buffered jobs that can join the webui batch of jobs[0] to jobs"""
+        job = jobs[0]
+        if job.group_key is None or self.max_batch_size <= 1:
+            return
+        payloads = [job.task["payload"]]
+        while True:
+            other = self.buffer.take_matching(
+                lambda j: j.group_key == job.group_key
+                and coalesce.can_join(payloads, j.task["payload"], self.max_batch_size)
+            )
+            if other is None or not self._hold(other):
+                return
+            if not self._claim(other):
+                with self.inferring_lock:
+                    self.inflight.pop(id(other), None)
+                continue
+            payloads.append(other.task["payload"])
+            jobs.append(other)
+
+    def _infer(self, jobs):
+        prefer = None
+        if self.models:
+            prefer = lambda backend: self.models.loaded_on(backend.url) == jobs[0].model
+        with self.backends.lease(prefer) as backend:
+            for j in jobs:
+                j.trace.update(backend=backend.url, batch=len(jobs))
+            # a merged call is profiled for the first sampled task in it
+            profile = next((j.profile for j in jobs if j.profile is not None), None)
+            with profiling.active(profile), self._model_loaded(jobs[0].model, backend.url):
+                self._infer_on(backend.url, jobs)
+        # from here on a drain waits for the jobs instead of returning them
+        with self.inferring_lock:
+            posted = [j for j in jobs if not j.returned]
+            for j in jobs:
+                self.inflight.pop(id(j), None)
+            self.posting += len(posted)
+        for j in jobs:
+            if j.returned:
+                # the drain gave the message to another instance
+                sd_api.release_images(j.response['images'])
+                j.response = None
+        for j in posted:
+            try:
+                self.post_queue.put(j)
+            finally:
+                with self.inferring_lock:
+                    self.posting -= 1
+
+    def _model_loaded(self, model, url):
+        """Context manager keeping model loaded on the backend at url during a call, nothing without model affinity"""
+        if self.models is None:
+            return nullcontext()
+        return self.models.use(model, url)
+
+    def _infer_on(self, url, jobs):
+        api = jobs[0].task["api"]
+        if self.progress:
+            self.progress.begin(jobs, url)
+        with self.inferring_lock:
+            self.inferring += 1
+        start = time.time()
+        for j in jobs:
+            j.timings['queueWait'] = start - j.sent_at
+        try:
+            with metrics.stage('inference'):
+                self._call_webui(url, api, jobs)
+            elapsed = time.time() - start
+            images = [coalesce.image_count(j.task["payload"]) for j in jobs]
+            self.costs.record([j.task for j in jobs], elapsed)
+            for j, count in zip(jobs, images):
+                j.timings['inference'] = elapsed
+                # a merged call's time is shared by its tasks in proportion to their images
+                self.throughput.record(scaling.task_class(j.task), count, elapsed * count / sum(images))
+        finally:
+            with self.inferring_lock:
+                self.inferring -= 1
+            if self.progress:
+                self.progress.end(jobs)
+
+    def _call_webui(self, url, api, jobs):
+        trace = {}
+        if len(jobs) == 1:
+            logger.info(f"Processing task {jobs[0].taskId} on {url}")
+            jobs[0].response = sd_api.call_webui(api, jobs[0].task["payload"], url, trace)
+            jobs[0].timings['decode'] = trace['decode']
+        else:
+            logger.info(f"Processing tasks {[j.taskId for j in jobs]} in one batch on {url}")
+            payloads = [j.task["payload"] for j in jobs]
+            response = sd_api.call_webui(api, coalesce.merge(payloads), url, trace)
+            try:
+                responses = coalesce.split(response, payloads)
+            except Exception:
+                sd_api.release_images(response['images'])
+                raise
+            for j, r in zip(jobs, responses):
+                j.response = r
+                j.timings['decode'] = trace['decode']
+
+    def _post_loop(self):
+        while not self.posts_closed or not self.post_queue.empty():
+            try:
+                job = self.post_queue.get(timeout=1)
+            except queue.Empty:
+                continue
+            try:
+                self._finish(job)
+            except Exception as e:
+                metrics.errors_total.labels('post').inc()
+                logger.error(f"Post processing error for task {job.taskId}: {e}")
+                self._drop(job, e)
+            finally:
+                self.post_queue.task_done()
+
+    def _finish(self, job):
+        """Encode the images of a job into the output spool, which uploads them"""
+        start = time.time()
+        with profiling.active(job.profile):
+            files, thumbnails = sd_api.encode_files(
+                job.response['images'],
+                sd_api.output_key(job.taskId),
+                job.task.get("output"),
+                sd_api.infotexts(job.response)
+            )
+        job.timings['encode'] = time.time() - start
+        job.response = None
+        job.trace['outputBytes'] = sum(os.path.getsize(f["path"]) for f in files)
+        context = {
+            # what a restart needs to extend and delete the message, attributes may hold binary values
+            "message": {k: job.message[k] for k in ('MessageId', 'ReceiptHandle', 'Body', 'Attributes') if k in job.message},
+            "queue_url": job.queue_url,
+            "taskId": job.taskId,
+            "owner": self._owner(job),
+            "cache_key": job.cache_key,
+            "timings": job.timings,
+            "trace": job.trace,
+        }
+        self.spool.add(job.taskId, files, thumbnails, context,
+                       on_uploaded=lambda record: self._uploaded(job, record),
+                       on_failed=lambda error: self._drop(job, failures.TransientError(f"upload failed: {error}")))
+
+    def _uploaded(self, job, record):
+        """The images of a job are in S3, finish its task"""
+        job.timings['upload'] = time.time() - record.created
+        job.timings['total'] = time.time() - job.sent_at
+        res = dict(record.res, trace=self._trace(job))
+
+        def durable():
+            metrics.tasks_total.labels('finished').inc()
+            metrics.images_total.inc(res['cnt'])
+            self._complete(job)
+            self.spool.remove(record)
+            self.profiler.dump(job.taskId, job.profile)
+            if job.cache_key:
+                # the trace belongs to this task, not to the ones served from the cache
+                self.cache.put(job.cache_key, record.res)
+
+        def failed():
+            self.spool.remove(record)
+            self._drop(job)
+
+        def lost():
+            self.spool.remove(record)
+            self._lost(job)
+        # the message is deleted once the finished status is written
+        self.status.finish(job.taskId, self._owner(job), res, job.timings, on_durable=durable, on_failed=failed,
+                           on_lost=lost)
+
+    def _trace(self, job):
+        """The trace stored in processRes: timings in seconds, backend, batch size and sizes in bytes"""
+        trace = dict(job.trace, timings={k: round(v, 3) for k, v in job.timings.items()})
+        trace['attempt'] = failures.receive_count(job.message)
+        trace['worker'] = self.owner
+        return trace
+
+    def _resume(self, record):
+        """Pick up a task whose images a previous run left in the output spool"""
+        context = record.context
+        job = Job(context["message"], context["queue_url"])
+        job.taskId = context["taskId"]
+        # the row is still claimed under the owner name of the previous run
+        job.owner = context.get("owner")
+        job.cache_key = context.get("cache_key")
+        job.timings = context.get("timings") or {}
+        job.trace = context.get("trace") or {}
+        # the message may still be invisible under the receipt handle of the previous run
+        self.heartbeat.track(job)
+        record.on_uploaded = lambda r: self._uploaded(job, r)
+        record.on_failed = lambda error: self._drop(job, failures.TransientError(f"upload failed: {error}"))
+
+    def _claim(self, job):
+        """Claim the task of a job in DynamoDB, return False if it must not be rendered here"""
+        try:
+            res = sd_dynamodb.claimTask(job.taskId, self.owner, self.heartbeat.timeout(job))
+        except Exception as e:
+            logger.error(f"Failed to claim task {job.taskId}: {e}")
+            self._drop(job)
+            return False
+        if res["claimed"]:
+            job.claimed = True
+            return True
+        if res["taskStatus"] in ("finished", "failed"):
+            logger.info(f"Task {job.taskId} is already {res['taskStatus']}, deleting duplicate message")
+            metrics.tasks_total.labels('duplicate').inc()
+            self._complete(job)
+        else:
+            logger.info(f"Task {job.taskId} is {res['taskStatus']} on another worker, skipping")
+            self._drop(job)
+        return False
+
+    def _owner(self, job):
+        """Owner the status writes of a job are conditional on"""
+        return job.owner or self.owner
+
+    def _lost(self, job):
+        """Let go of a job whose task finished elsewhere or another worker took over
+
+        The message isn't deleted, it belongs to the current owner of the task; a
+        later delivery of a finished task is deleted as a duplicate.
+        """
+        metrics.tasks_total.labels('lost').inc()
+        logger.warning(f"Task {job.taskId} is no longer ours, leaving its message to its owner")
+        job.claimed = False
+        self._drop(job)
+
+    def _complete(self, job):
+        """Stop the heartbeat of a handled job and delete its message"""
+        self.heartbeat.untrack(job)
+        self.deleter.add(job)
+        self.poller.record_completed(job.queue_url, job.sent_at)
+
+    def _drop(self, job, error=None):
+        """Give up on the current delivery of a job
+
+        Without an error a claimed task is put back to waiting and the message
+        reappears once the current visibility runs out. A transient error puts the
+        task back to waiting with the error recorded and hides the message for an
+        exponentially growing backoff. A permanent error, or any error on the
+        max_receives-th delivery, marks the task failed and dead-letters the message
+        once that is written, so a poison task stops taking GPU time.
+        """
+        self.heartbeat.untrack(job)
+        if job.profile is not None:
+            self.profiler.dump(job.taskId or job.message.get('MessageId'), job.profile)
+            job.profile = None
+        if job.response is not None:
+            sd_api.release_images(job.response.get('images'))
+            job.response = None
+        claimed, job.claimed = job.claimed, False
+        if error is None:
+            if claimed:
+                try:
+                    sd_dynamodb.releaseTask(job.taskId, self.owner)
+                except Exception as e:
+                    logger.error(f"Failed to release task {job.taskId}: {e}")
+            return
+        receives = failures.receive_count(job.message)
+        if failures.is_permanent(error) or receives >= failures.max_receives:
+            metrics.tasks_total.labels('failed').inc()
+            logger.error(f"Task {job.taskId} failed for good on delivery {receives}: {error}")
+            if job.taskId:
+                self.status.fail(job.taskId, self._owner(job), error, job.timings,
+                                 on_durable=lambda: self._dead_letter(job, error))
+            else:
+                self._dead_letter(job, error)
+            return
+        delay = failures.backoff(receives)
+        metrics.tasks_total.labels('retried').inc()
+        logger.warning(f"Task {job.taskId} failed on delivery {receives}, retrying in {delay}s: {error}")
+        self._retry_later(job, delay)
+        if job.taskId:
+            self.status.retry(job.taskId, self._owner(job), error, job.timings)
+
+    def _retry_later(self, job, delay):
+        """Hide the message of a job for delay seconds"""
+        try:
+            self.sqs_client.change_message_visibility(
+                QueueUrl=job.queue_url,
+                ReceiptHandle=job.receipt_handle,
+                VisibilityTimeout=delay
+            )
+        except Exception as e:
+            # it reappears once the current visibility runs out
+            metrics.errors_total.labels('backoff').inc()
+            logger.error(f"Failed to delay the retry of task {job.taskId}: {e}")
+
+    def _dead_letter(self, job, error):
+        """Move the message of a failed job to the dead-letter queue, delete it without one"""
+        if failures.dlq_url:
+            try:
+                self.sqs_client.send_message(
+                    QueueUrl=failures.dlq_url,
+                    MessageBody=job.body,
+                    MessageAttributes={
+                        'error': {'DataType': 'String', 'StringValue': str(error)[:1000] or type(error).__name__},
+                        'queue': {'DataType': 'String', 'StringValue': job.queue_url},
+                    }
+                )
+            except Exception as e:
+                # left on the queue, the redrive policy moves it eventually
+                metrics.errors_total.labels('dead_letter').inc()
+                logger.error(f"Failed to dead-letter the message of task {job.taskId}: {e}")
+                return
+        self.deleter.add(job)
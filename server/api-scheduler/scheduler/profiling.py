@@ -0,0 +1,111 @@
+import cProfile
+import os
+import threading
+import logging
+from contextlib import contextmanager
+
+import scheduler.sd_s3 as sd_s3
+import scheduler.sd_api as sd_api
+from scheduler.conf import schedulerConfig
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger('profiling')
+
+# 每 every 个任务用 cProfile 采样一个, 记录调度器在该任务上的 Python 开销; 0 关闭
+every = schedulerConfig.getint('profiling', 'every', fallback=0)
+# 采样结果(pstats 文件)保存的本地目录, 最多保留 keep 个
+profile_dir = schedulerConfig.get('profiling', 'dir', fallback='/tmp/sd-profiles')
+keep = schedulerConfig.getint('profiling', 'keep', fallback=100)
+# 不为空时同时上传到 S3 桶的该前缀下
+s3_prefix = schedulerConfig.get('profiling', 's3_prefix', fallback='')
+
+
+class TaskProfiler:
+    """Samples one task in every and profiles the scheduler's work on it
+
+    A sampled task carries a cProfile.Profile that is enabled around each stage
+    the pipeline runs for it (resolve, inference, encode), whatever thread runs
+    the stage; the stages of a task never overlap. dump() writes the stats to
+    directory/<taskId>.prof, keeps the newest keep files and uploads them under
+    s3_prefix if one is set. Load them with pstats or snakeviz.
+    """
+    def __init__(self, every, directory, keep=100, s3_prefix=''):
+        self.every = every
+        self.directory = directory
+        self.keep = keep
+        self.s3_prefix = s3_prefix
+        self.count = 0
+        self.lock = threading.Lock()
+        self.stats = {"sampled": 0, "dumped": 0}
+
+    def sample(self):
+        """A profile for the next task if it is sampled, else None"""
+        if self.every <= 0:
+            return None
+        with self.lock:
+            self.count += 1
+            if self.count % self.every:
+                return None
+            self.stats["sampled"] += 1
+        return cProfile.Profile()
+
+    def dump(self, taskId, profile):
+        """Store the profile of a finished or dropped task, no-op if it wasn't sampled"""
+        if profile is None:
+            return
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            path = os.path.join(self.directory, f"{taskId}.prof")
+            profile.dump_stats(path)
+            self.stats["dumped"] += 1
+            self._prune()
+        except Exception as e:
+            logger.error(f"Failed to write the profile of task {taskId}: {e}")
+            return
+        if self.s3_prefix:
+            # off the status writer thread that finishes the task
+            sd_api.upload_pool.submit(self._upload, taskId, path)
+
+    def _upload(self, taskId, path):
+        try:
+            sd_s3.upload_file_to_s3(f"{self.s3_prefix}{taskId}.prof", path, 'application/octet-stream')
+        except Exception as e:
+            logger.error(f"Failed to upload the profile of task {taskId}: {e}")
+
+    def _prune(self):
+        names = [n for n in os.listdir(self.directory) if n.endswith('.prof')]
+        if len(names) <= self.keep:
+            return
+        paths = sorted((os.path.join(self.directory, n) for n in names), key=os.path.getmtime)
+        for path in paths[:len(paths) - self.keep]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+@contextmanager
+def active(profile):
+    """Profile the enclosed code in the current thread, nothing if profile is None"""
+    if profile is None:
+        yield
+        return
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+
+
+# Singleton instance
+task_profiler = None
+
+def get_task_profiler():
+    global task_profiler
+    if task_profiler is None:
+        task_profiler = TaskProfiler(every, profile_dir, keep, s3_prefix)
+    return task_profiler
@@ -0,0 +1,110 @@
+import base64
+import io
+import threading
+import time
+import logging
+from PIL import Image
+
+import scheduler.sd_api as sd_api
+import scheduler.sd_s3 as sd_s3
+import scheduler.sd_dynamodb as sd_dynamodb
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger('progress')
+
+PREVIEW_SIZE = 256
+
+
+class ProgressReporter:
+    """Polls the webui progress endpoint and writes it to the running tasks' rows
+
+    The webui is polled every poll_interval seconds, but each task row is written at
+    most once every write_interval seconds so the progress costs a bounded number
+    of WCUs per task. Each webui backend is polled for the call running on it.
+    With previews enabled a small JPEG of the current step is
+    uploaded next to the outputs and linked from the row as previewUrl.
+    """
+    def __init__(self, owner, poll_interval=2, write_interval=10, previews=False):
+        self.owner = owner
+        self.poll_interval = poll_interval
+        self.write_interval = write_interval
+        self.previews = previews
+        self.active = {}
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.running = False
+
+    def begin(self, jobs, url=None):
+        """Report progress for jobs rendering in one call on the webui at url"""
+        with self.lock:
+            self.active[id(jobs[0])] = {"jobs": jobs, "url": url, "last_write": 0, "last_progress": None}
+
+    def end(self, jobs):
+        with self.lock:
+            self.active.pop(id(jobs[0]), None)
+
+    def poll(self):
+        with self.lock:
+            calls = {}
+            for entry in self.active.values():
+                calls.setdefault(entry["url"], []).append(entry)
+        for entries in calls.values():
+            # a webui reports one progress, only attribute it when a single call is running on it
+            if len(entries) != 1:
+                continue
+            try:
+                self._poll(entries[0])
+            except Exception as e:
+                logger.error(f"Error reporting progress from {entries[0]['url']}: {e}")
+
+    def _poll(self, entry):
+        now = time.time()
+        if now - entry["last_write"] < self.write_interval:
+            return
+        state = sd_api.get_progress(skip_current_image=not self.previews, url=entry["url"])
+        progress = state.get("progress", 0) or 0
+        if progress == entry["last_progress"]:
+            return
+        previewUrl = None
+        if self.previews and state.get("current_image"):
+            previewUrl = self._upload_preview(entry["jobs"][0].taskId, progress, state["current_image"])
+        for job in entry["jobs"]:
+            sd_dynamodb.updateProgress(job.taskId, self.owner, progress, state.get("eta_relative", 0) or 0, previewUrl)
+        entry["last_write"] = now
+        entry["last_progress"] = progress
+
+    def _upload_preview(self, taskId, progress, current_image):
+        image = Image.open(io.BytesIO(base64.b64decode(current_image.split(",", 1)[-1])))
+        image.thumbnail((PREVIEW_SIZE, PREVIEW_SIZE))
+        buf = io.BytesIO()
+        image.convert('RGB').save(buf, format='JPEG', quality=70)
+        # a new key per step so CloudFront never serves a stale preview
+        uri = sd_s3.put_object_to_s3(f"sd/preview/{taskId}-{int(progress * 100)}.jpg", buf.getvalue(), 'image/jpeg')
+        return uri or None
+
+    def _loop(self):
+        while self.running:
+            try:
+                self.poll()
+            except Exception as e:
+                logger.error(f"Error reporting progress: {e}")
+            self.wakeup.wait(self.poll_interval)
+
+    def start(self):
+        if not self.running:
+            self.running = True
+            self.thread = threading.Thread(target=self._loop)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self):
+        if self.running:
+            self.running = False
+            self.wakeup.set()
+            if self.thread:
+                self.thread.join(timeout=self.poll_interval + 1)
@@ -0,0 +1,156 @@
+import random
+import threading
+import time
+import logging
+
+from scheduler.conf import schedulerConfig
+import scheduler.metrics as metrics
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger('queues')
+
+
+class TaskQueue:
+    """One SQS queue the scheduler consumes, with its latency statistics"""
+    def __init__(self, name, url, priority=0, weight=1):
+        self.name = name
+        self.url = url
+        self.priority = priority
+        self.weight = weight
+        self.lock = threading.Lock()
+        self.stats = {"received": 0, "completed": 0, "queue_wait_total": 0.0, "queue_wait_max": 0.0,
+                      "latency_total": 0.0, "latency_max": 0.0}
+
+    def record_received(self, queue_wait):
+        with self.lock:
+            self.stats["received"] += 1
+            self.stats["queue_wait_total"] += queue_wait
+            self.stats["queue_wait_max"] = max(self.stats["queue_wait_max"], queue_wait)
+
+    def record_completed(self, latency):
+        with self.lock:
+            self.stats["completed"] += 1
+            self.stats["latency_total"] += latency
+            self.stats["latency_max"] = max(self.stats["latency_max"], latency)
+
+    def summary(self):
+        with self.lock:
+            s = dict(self.stats)
+        s["queue_wait_avg"] = s["queue_wait_total"] / s["received"] if s["received"] else 0.0
+        s["latency_avg"] = s["latency_total"] / s["completed"] if s["completed"] else 0.0
+        return s
+
+
+def load_queues():
+    """Queues from conf.ini in priority order
+
+    Every [queue.<name>] section adds a queue with url and optional weight, the first
+    section has the highest priority. Without such sections the single
+    [aws] queue_url is used as before.
+    """
+    queues = []
+    for section in schedulerConfig.sections():
+        if section.startswith('queue.'):
+            queues.append(TaskQueue(
+                section[len('queue.'):],
+                schedulerConfig.get(section, 'url'),
+                priority=len(queues),
+                weight=schedulerConfig.getfloat(section, 'weight', fallback=1)
+            ))
+    if not queues:
+        queues.append(TaskQueue('default', schedulerConfig.get('aws', 'queue_url')))
+    return queues
+
+
+class QueuePoller:
+    """Receives messages from an ordered list of queues
+
+    In "priority" mode the queues are tried in order with short polls and only the
+    last one is long polled, so a high priority message never waits behind bulk
+    work. In "weighted" mode the order of every sweep is drawn by weight.
+    """
+    def __init__(self, sqs_client, queues, mode='priority', wait_time=10, report_interval=60):
+        self.sqs_client = sqs_client
+        self.queues = queues
+        self.mode = mode
+        self.wait_time = wait_time
+        self.report_interval = report_interval
+        self.last_report = time.time()
+        self.by_url = {q.url: q for q in queues}
+        self.backlog_ttl = 15
+        self.backlogs = {}
+        for q in queues:
+            metrics.queue_backlog.set_function(lambda q=q: self.backlog(q), q.name)
+
+    def _order(self):
+        if self.mode != 'weighted' or len(self.queues) == 1:
+            return list(self.queues)
+        # weighted shuffle: draw queues one by one with probability proportional to weight
+        remaining = list(self.queues)
+        order = []
+        while remaining:
+            q = random.choices(remaining, weights=[max(q.weight, 0.001) for q in remaining])[0]
+            remaining.remove(q)
+            order.append(q)
+        return order
+
+    def receive(self, max_messages, visibility_timeout):
+        """Return [(message, queue)] from the first queue in the sweep that has messages"""
+        self._report()
+        order = self._order()
+        for index, q in enumerate(order):
+            last = index == len(order) - 1
+            with metrics.stage('sqs_receive'):
+                response = self.sqs_client.receive_message(
+                    QueueUrl=q.url,
+                    MaxNumberOfMessages=max_messages,
+                    WaitTimeSeconds=self.wait_time if last else 0,
+                    VisibilityTimeout=visibility_timeout,
+                    AttributeNames=['SentTimestamp', 'ApproximateReceiveCount']
+                )
+            messages = response.get('Messages', [])
+            if messages:
+                now = time.time()
+                for message in messages:
+                    q.record_received(now - sent_time(message, now))
+                return [(message, q) for message in messages]
+        return []
+
+    def record_completed(self, queue_url, sent_at):
+        q = self.by_url.get(queue_url)
+        if q is not None:
+            q.record_completed(time.time() - sent_at)
+
+    def summary(self):
+        return {q.name: q.summary() for q in self.queues}
+
+    def backlog(self, q):
+        """Approximate number of visible messages in q, cached for backlog_ttl seconds"""
+        cached = self.backlogs.get(q.url)
+        if cached is None or time.time() - cached[0] > self.backlog_ttl:
+            response = self.sqs_client.get_queue_attributes(
+                QueueUrl=q.url,
+                AttributeNames=['ApproximateNumberOfMessages']
+            )
+            cached = (time.time(), int(response['Attributes']['ApproximateNumberOfMessages']))
+            self.backlogs[q.url] = cached
+        return cached[1]
+
+    def _report(self):
+        if time.time() - self.last_report < self.report_interval:
+            return
+        self.last_report = time.time()
+        for name, s in self.summary().items():
+            logger.info(f"Queue {name}: received {s['received']}, completed {s['completed']}, "
+                        f"queue wait avg {s['queue_wait_avg']:.1f}s max {s['queue_wait_max']:.1f}s, "
+                        f"end-to-end avg {s['latency_avg']:.1f}s max {s['latency_max']:.1f}s")
+
+
+def sent_time(message, default):
+    """Time the message was sent to SQS in epoch seconds"""
+    sent = message.get('Attributes', {}).get('SentTimestamp')
+    return int(sent) / 1000 if sent else default
@@ -0,0 +1,133 @@
+import hashlib
+import json
+import threading
+import time
+import logging
+from collections import OrderedDict
+
+import scheduler.sd_api as sd_api
+import scheduler.encoding as encoding
+import scheduler.sd_s3 as sd_s3
+from scheduler.conf import schedulerConfig
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger('result_cache')
+
+# 结果缓存: 固定seed且参数相同的请求直接返回已有图片, 不再占用GPU
+enabled = schedulerConfig.getboolean('cache', 'enabled', fallback=False)
+max_entries = schedulerConfig.getint('cache', 'max_entries', fallback=10000)
+ttl = schedulerConfig.getint('cache', 'ttl', fallback=86400)
+manifest_prefix = schedulerConfig.get('cache', 'manifest_prefix', fallback='sd/cache/')
+
+# Payload fields that don't change the rendered images
+IGNORED_FIELDS = ('send_images', 'save_images', 'do_not_save_samples', 'do_not_save_grid')
+
+
+class ResultCache:
+    """Content addressed cache of finished results
+
+    Lookups go to a local LRU index first and then to a JSON manifest in S3,
+    so every instance sees results rendered by the others. Entries expire after
+    ttl seconds and the local index keeps at most max_entries results.
+    """
+    def __init__(self, max_entries=10000, ttl=86400, manifest_prefix='sd/cache/'):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.manifest_prefix = manifest_prefix
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {"local_hits": 0, "persistent_hits": 0, "misses": 0, "evictions": 0}
+
+    def key(self, task, model=None):
+        """Canonical hash of the api, the normalized payload, the model and the output encoding, None if not deterministic
+
+        model is the checkpoint the task renders with as the ModelTracker resolved
+        it, its sd_model_checkpoint override if None. Without either the checkpoint
+        depends on the backend the task lands on, and the task isn't cached.
+        """
+        payload = task.get("payload", {})
+        model = model or (payload.get("override_settings") or {}).get("sd_model_checkpoint")
+        if model is None or int(payload.get("seed", -1)) == -1:
+            return None
+        if float(payload.get("subseed_strength", 0) or 0) > 0 and int(payload.get("subseed", -1)) == -1:
+            return None
+        normalized = {k: v for k, v in payload.items() if k not in IGNORED_FIELDS}
+        canonical = json.dumps(
+            {
+                "api": task.get("api"),
+                "payload": normalized,
+                "model": model,
+                "output": encoding.options(task.get("output"))
+            },
+            sort_keys=True,
+            separators=(',', ':')
+        )
+        return hashlib.sha256(canonical.encode()).hexdigest()
+
+    def get(self, key):
+        """Cached result for key or None"""
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and now - entry["created"] < self.ttl:
+                self.entries.move_to_end(key)
+                self.stats["local_hits"] += 1
+                return entry["res"]
+            if entry is not None:
+                del self.entries[key]
+                self.stats["evictions"] += 1
+        entry = self._read_manifest(key)
+        if entry is not None and now - entry["created"] < self.ttl:
+            self._remember(key, entry)
+            with self.lock:
+                self.stats["persistent_hits"] += 1
+            return entry["res"]
+        with self.lock:
+            self.stats["misses"] += 1
+        return None
+
+    def put(self, key, res):
+        """Remember res for key, its manifest is written to S3 on the upload pool"""
+        entry = {"created": time.time(), "res": res}
+        self._remember(key, entry)
+        sd_api.upload_pool.submit(self._write_manifest, key, entry)
+
+    def _write_manifest(self, key, entry):
+        try:
+            uri = sd_s3.put_object_to_s3(f"{self.manifest_prefix}{key}.json", json.dumps(entry).encode(), 'application/json')
+        except Exception as e:
+            uri = False
+            logger.error(f"Failed to write cache manifest {key}: {e}")
+        if uri is False:
+            logger.warning(f"Failed to write cache manifest {key}")
+
+    def _remember(self, key, entry):
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.stats["evictions"] += 1
+
+    def _read_manifest(self, key):
+        try:
+            data = sd_s3.get_object_from_s3(f"{self.manifest_prefix}{key}.json")
+            return json.loads(data) if data else None
+        except Exception as e:
+            logger.error(f"Failed to read cache manifest {key}: {e}")
+            return None
+
+
+# Singleton instance
+result_cache = None
+
+def get_result_cache():
+    """Get the result cache, None when caching is disabled"""
+    global result_cache
+    if enabled and result_cache is None:
+        result_cache = ResultCache(max_entries, ttl, manifest_prefix)
+    return result_cache
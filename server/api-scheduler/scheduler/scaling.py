@@ -0,0 +1,247 @@
+import json
+import socket
+import threading
+import time
+import logging
+
+import scheduler.clients as clients
+import scheduler.metrics as metrics
+from scheduler.conf import schedulerConfig
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger('scaling')
+
+# 扩缩容信号: 积压任务按最近的处理速度需要多少秒, 按实例平均
+enabled = schedulerConfig.getboolean('scaling', 'enabled', fallback=False)
+# 发布到哪些 sink, 逗号分隔: prometheus, cloudwatch, emf
+sink_names = [s.strip() for s in schedulerConfig.get('scaling', 'sinks', fallback='prometheus').split(',') if s.strip()]
+# 发布间隔(秒), 以及吞吐量估计的平滑系数, 越大越跟随最近的任务
+interval = schedulerConfig.getint('scaling', 'interval', fallback=60)
+smoothing = schedulerConfig.getfloat('scaling', 'smoothing', fallback=0.1)
+namespace = schedulerConfig.get('scaling', 'namespace', fallback='SdInference')
+# 还没有完成任务时假定的每个任务耗时(秒)
+default_seconds_per_task = schedulerConfig.getfloat('scaling', 'default_seconds_per_task', fallback=10)
+
+
+def task_class(task):
+    """Class of a task for throughput estimates: api, size and hires"""
+    payload = task.get("payload", {})
+    api = task.get("api", "").rsplit("/", 1)[-1]
+    size = f'{payload.get("width", 512)}x{payload.get("height", 512)}'
+    return f'{api}-{size}{"-hr" if payload.get("enable_hr") else ""}'
+
+
+class ThroughputEstimator:
+    """Rolling GPU seconds per image and per task by task class, and the class mix
+
+    Exponentially weighted, so the estimate follows a changing task mix within a
+    few dozen tasks without being thrown around by a single slow one. The mix is
+    the share of each class among the recent tasks; a task whose class isn't
+    known, like one still on the queue, is expected to take the mix-weighted
+    average of the per-class seconds.
+    """
+    def __init__(self, smoothing=0.1, default_seconds_per_task=10):
+        self.smoothing = smoothing
+        self.default_seconds_per_task = default_seconds_per_task
+        self.per_image = {}
+        self.per_task = {}
+        self.mix = {}
+        self.lock = threading.Lock()
+
+    def _average(self, old, value):
+        return value if old is None else old + self.smoothing * (value - old)
+
+    def record(self, cls, images, seconds):
+        """A task of class cls rendered images in seconds of webui time"""
+        if images <= 0 or seconds <= 0:
+            return
+        with self.lock:
+            self.per_image[cls] = self._average(self.per_image.get(cls), seconds / images)
+            self.per_task[cls] = self._average(self.per_task.get(cls), seconds)
+            for other in self.mix:
+                self.mix[other] *= 1 - self.smoothing
+            self.mix[cls] = self.mix.get(cls, 0) + (self.smoothing if self.mix else 1)
+
+    def images_per_second(self):
+        with self.lock:
+            return {cls: 1 / seconds for cls, seconds in self.per_image.items()}
+
+    def seconds_per_task(self, cls=None):
+        """Rolling webui seconds per task of class cls, of the recent mix if cls is None or unseen
+
+        The configured default before the first task.
+        """
+        with self.lock:
+            if cls in self.per_task:
+                return self.per_task[cls]
+            total = sum(self.mix.values())
+            if not total:
+                return self.default_seconds_per_task
+            return sum(share * self.per_task[c] for c, share in self.mix.items()) / total
+
+
+class PrometheusSink:
+    """Serves the signal on /metrics"""
+    def __init__(self):
+        self.values = {}
+        metrics.scaling.set_function(lambda: self.values.get('BacklogSecondsPerInstance'), 'backlog_seconds_per_instance')
+        metrics.scaling.set_function(lambda: self.values.get('SecondsPerTask'), 'seconds_per_task')
+        metrics.scaling.set_function(lambda: self.values.get('InServiceInstances'), 'instances')
+
+    def publish(self, values, dimensions):
+        self.values = values
+
+
+class CloudWatchSink:
+    """put_metric_data to the namespace, one call per publish"""
+    def publish(self, values, dimensions):
+        clients.client('cloudwatch').put_metric_data(
+            Namespace=namespace,
+            MetricData=[{
+                'MetricName': name,
+                'Dimensions': [{'Name': k, 'Value': v} for k, v in dimensions.items()],
+                'Value': value,
+                'Unit': 'Seconds' if 'Seconds' in name else 'Count',
+            } for name, value in values.items()]
+        )
+
+
+class EmfSink:
+    """CloudWatch embedded metric format line on stdout, extracted by CloudWatch Logs"""
+    def publish(self, values, dimensions):
+        line = {
+            "_aws": {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [{
+                    "Namespace": namespace,
+                    "Dimensions": [list(dimensions)],
+                    "Metrics": [{"Name": name, "Unit": "Seconds" if "Seconds" in name else "Count"} for name in values],
+                }],
+            },
+        }
+        line.update(dimensions)
+        line.update(values)
+        print(json.dumps(line), flush=True)
+
+
+# sink 名称 -> 类, 可以注册新的 sink
+sinks = {
+    "prometheus": PrometheusSink,
+    "cloudwatch": CloudWatchSink,
+    "emf": EmfSink,
+}
+
+
+class ScalingSignal:
+    """Publishes the seconds of queued work per instance as a scaling metric
+
+    Raw queue depth treats a 512px txt2img and a hires batch alike. This signal
+    prices the tasks this instance has prefetched by the seconds per task of
+    their class and the other visible and in flight messages by the seconds per
+    task of the recent class mix. The sum is divided by the webuis in service,
+    the instances times the backends each runs, so a target tracking policy on
+    it scales out as soon as the queue would take longer than the latency
+    objective to drain, whatever the task mix and GPUs per instance.
+    pending() returns the tasks waiting in this instance's buffer.
+    """
+    def __init__(self, poller, estimator, instance_id=lambda: None, sink_names=('prometheus',), interval=60,
+                 backends=1, pending=lambda: []):
+        self.poller = poller
+        self.estimator = estimator
+        self.instance_id = instance_id
+        self.backends = max(backends, 1)
+        self.pending = pending
+        self.interval = interval
+        self.sinks = [sinks[name]() for name in sink_names]
+        self.group = None
+        self.instances = (0, 1)
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.running = False
+
+    def _group(self):
+        """Auto Scaling group of this instance, None when not in one"""
+        instance_id = self.instance_id()
+        if self.group is None and instance_id:
+            response = clients.client('autoscaling').describe_auto_scaling_instances(InstanceIds=[instance_id])
+            instances = response.get('AutoScalingInstances', [])
+            self.group = instances[0]['AutoScalingGroupName'] if instances else ''
+        return self.group or None
+
+    def _in_service(self):
+        """Instances in service in our group, cached for the publish interval"""
+        checked, count = self.instances
+        group = self._group()
+        if group and time.time() - checked > self.interval:
+            response = clients.client('autoscaling').describe_auto_scaling_groups(AutoScalingGroupNames=[group])
+            members = response['AutoScalingGroups'][0]['Instances'] if response['AutoScalingGroups'] else []
+            count = max(sum(1 for i in members if i['LifecycleState'] == 'InService'), 1)
+            self.instances = (time.time(), count)
+        return count
+
+    def _queue_depth(self):
+        """Messages waiting or being processed in all queues"""
+        depth = 0
+        for q in self.poller.queues:
+            response = self.poller.sqs_client.get_queue_attributes(
+                QueueUrl=q.url,
+                AttributeNames=['ApproximateNumberOfMessages', 'ApproximateNumberOfMessagesNotVisible']
+            )
+            depth += sum(int(v) for v in response['Attributes'].values())
+        return depth
+
+    def compute(self):
+        """Current signal values"""
+        seconds_per_task = self.estimator.seconds_per_task()
+        # prefetched and running tasks are invisible but still work to do
+        backlog = self._queue_depth()
+        known = [self.estimator.seconds_per_task(task_class(task)) for task in self.pending()]
+        seconds = sum(known) + max(backlog - len(known), 0) * seconds_per_task
+        instances = self._in_service()
+        return {
+            "BacklogSecondsPerInstance": seconds / (instances * self.backends),
+            "SecondsPerTask": seconds_per_task,
+            "BacklogMessages": backlog,
+            "InServiceInstances": instances,
+            "WebuisPerInstance": self.backends,
+        }
+
+    def publish(self):
+        values = self.compute()
+        for cls in self.estimator.images_per_second():
+            metrics.throughput.set_function(lambda cls=cls: self.estimator.images_per_second().get(cls), cls)
+        group = self._group()
+        dimensions = {"AutoScalingGroupName": group} if group else {"Host": socket.gethostname()}
+        for sink in self.sinks:
+            try:
+                sink.publish(values, dimensions)
+            except Exception as e:
+                logger.error(f"Failed to publish scaling signal to {sink.__class__.__name__}: {e}")
+        logger.info(f"Backlog {values['BacklogMessages']} tasks, {values['SecondsPerTask']:.1f}s per task, "
+                    f"{values['BacklogSecondsPerInstance']:.0f}s per instance over {values['InServiceInstances']} instances")
+
+    def _loop(self):
+        while self.running:
+            try:
+                self.publish()
+            except Exception as e:
+                logger.error(f"Error publishing scaling signal: {e}")
+            self.wakeup.wait(self.interval)
+
+    def start(self):
+        if not self.running:
+            self.running = True
+            self.thread = threading.Thread(target=self._loop)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self):
+        if self.running:
+            self.running = False
+            self.wakeup.set()
+            if self.thread:
+                self.thread.join(timeout=5)
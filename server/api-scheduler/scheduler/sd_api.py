@@ -1,48 +1,155 @@
 import json
-import requests
-import io
-import base64
-from PIL import Image, PngImagePlugin
+import os
+from concurrent.futures import ThreadPoolExecutor
 
-import scheduler.sd_s3 as sd_s3
+import scheduler.encoding as encoding
+import scheduler.streaming as streaming
+import scheduler.clients as clients
+import scheduler.failures as failures
+import scheduler.metrics as metrics
+from scheduler.conf import schedulerConfig
 
-# webui_api_url
+# webui_api_url, 默认的 webui; 多个 webui 在 [webui] endpoints 中配置
 webui_api_url = "http://127.0.0.1:7860"
 
-def process_sd_request(taskId, taskInfo):
-    task = json.loads(taskInfo)
-    res = call_simple_api(task["api"], task["payload"], f"sd/out/{taskId}")
-    return res
+# 图片解码和上传S3的并发数, 所有任务共享
+upload_concurrency = schedulerConfig.getint('scheduler', 'upload_concurrency', fallback=8)
+upload_pool = ThreadPoolExecutor(max_workers=upload_concurrency, thread_name_prefix='s3-upload')
 
-def call_simple_api(api, payload, imagekey):
-    imageList = []
-    res = {"cnt":0, "images":[], "error": ""}
-    cnt = 0
+def get_options(url=None):
+    """Current webui settings, including the loaded sd_model_checkpoint and sd_vae"""
+    response = clients.http_session('webui').get(url=f'{url or webui_api_url}/sdapi/v1/options', timeout=(5, 30))
+    response.raise_for_status()
+    return response.json()
+
+def set_options(options, url=None):
+    """Change webui settings, setting sd_model_checkpoint loads that checkpoint"""
+    response = clients.http_session('webui').post(url=f'{url or webui_api_url}/sdapi/v1/options', json=options, timeout=(5, None))
+    response.raise_for_status()
+
+def get_progress(skip_current_image=True, url=None):
+    """Progress of the running inference: progress 0-1, eta_relative, state and current_image"""
+    response = clients.http_session('webui').get(
+        url=f'{url or webui_api_url}/sdapi/v1/progress',
+        params={"skip_current_image": "true" if skip_current_image else "false"},
+        timeout=(2, 10)
+    )
+    response.raise_for_status()
+    return response.json()
+
+def output_key(taskId):
+    """S3 key prefix of the images generated for a task"""
+    return f"sd/out/{taskId}"
+
+def parse_task(taskInfo):
+    """Parse the requestData stored with a task into {"api", "payload"}
+
+    Raises failures.PermanentError if it isn't a JSON object with an "api"
+    string and a "payload" object, or its "output" options are invalid; no
+    delivery of the task can run it.
+    """
+    try:
+        task = json.loads(taskInfo)
+    except (TypeError, ValueError) as e:
+        raise failures.PermanentError(f"requestData is not JSON: {e}") from e
+    if not isinstance(task, dict) or not isinstance(task.get("api"), str) or not isinstance(task.get("payload"), dict):
+        raise failures.PermanentError("requestData needs an \"api\" string and a \"payload\" object")
+    # checked before the GPU renders it, the post stage would fail every delivery
+    try:
+        encoding.options(task.get("output"))
+    except (TypeError, ValueError) as e:
+        raise failures.PermanentError(f"Invalid output options: {e}") from e
+    return task
+
+def call_webui(api, payload, url=None, trace=None):
+    """Run one inference on the webui at url (the default webui if None) and return the parsed response
+
+    The response is parsed as it arrives and its images are decoded straight to
+    disk, so "images" holds streaming.SpooledImage objects instead of base64
+    strings. encode_files() takes them over, release_images() removes the ones
+    not encoded.
+    Error responses raise failures.TransientError or failures.PermanentError.
+    The decode time is stored in trace["decode"] if a dict is given.
+    """
+    response = clients.http_session('webui').post(url=f'{url or webui_api_url}{api}', json=payload,
+                                                  timeout=(5, None), stream=True)
+    with response:
+        if response.status_code >= 400:
+            raise failures.webui_error(response)
+        return streaming.parse_response(response.iter_content(streaming.chunk_size), trace)
+
+def release_images(images):
+    """Remove spooled images that won't be uploaded"""
+    for image in images or []:
+        image.close()
+
+def infotexts(response):
+    """Generation parameters of each image in a webui response, None if not reported"""
+    try:
+        texts = json.loads(response.get('info') or '{}').get('infotexts')
+    except (TypeError, ValueError, AttributeError):
+        return None
+    images = response.get('images') or []
+    if not texts:
+        return None
+    # the grid image of a batch has its own infotext in front
+    if len(texts) == len(images) + 1:
+        texts = texts[1:]
+    return texts if len(texts) == len(images) else None
+
+def _encode_files(image, imagekey, cnt, opts, infotext):
+    """Files to upload for one spooled image, its own file and the re-encoded renditions"""
+    files = []
     try:
-        # save png info only
-        response = requests.post(url=f'{webui_api_url}{api}', json=payload)
-        r = response.json()
-        for i in r['images']:
-            imageBody = base64.b64decode(i.split(",",1)[0])
-            cnt = cnt + 1
-            imagePath = f"{imagekey}-{cnt}.png"
-            uri = sd_s3.put_object_to_s3(imagePath, imageBody, 'image/png')
-            imageList.append(uri)
-
-            #image = Image.open(io.BytesIO(base64.b64decode(i.split(",",1)[0])))
-            #png_payload = {
-            #    "image": "data:image/png;base64," + i
-            #}
-            #response2 = requests.post(url=f'{webui_api_url}/sdapi/v1/png-info', json=png_payload)
-            #pnginfo = PngImagePlugin.PngInfo()
-            #pnginfo.add_text("parameters", response2.json().get("info"))
-            #image.save('output.png', pnginfo=pnginfo)
-        res["cnt"] = cnt
-        res["images"] = imageList
-    except Exception as e:
-        res["error"] = f"{e}"
-
-    return res
+        with metrics.stage('encode'):
+            renditions = encoding.renditions(image, opts, infotext)
+        for suffix, ext, body, contentType in renditions:
+            files.append({
+                "path": image.path if body is image else streaming.spool(body).path,
+                "key": f"{imagekey}-{cnt}{suffix}.{ext}",
+                "content_type": contentType,
+                "image": cnt,
+                "thumbnail": int(suffix[1:]) if suffix else None,
+            })
+        if all(f["path"] != image.path for f in files):
+            # re-encoded, the webui's png isn't uploaded
+            image.close()
+        return files
+    except Exception:
+        image.close()
+        discard_files(files)
+        raise
+
+def encode_files(images, imagekey, output=None, infotexts=None):
+    """Encode the images spooled by call_webui into the files of the output spool
+
+    Returns the files as {"path", "key", "content_type", "image", "thumbnail"}
+    for OutputSpool.add() and whether the task asked for thumbnails.
+    """
+    opts = encoding.options(output)
+    futures = []
+    for cnt, image in enumerate(images, 1):
+        infotext = infotexts[cnt - 1] if infotexts else None
+        futures.append(upload_pool.submit(_encode_files, image, imagekey, cnt, opts, infotext))
+    files = []
+    error = None
+    for future in futures:
+        try:
+            files += future.result()
+        except Exception as e:
+            error = error or e
+    if error is not None:
+        discard_files(files)
+        raise error
+    return files, bool(opts["thumbnails"])
+
+def discard_files(files):
+    """Remove encoded files that won't be spooled"""
+    for f in files:
+        try:
+            os.remove(f["path"])
+        except FileNotFoundError:
+            pass
 
 if __name__ == "__main__":
     api = '/sdapi/v1/txt2img'
@@ -54,5 +161,7 @@ if __name__ == "__main__":
 
     # in local machine test mode change webui api url
     webui_api_url = "{your webui url}"
-    res = process_sd_request(api, payload, imageKey)
-    print(res)
\ No newline at end of file
+    response = call_webui(api, payload)
+    files, thumbnails = encode_files(response['images'], imageKey, None, infotexts(response))
+    print(files)
+    discard_files(files)
@@ -1,30 +1,201 @@
-import boto3
 import os
 import json
+import time
+import logging
 from datetime import datetime
 
 from scheduler.conf import schedulerConfig
+import scheduler.clients as clients
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger('sd_dynamodb')
 
 table_name = schedulerConfig.get('aws', 'dynamodb_table_name')
 os.environ['AWS_DEFAULT_REGION'] = schedulerConfig.get('aws', 'region')
 
-def finishTask(taskId, processRes):
-    dynamodb = boto3.client('dynamodb')
-    response = dynamodb.update_item(
-        TableName=table_name,
-        Key={ 'taskId': {'S': taskId} },
-        UpdateExpression="SET taskStatus = :val1, processRes = :val2, processTime = :val3",
-        ExpressionAttributeValues={
-            ':val1': {'S': 'finished'},
-            ':val2': {'S': json.dumps(processRes)},
-            ':val3': {'S': datetime.now().isoformat()},
-        },
-        ReturnValues="UPDATED_NEW"  # 返回更新后的值
-    )
-    return response
+def _timing_values(timings):
+    """DynamoDB map of timing fields in seconds"""
+    return {'M': {k: {'N': str(round(v, 3))} for k, v in timings.items()}}
+
+# 任务仍未完成且不属于其他实例时才能写入最终状态; 租约过期后被其他实例认领的任务不再由本实例写入
+OWNED_CONDITION = ("attribute_exists(taskId) AND NOT taskStatus IN (:finished, :failed) "
+                   "AND (attribute_not_exists(taskOwner) OR taskOwner = :owner)")
+
+def finishTask(taskId, owner, processRes, timings=None):
+    """Record the result of a task, unless it finished, failed or another worker owns it
+
+    Returns False if the condition did not hold.
+    """
+    dynamodb = clients.client('dynamodb')
+    expression = "SET taskStatus = :val1, processRes = :val2, processTime = :val3"
+    values = {
+        ':val1': {'S': 'finished'},
+        ':val2': {'S': json.dumps(processRes)},
+        ':val3': {'S': datetime.now().isoformat()},
+        ':finished': {'S': 'finished'},
+        ':failed': {'S': 'failed'},
+        ':owner': {'S': owner},
+    }
+    # 排队、推理、上传等阶段耗时(秒), 用于分析
+    if timings:
+        expression += ", timings = :timings"
+        values[':timings'] = _timing_values(timings)
+    try:
+        dynamodb.update_item(
+            TableName=table_name,
+            Key={ 'taskId': {'S': taskId} },
+            UpdateExpression=expression + " REMOVE errorMessage",
+            ConditionExpression=OWNED_CONDITION,
+            ExpressionAttributeValues=values
+        )
+        return True
+    except dynamodb.exceptions.ConditionalCheckFailedException:
+        return False
+
+def failTask(taskId, owner, error, timings=None):
+    """Record that a task failed for good, unless it finished, failed or another worker owns it
+
+    taskStatus = failed is final, later deliveries of the task are not claimed.
+    Returns False if the condition did not hold.
+    """
+    return _recordError(taskId, owner, error, timings, 'failed')
+
+def retryTask(taskId, owner, error, timings=None):
+    """Record a failed attempt and put the task back to waiting for its next delivery
+
+    Returns False if the task finished, failed or another worker owns it.
+    """
+    return _recordError(taskId, owner, error, timings, 'waiting')
+
+def _recordError(taskId, owner, error, timings, status):
+    dynamodb = clients.client('dynamodb')
+    expression = "SET taskStatus = :status, errorMessage = :error, processTime = :time ADD attempts :one"
+    values = {
+        ':status': {'S': status},
+        ':finished': {'S': 'finished'},
+        ':failed': {'S': 'failed'},
+        ':error': {'S': str(error)[:1000]},
+        ':time': {'S': datetime.now().isoformat()},
+        ':one': {'N': '1'},
+        ':owner': {'S': owner},
+    }
+    if timings:
+        expression = expression.replace(" ADD", ", timings = :timings ADD")
+        values[':timings'] = _timing_values(timings)
+    try:
+        dynamodb.update_item(
+            TableName=table_name,
+            Key={ 'taskId': {'S': taskId} },
+            UpdateExpression=expression + " REMOVE taskOwner, leaseUntil",
+            ConditionExpression=OWNED_CONDITION,
+            ExpressionAttributeValues=values
+        )
+        return True
+    except dynamodb.exceptions.ConditionalCheckFailedException:
+        return False
+
+def claimTask(taskId, owner, leaseSeconds):
+    """Mark a task as processing by owner for leaseSeconds
+
+    The conditional update only succeeds while the task is waiting, already ours,
+    or its previous owner's lease ran out, so a duplicate SQS delivery of a task
+    that is running elsewhere, finished or failed is skipped instead of rendered again.
+    """
+    dynamodb = clients.client('dynamodb')
+    now = int(time.time())
+    try:
+        dynamodb.update_item(
+            TableName=table_name,
+            Key={ 'taskId': {'S': taskId} },
+            UpdateExpression="SET taskStatus = :processing, taskOwner = :owner, leaseUntil = :lease, startTime = :start",
+            ConditionExpression="attribute_not_exists(taskStatus) OR taskStatus = :waiting "
+                                "OR (taskStatus = :processing AND (taskOwner = :owner OR leaseUntil < :now))",
+            ExpressionAttributeValues={
+                ':processing': {'S': 'processing'},
+                ':waiting': {'S': 'waiting'},
+                ':owner': {'S': owner},
+                ':lease': {'N': str(now + leaseSeconds)},
+                ':now': {'N': str(now)},
+                ':start': {'S': datetime.now().isoformat()},
+            },
+            ReturnValuesOnConditionCheckFailure='ALL_OLD'
+        )
+        return {"claimed": True, "taskStatus": "processing"}
+    except dynamodb.exceptions.ConditionalCheckFailedException as e:
+        item = e.response.get('Item', {})
+        return {"claimed": False, "taskStatus": item.get('taskStatus', {}).get('S')}
+
+def renewLease(taskId, owner, leaseSeconds):
+    """Extend the lease of a task we are still processing, return False if we lost it"""
+    dynamodb = clients.client('dynamodb')
+    try:
+        dynamodb.update_item(
+            TableName=table_name,
+            Key={ 'taskId': {'S': taskId} },
+            UpdateExpression="SET leaseUntil = :lease",
+            ConditionExpression="taskStatus = :processing AND taskOwner = :owner",
+            ExpressionAttributeValues={
+                ':processing': {'S': 'processing'},
+                ':owner': {'S': owner},
+                ':lease': {'N': str(int(time.time()) + leaseSeconds)},
+            }
+        )
+        return True
+    except dynamodb.exceptions.ConditionalCheckFailedException:
+        return False
+
+def releaseTask(taskId, owner):
+    """Put a task we failed to process back to waiting so the next delivery can claim it"""
+    dynamodb = clients.client('dynamodb')
+    try:
+        dynamodb.update_item(
+            TableName=table_name,
+            Key={ 'taskId': {'S': taskId} },
+            UpdateExpression="SET taskStatus = :waiting REMOVE taskOwner, leaseUntil",
+            ConditionExpression="taskStatus = :processing AND taskOwner = :owner",
+            ExpressionAttributeValues={
+                ':processing': {'S': 'processing'},
+                ':waiting': {'S': 'waiting'},
+                ':owner': {'S': owner},
+            }
+        )
+        return True
+    except dynamodb.exceptions.ConditionalCheckFailedException:
+        return False
+
+def updateProgress(taskId, owner, progress, eta, previewUrl=None):
+    """Record the progress of a task we are processing, ignored once it is no longer ours"""
+    dynamodb = clients.client('dynamodb')
+    expression = "SET progress = :progress, eta = :eta, progressTime = :time"
+    values = {
+        ':processing': {'S': 'processing'},
+        ':owner': {'S': owner},
+        ':progress': {'N': str(round(progress * 100, 1))},
+        ':eta': {'N': str(round(eta, 1))},
+        ':time': {'S': datetime.now().isoformat()},
+    }
+    if previewUrl:
+        expression += ", previewUrl = :preview"
+        values[':preview'] = {'S': previewUrl}
+    try:
+        dynamodb.update_item(
+            TableName=table_name,
+            Key={ 'taskId': {'S': taskId} },
+            UpdateExpression=expression,
+            ConditionExpression="taskStatus = :processing AND taskOwner = :owner",
+            ExpressionAttributeValues=values
+        )
+        return True
+    except dynamodb.exceptions.ConditionalCheckFailedException:
+        return False
+
 def getTask(taskId):
     # 初始化DynamoDB客户端
-    dynamodb = boto3.client('dynamodb')
+    dynamodb = clients.client('dynamodb')
     res = {}
 
     try :
@@ -35,7 +206,7 @@ def getTask(taskId):
             }
         )
         item = response.get('Item')
-        print(f"got item [{item}]")
+        logger.debug(f"got item [{item}]")
         if item is None:
             res = {
                 "errno":404,
@@ -45,12 +216,13 @@ def getTask(taskId):
             res = {
                 "errno":200,
                 "taskId": item['taskId']['S'],
-                "requestData":  item['requestData']['S']
+                "requestData":  item['requestData']['S'],
+                "taskStatus": item.get('taskStatus', {}).get('S')
             }
     except Exception as e:
         res = {
             "errno":500,
-            "error": f"e"
+            "error": f"{e}"
         }
     return res
     
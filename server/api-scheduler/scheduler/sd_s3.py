@@ -1,7 +1,10 @@
-import boto3
+import io
 import os
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError, NoCredentialsError
 
 from scheduler.conf import schedulerConfig
+import scheduler.clients as clients
 
 os.environ['AWS_DEFAULT_REGION'] = schedulerConfig.get('aws', 'region')
 
@@ -9,17 +12,56 @@ bucket_name = schedulerConfig.get('aws', 'bucket_name')  # 替换为您的S3桶
 # 替换为您的cloudfront host 需要配置好s3回援
 cloudfront = schedulerConfig.get('aws', 'cloudfront')
 
-s3 = boto3.client('s3')
+# 超过阈值的对象使用分片并发上传
+MB = 1024 * 1024
+multipart_threshold = schedulerConfig.getint('aws', 's3_multipart_threshold_mb', fallback=8) * MB
+transfer_config = TransferConfig(
+    multipart_threshold=multipart_threshold,
+    multipart_chunksize=multipart_threshold,
+    max_concurrency=4
+)
+
+def upload_file_to_s3(key, path, content_type):
+    """Upload a file, in parts above the multipart threshold, return its uri; raises on failure"""
+    if os.path.getsize(path) < multipart_threshold:
+        with open(path, 'rb') as f:
+            clients.client('s3').put_object(
+                Bucket=bucket_name,
+                Key=key,
+                Body=f,
+                ContentType=content_type
+            )
+    else:
+        clients.client('s3').upload_file(
+            path,
+            bucket_name,
+            key,
+            ExtraArgs={'ContentType': content_type},
+            Config=transfer_config
+        )
+    return f"{cloudfront}{key}"
 
 def put_object_to_s3(key, data, content_type):
+    """Upload bytes, or the file of a spooled image read from disk in parts, return the uri or False"""
     try:
-        # Put the object
-        s3.put_object(
-            Bucket=bucket_name,
-            Key=key,
-            Body=data,
-            ContentType=content_type
-        )
+        if hasattr(data, 'path'):
+            upload_file_to_s3(key, data.path, content_type)
+        elif len(data) < multipart_threshold:
+            # Put the object
+            clients.client('s3').put_object(
+                Bucket=bucket_name,
+                Key=key,
+                Body=data,
+                ContentType=content_type
+            )
+        else:
+            clients.client('s3').upload_fileobj(
+                io.BytesIO(data),
+                bucket_name,
+                key,
+                ExtraArgs={'ContentType': content_type},
+                Config=transfer_config
+            )
         print(f"Successfully put object {key} in bucket {bucket_name}.")
         uri = f"{cloudfront}{key}"
         return uri
@@ -27,13 +69,35 @@ def put_object_to_s3(key, data, content_type):
         print("put object exception", e)
         return False
 
+def get_object_from_s3(key):
+    """Read an object from the bucket, return None if it does not exist"""
+    try:
+        response = clients.client('s3').get_object(Bucket=bucket_name, Key=key)
+        return response['Body'].read()
+    except clients.client('s3').exceptions.NoSuchKey:
+        return None
+
+def get_object_if_changed(bucket, key, etag=None):
+    """Read an object unless its ETag is still etag, return (data or None, etag)"""
+    s3 = clients.client('s3')
+    try:
+        if etag:
+            response = s3.get_object(Bucket=bucket, Key=key, IfNoneMatch=etag)
+        else:
+            response = s3.get_object(Bucket=bucket, Key=key)
+        return response['Body'].read(), response['ETag']
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') in ('304', 'NotModified'):
+            return None, etag
+        raise
+
 def put_file_to_s3(file_name, bucket, object_name):
     # 如果S3 object_name未指定，则使用file_name作为默认值
     if object_name is None:
         object_name = file_name
 
     try:
-        s3.upload_file(file_name, bucket, object_name)
+        clients.client('s3').upload_file(file_name, bucket, object_name)
         print(f"Upload successful: {file_name} to {bucket}/{object_name}")
         return True
     except FileNotFoundError:
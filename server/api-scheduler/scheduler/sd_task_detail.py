@@ -1,16 +1,61 @@
 import json
+import scheduler.failures as failures
 import scheduler.sd_dynamodb as sd_dynamodb
+import scheduler.sd_s3 as sd_s3
 
-def get(message):
-    info = json.loads(message)
-    dbRet = None
-    # storage 如果是dynamodb 从dynamodb获取数据
-    if info["storage"] == "dynamodb":
-        dbRet = sd_dynamodb.getTask(info["taskId"])
+# storage 名称 -> 读取任务详情的函数, 参数为解析后的 SQS 消息
+# 返回 {"errno", "taskId", "requestData", "taskStatus"} 或 {"errno", "error"}
+storages = {}
+
+def register(name):
+    """Register a loader for the task details of messages with storage == name"""
+    def decorator(loader):
+        storages[name] = loader
+        return loader
+    return decorator
+
+@register("dynamodb")
+def from_dynamodb(info):
+    return sd_dynamodb.getTask(info["taskId"])
 
-    return dbRet
+@register("inline")
+def from_inline(info):
+    # 小请求直接放在消息中, 不需要读取 dynamodb
+    requestData = info.get("requestData")
+    if requestData is None:
+        return {"errno": 400, "error": f"inline message of task [{info['taskId']}] has no requestData"}
+    if not isinstance(requestData, str):
+        requestData = json.dumps(requestData)
+    return {"errno": 200, "taskId": info["taskId"], "requestData": requestData, "taskStatus": None}
+
+@register("s3")
+def from_s3(info):
+    # 大请求保存在 s3, 消息中只有 key (和可选的 bucket)
+    try:
+        if info.get("bucket"):
+            data = sd_s3.get_object_if_changed(info["bucket"], info["key"])[0]
+        else:
+            data = sd_s3.get_object_from_s3(info["key"])
+    except Exception as e:
+        return {"errno": 500, "error": f"{e}"}
+    if data is None:
+        return {"errno": 404, "error": f"no request at [{info['key']}]"}
+    return {"errno": 200, "taskId": info["taskId"], "requestData": data.decode(), "taskStatus": None}
+
+def get(message):
+    """Task details of an SQS message body, raises failures.PermanentError if the body is malformed"""
+    try:
+        info = json.loads(message)
+    except (TypeError, ValueError) as e:
+        raise failures.PermanentError(f"message is not JSON: {e}") from e
+    if not isinstance(info, dict) or not info.get("taskId"):
+        raise failures.PermanentError("message has no taskId")
+    loader = storages.get(info.get("storage", "dynamodb"))
+    if loader is None:
+        return {"errno": 400, "error": f"unknown storage [{info.get('storage')}]"}
+    return loader(info)
 
 if __name__ == "__main__":
     message = '{"storage": "dynamodb", "taskId": "e0185dde-3814-4ce5-9c22-c9a318d19e0b" }'
     dbRet = get(message)
-    print(f"got detail[{dbRet}]")
\ No newline at end of file
+    print(f"got detail[{dbRet}]")
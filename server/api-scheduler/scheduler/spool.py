@@ -0,0 +1,389 @@
+import heapq
+import json
+import os
+import threading
+import time
+import uuid
+import logging
+
+import scheduler.sd_s3 as sd_s3
+import scheduler.sd_api as sd_api
+import scheduler.streaming as streaming
+import scheduler.metrics as metrics
+from scheduler.conf import schedulerConfig
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger('spool')
+
+# 生成的图片先写入本地 spool 目录并记录日志, 由后台线程上传到 S3; S3 变慢或不可用时图片在本地堆积, 重启后继续上传
+# spool 中等待上传的图片总大小上限(MB), 超过后处理线程等待, 推理随之放慢
+spool_max_mb = schedulerConfig.getint('output', 'spool_max_mb', fallback=4096)
+# 上传失败后第 n 次重试前等待 upload_backoff * 2^(n-1) 秒, 最多 upload_backoff_max 秒
+upload_backoff = schedulerConfig.getfloat('output', 'upload_backoff', fallback=1)
+upload_backoff_max = schedulerConfig.getfloat('output', 'upload_backoff_max', fallback=60)
+# 一个文件上传失败这么多次后放弃该任务, 任务按瞬时错误重试
+upload_attempts = schedulerConfig.getint('output', 'upload_attempts', fallback=20)
+# 停止时最多等待多少秒让 spool 中的图片上传完, 剩下的在下次启动后继续上传
+drain_timeout = schedulerConfig.getint('output', 'upload_drain', fallback=30)
+
+
+class SpoolRecord:
+    """The output files of one task in the spool and what to do with them once uploaded
+
+    files is a list of {"name", "key", "content_type", "image", "thumbnail", "size"}
+    with "uri" set once uploaded; context is the pipeline state needed to finish
+    the task, including after a restart. Once every file is uploaded the files
+    are removed and res is kept in the journal until remove().
+    """
+    def __init__(self, id, files, thumbnails, context, created=None, res=None):
+        self.id = id
+        self.files = files
+        self.thumbnails = thumbnails
+        self.context = context
+        self.created = created or time.time()
+        self.res = res
+        self.remaining = sum(1 for f in files if not f.get("uri"))
+        self.failed = False
+        # set by add() or the resume callback, not persisted
+        self.on_uploaded = None
+        self.on_failed = None
+
+    def to_json(self):
+        return {
+            "id": self.id,
+            "created": self.created,
+            "files": self.files,
+            "thumbnails": self.thumbnails,
+            "context": self.context,
+            "res": self.res,
+        }
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(data["id"], data["files"], data["thumbnails"], data["context"], data["created"], data.get("res"))
+
+    def result(self):
+        """processRes of the uploaded files: the uri of each image in order and, if asked for, its thumbnails"""
+        count = max((f["image"] for f in self.files), default=0)
+        images = [None] * count
+        thumbnails = [{} for _ in range(count)]
+        for f in self.files:
+            if f["thumbnail"]:
+                thumbnails[f["image"] - 1][str(f["thumbnail"])] = f["uri"]
+            else:
+                images[f["image"] - 1] = f["uri"]
+        res = {"cnt": count, "images": images, "error": ""}
+        if self.thumbnails:
+            res["thumbnails"] = thumbnails
+        return res
+
+
+class OutputSpool:
+    """Bounded on-disk spool of rendered images waiting for their S3 upload
+
+    add() moves the files of a task under directory/files and writes a journal
+    record to directory/journal before it returns, so a render survives S3
+    outages and restarts. Uploader threads upload the files oldest first and
+    retry a failed upload with exponential backoff; after max_attempts failures
+    of one file the record is given up and on_failed(error) runs. Once every file
+    of a record is uploaded the files are removed, the record keeps the result
+    and on_uploaded(record) runs; remove(record) drops it once the task is
+    finished. start(resume) loads the records a previous run left and passes
+    each to resume(record), which sets its callbacks. add() blocks while the
+    files in the spool exceed max_bytes.
+    """
+    def __init__(self, directory, max_bytes, workers=8, backoff=1, max_backoff=60, max_attempts=20):
+        self.directory = directory
+        self.files_dir = os.path.join(directory, 'files')
+        self.journal_dir = os.path.join(directory, 'journal')
+        self.max_bytes = max_bytes
+        self.workers = workers
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_attempts = max_attempts
+        self.records = {}
+        self.bytes = 0
+        # (due time, sequence, record, file) of the uploads to run
+        self.uploads = []
+        self.sequence = 0
+        self.active = 0
+        self.cond = threading.Condition()
+        self.threads = []
+        self.running = False
+        self.stats = {"uploaded": 0, "retries": 0, "given_up": 0, "resumed": 0}
+        os.makedirs(self.files_dir, exist_ok=True)
+        os.makedirs(self.journal_dir, exist_ok=True)
+
+    def __len__(self):
+        with self.cond:
+            return len(self.records)
+
+    def _journal_path(self, record):
+        return os.path.join(self.journal_dir, f"{record.id}.json")
+
+    def _write_journal(self, record):
+        path = self._journal_path(record)
+        tmp = f"{path}.tmp"
+        with open(tmp, 'w') as f:
+            json.dump(record.to_json(), f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+    def add(self, name, files, thumbnails, context, on_uploaded, on_failed):
+        """Spool the files of a task and queue their uploads
+
+        files is a list of {"path", "key", "content_type", "image", "thumbnail"},
+        the paths are moved into the spool. Returns the record.
+        """
+        size = sum(os.path.getsize(f["path"]) for f in files)
+        with self.cond:
+            # a record larger than the spool still goes in when the spool is empty
+            while self.bytes and self.bytes + size > self.max_bytes:
+                self.cond.wait()
+            self.bytes += size
+        record = SpoolRecord(f"{name}-{uuid.uuid4().hex[:8]}", [], thumbnails, context)
+        try:
+            for n, f in enumerate(files, 1):
+                file_name = f"{record.id}-{n}"
+                os.replace(f["path"], os.path.join(self.files_dir, file_name))
+                record.files.append({
+                    "name": file_name,
+                    "key": f["key"],
+                    "content_type": f["content_type"],
+                    "image": f["image"],
+                    "thumbnail": f["thumbnail"],
+                    "size": os.path.getsize(os.path.join(self.files_dir, file_name)),
+                })
+            self._write_journal(record)
+        except Exception:
+            paths = [os.path.join(self.files_dir, f["name"]) for f in record.files]
+            for path in paths + [f["path"] for f in files]:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            with self.cond:
+                self.bytes -= size
+                self.cond.notify_all()
+            raise
+        record.remaining = len(record.files)
+        record.on_uploaded = on_uploaded
+        record.on_failed = on_failed
+        self._queue(record)
+        return record
+
+    def _queue(self, record):
+        with self.cond:
+            self.records[record.id] = record
+            if record.remaining == 0:
+                # every file was uploaded before a restart
+                threading.Thread(target=self._uploaded, args=(record,), daemon=True).start()
+                return
+            for f in record.files:
+                if not f.get("uri"):
+                    self._push(0, record, f)
+            self.cond.notify_all()
+
+    def _push(self, due, record, f):
+        self.sequence += 1
+        heapq.heappush(self.uploads, (due, self.sequence, record, f))
+
+    def _next(self):
+        """Wait for the next due upload, None once stopped"""
+        with self.cond:
+            while True:
+                if not self.running:
+                    return None
+                now = time.time()
+                if self.uploads and self.uploads[0][0] <= now:
+                    _, _, record, f = heapq.heappop(self.uploads)
+                    if record.failed:
+                        continue
+                    self.active += 1
+                    return record, f
+                self.cond.wait(self.uploads[0][0] - now if self.uploads else 1)
+
+    def _loop(self):
+        while True:
+            item = self._next()
+            if item is None:
+                return
+            record, f = item
+            try:
+                self._upload(record, f)
+            finally:
+                with self.cond:
+                    self.active -= 1
+                    self.cond.notify_all()
+
+    def _upload(self, record, f):
+        path = os.path.join(self.files_dir, f["name"])
+        try:
+            with metrics.stage('s3_upload'):
+                f["uri"] = sd_s3.upload_file_to_s3(f["key"], path, f["content_type"])
+        except Exception as e:
+            f["attempts"] = f.get("attempts", 0) + 1
+            metrics.errors_total.labels('s3_upload').inc()
+            if f["attempts"] >= self.max_attempts:
+                self._give_up(record, e)
+                return
+            delay = min(self.backoff * 2 ** (f["attempts"] - 1), self.max_backoff)
+            self.stats["retries"] += 1
+            logger.warning(f"Upload of {f['key']} failed ({e}), retrying in {delay:.1f}s")
+            with self.cond:
+                self._push(time.time() + delay, record, f)
+                self.cond.notify_all()
+            return
+        with self.cond:
+            self.stats["uploaded"] += 1
+            record.remaining -= 1
+            done = record.remaining == 0 and not record.failed
+        if done:
+            self._uploaded(record)
+
+    def _uploaded(self, record):
+        """Every file of record is in S3: keep only the result and run on_uploaded"""
+        if record.res is None:
+            record.res = record.result()
+            try:
+                self._write_journal(record)
+            except Exception as e:
+                # the next start uploads the files again
+                logger.error(f"Failed to journal the upload of {record.id}: {e}")
+        self._delete_files(record)
+        self._callback(record.on_uploaded, record)
+
+    def _give_up(self, record, error):
+        with self.cond:
+            if record.failed:
+                return
+            record.failed = True
+            self.stats["given_up"] += 1
+        logger.error(f"Giving up on the upload of {record.id}: {error}")
+        self.remove(record)
+        self._callback(record.on_failed, error)
+
+    def _callback(self, fn, arg):
+        if fn is None:
+            return
+        try:
+            fn(arg)
+        except Exception as e:
+            logger.error(f"Spool callback error: {e}")
+
+    def _delete_files(self, record):
+        freed = 0
+        for f in record.files:
+            path = os.path.join(self.files_dir, f["name"])
+            try:
+                freed += os.path.getsize(path)
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        with self.cond:
+            self.bytes -= freed
+            self.cond.notify_all()
+
+    def remove(self, record):
+        """Drop a record and whatever is left of its files, once its task is finished or given up"""
+        self._delete_files(record)
+        with self.cond:
+            self.records.pop(record.id, None)
+            self.cond.notify_all()
+        try:
+            os.remove(self._journal_path(record))
+        except FileNotFoundError:
+            pass
+
+    def _load(self):
+        """Records of a previous run, oldest first, with the size of their files counted"""
+        records = []
+        for name in os.listdir(self.journal_dir):
+            path = os.path.join(self.journal_dir, name)
+            if name.endswith('.tmp'):
+                os.remove(path)
+                continue
+            try:
+                with open(path) as f:
+                    records.append(SpoolRecord.from_json(json.load(f)))
+            except (OSError, ValueError, KeyError) as e:
+                logger.error(f"Dropping unreadable spool record {name}: {e}")
+                os.remove(path)
+        known = set()
+        for record in records:
+            for f in record.files:
+                known.add(f["name"])
+                path = os.path.join(self.files_dir, f["name"])
+                if os.path.exists(path):
+                    self.bytes += os.path.getsize(path)
+                elif not f.get("uri") and record.res is None:
+                    logger.error(f"Spooled file {f['name']} of {record.id} is missing")
+                    record.failed = True
+        # files of a record whose journal write didn't finish
+        for name in os.listdir(self.files_dir):
+            if name not in known:
+                os.remove(os.path.join(self.files_dir, name))
+        return sorted(records, key=lambda r: r.created)
+
+    def start(self, resume=None):
+        """Start the uploaders, after queueing the records left by a previous run"""
+        if self.running:
+            return
+        self.running = True
+        for record in self._load():
+            if record.failed:
+                self.remove(record)
+                continue
+            self.stats["resumed"] += 1
+            if resume is not None:
+                resume(record)
+            self._queue(record)
+        if self.stats["resumed"]:
+            logger.info(f"Resuming {self.stats['resumed']} spooled tasks ({self.bytes / 1024 / 1024:.1f} MB)")
+        for _ in range(self.workers):
+            thread = threading.Thread(target=self._loop)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def drain(self, timeout):
+        """Wait until every queued upload finished or timeout seconds passed, return True if drained"""
+        deadline = time.time() + timeout
+        with self.cond:
+            while (self.uploads or self.active) and time.time() < deadline:
+                self.cond.wait(min(deadline - time.time(), 1))
+            return not self.uploads and not self.active
+
+    def stop(self):
+        """Stop the uploaders, what is still spooled is uploaded on the next start"""
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+
+# Singleton instance
+output_spool = None
+_lock = threading.Lock()
+
+def get_output_spool():
+    """The output spool under [output] spool_dir"""
+    global output_spool
+    with _lock:
+        if output_spool is None:
+            output_spool = OutputSpool(
+                streaming.spool_directory(),
+                spool_max_mb * 1024 * 1024,
+                workers=sd_api.upload_concurrency,
+                backoff=upload_backoff,
+                max_backoff=upload_backoff_max,
+                max_attempts=upload_attempts
+            )
+        return output_spool
@@ -1,9 +1,10 @@
-import boto3
 import os
 
-import scheduler.sd_api as sd_api
-import scheduler.sd_task_detail as sd_task_detail
-import scheduler.sd_dynamodb as sd_dynamodb
+import scheduler.clients as clients
+from scheduler.pipeline import Pipeline
+from scheduler.queues import QueuePoller, load_queues
+import scheduler.scaling as scaling
+import scheduler.cost_model as cost_model
 
 from scheduler.conf import schedulerConfig
 
@@ -11,55 +12,66 @@ from scheduler.conf import schedulerConfig
 os.environ['AWS_DEFAULT_REGION'] = schedulerConfig.get('aws', 'region')
 queue_url = schedulerConfig.get('aws', 'queue_url')
 
-def process_message(message_body):
-    print("Processing:", message_body)
-    task = sd_task_detail.get(message_body)
-    if task["errno"] != 200:
-        raise Exception(task["error"])
-    res = sd_api.process_sd_request(task["taskId"], task["requestData"])
-    if res['error'] == '':
-        sd_dynamodb.finishTask(task["taskId"], res)
-    else:
-        raise Exception(res['error'])
-
-    
+# pipeline 配置: 预取消息数, 同时在webui上运行的推理数, 上传/完成任务的后台线程数
+prefetch_size = schedulerConfig.getint('scheduler', 'prefetch_size', fallback=10)
+inference_workers = schedulerConfig.getint('scheduler', 'inference_workers', fallback=1)
+post_workers = schedulerConfig.getint('scheduler', 'post_workers', fallback=2)
+wait_time = schedulerConfig.getint('scheduler', 'wait_time', fallback=10)
+# 可合并为一次webui批量推理的最大图片数, 1 表示不合并
+max_batch_size = schedulerConfig.getint('scheduler', 'max_batch_size', fallback=1)
+# 消息每次延长的可见性超时(秒), 运行中的任务由心跳线程持续延长
+visibility_timeout = schedulerConfig.getint('scheduler', 'visibility_timeout', fallback=300)
+# 优先处理与webui已加载模型相同的任务, 任务最多等待 max_wait 秒
+model_affinity = schedulerConfig.getboolean('scheduler', 'model_affinity', fallback=False)
+max_wait = schedulerConfig.getint('scheduler', 'max_wait', fallback=120)
+# 多队列轮询方式: priority 按顺序严格优先, weighted 按权重
+queue_mode = schedulerConfig.get('scheduler', 'queue_mode', fallback='priority')
+# 推理进度写入任务记录, 每个任务最多每 interval 秒写一次
+report_progress = schedulerConfig.getboolean('progress', 'enabled', fallback=False)
+progress_interval = schedulerConfig.getint('progress', 'interval', fallback=10)
+progress_previews = schedulerConfig.getboolean('progress', 'previews', fallback=False)
 
 # test request {"api":"/sdapi/v1/txt2img","payload":{"prompt":"puppy dog","steps":5}}
 # sqs message  { "storage": "dynamodb", "taskId": "e0185dde-3814-4ce5-9c22-c9a318d19e0b" }
 
 
-def receiveAndProcess():
-
+def build_pipeline():
+    """Pipeline configured from conf.ini"""
     # 创建 SQS 客户端
-    sqs = boto3.client('sqs')
+    sqs = clients.client('sqs')
 
-    while True:
-        # 从 SQS 获取消息
-        response = sqs.receive_message(
-            QueueUrl=queue_url,
-            MaxNumberOfMessages=1,   # 调整为每次读取的消息数量
-            WaitTimeSeconds=10        # 使用长轮询以等待消息到来
-        )
+    poller = QueuePoller(sqs, load_queues(), mode=queue_mode, wait_time=wait_time)
+    return Pipeline(
+        sqs,
+        poller,
+        prefetch_size=prefetch_size,
+        inference_workers=inference_workers,
+        post_workers=post_workers,
+        max_batch_size=max_batch_size,
+        visibility_timeout=visibility_timeout,
+        model_affinity=model_affinity,
+        max_wait=max_wait,
+        report_progress=report_progress,
+        progress_interval=progress_interval,
+        progress_previews=progress_previews,
+        scaling_signal=scaling.enabled,
+        shortest_first=cost_model.shortest_first,
+        max_bypass=cost_model.max_bypass,
+        adaptive_visibility=cost_model.adaptive_visibility
+    )
 
-        messages = response.get('Messages')
-        if messages:
-            for message in messages:
-                try:
-                    # 处理消息
-                    process_message(message['Body'])
-                    # 从队列中 删除消息
-                    sqs.delete_message(
-                        QueueUrl=queue_url,
-                        ReceiptHandle=message['ReceiptHandle']
-                    )
-                except Exception as e:
-                    print("process message  error", e)
-        else:
-            print("No messages received. Waiting for next poll...")
+def receiveAndProcess(drainer=None):
+    """Run the pipeline, until drainer drained it if one is given"""
+    pipeline = build_pipeline()
+    pipeline.start()
+    if drainer is None:
+        pipeline.join()
+    else:
+        drainer.run(pipeline)
 
 def receiveAndDelete():
     # 创建 SQS 客户端
-    sqs = boto3.client('sqs')
+    sqs = clients.client('sqs')
 
     while True:
         # 从 SQS 获取消息
@@ -87,6 +99,3 @@ def receiveAndDelete():
 
 if __name__ == "__main__":
     receiveAndProcess()
-    #message = '{"storage": "dynamodb", "taskId": "e0185dde-3814-4ce5-9c22-c9a318d19e0b" }'
-    #ret = process_message(message)
-    #print(f"process ret [{ret}]")
@@ -0,0 +1,138 @@
+import queue
+import threading
+import time
+import logging
+
+import scheduler.sd_dynamodb as sd_dynamodb
+import scheduler.metrics as metrics
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger('status_writer')
+
+
+class StatusUpdate:
+    """One task status transition and what to do once it is durable, lost or given up"""
+    def __init__(self, kind, write, on_durable=None, on_failed=None, on_lost=None):
+        self.kind = kind
+        self.write = write
+        self.on_durable = on_durable
+        self.on_failed = on_failed
+        self.on_lost = on_lost
+        self.attempts = 0
+
+
+class StatusWriter:
+    """Writes task status transitions to DynamoDB behind the pipeline
+
+    Updates wait in a bounded queue, so a slow table pushes back on the post
+    workers instead of growing without limit, and are written by writer threads
+    with retries and exponential backoff. on_durable runs after the write
+    succeeded, which is where the SQS message gets deleted; on_failed runs when
+    the retries are exhausted so the message is left to reappear. A write whose
+    condition failed, because the task finished or another worker took it over,
+    is not retried and runs on_lost instead: the message belongs to the task's
+    current owner and must not be deleted. stop() writes everything still queued
+    before it returns.
+    """
+    def __init__(self, capacity=100, workers=2, max_attempts=5, backoff=0.5, max_backoff=10):
+        self.queue = queue.Queue(maxsize=capacity)
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.threads = []
+        self.running = False
+
+    def finish(self, taskId, owner, processRes, timings=None, on_durable=None, on_failed=None, on_lost=None):
+        self.put(StatusUpdate(
+            'finished',
+            lambda: sd_dynamodb.finishTask(taskId, owner, processRes, timings),
+            on_durable, on_failed, on_lost
+        ))
+
+    def fail(self, taskId, owner, error, timings=None, on_durable=None, on_failed=None, on_lost=None):
+        self.put(StatusUpdate(
+            'failed',
+            lambda: sd_dynamodb.failTask(taskId, owner, error, timings),
+            on_durable, on_failed, on_lost
+        ))
+
+    def retry(self, taskId, owner, error, timings=None, on_durable=None, on_failed=None, on_lost=None):
+        self.put(StatusUpdate(
+            'retry',
+            lambda: sd_dynamodb.retryTask(taskId, owner, error, timings),
+            on_durable, on_failed, on_lost
+        ))
+
+    def put(self, update):
+        """Queue an update, blocks while the queue is full"""
+        if not self.running:
+            # not started or already stopped, write in the caller
+            self._write(update)
+            return
+        self.queue.put(update)
+
+    def __len__(self):
+        return self.queue.qsize()
+
+    def _write(self, update):
+        while True:
+            update.attempts += 1
+            try:
+                with metrics.stage('status_write'):
+                    written = update.write()
+                break
+            except Exception as e:
+                metrics.errors_total.labels('status_write').inc()
+                if update.attempts >= self.max_attempts:
+                    logger.error(f"Giving up on {update.kind} status write after {update.attempts} attempts: {e}")
+                    self._callback(update.on_failed)
+                    return
+                delay = min(self.backoff * 2 ** (update.attempts - 1), self.max_backoff)
+                logger.warning(f"{update.kind} status write failed ({e}), retrying in {delay:.1f}s")
+                time.sleep(delay)
+        if written is False:
+            logger.warning(f"{update.kind} status not written, the task finished or another worker owns it")
+            self._callback(update.on_lost)
+            return
+        self._callback(update.on_durable)
+
+    def _callback(self, fn):
+        if fn is None:
+            return
+        try:
+            fn()
+        except Exception as e:
+            logger.error(f"Status write callback error: {e}")
+
+    def _loop(self):
+        while self.running or not self.queue.empty():
+            try:
+                update = self.queue.get(timeout=1)
+            except queue.Empty:
+                continue
+            try:
+                self._write(update)
+            finally:
+                self.queue.task_done()
+
+    def start(self):
+        if not self.running:
+            self.running = True
+            for _ in range(self.workers):
+                thread = threading.Thread(target=self._loop)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+    def stop(self):
+        """Write the queued updates and stop the writer threads"""
+        if self.running:
+            self.running = False
+            for thread in self.threads:
+                thread.join()
+            self.threads = []
@@ -0,0 +1,265 @@
+import binascii
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+import logging
+
+import scheduler.metrics as metrics
+from scheduler.conf import schedulerConfig
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger('streaming')
+
+# webui 返回的图片边接收边解码, 写入该目录的临时文件, 上传后删除; 不会整批图片留在内存里
+spool_dir = schedulerConfig.get('output', 'spool_dir', fallback='/tmp/sd-outputs')
+# 每次从 webui 连接读取的字节数
+chunk_size = schedulerConfig.getint('output', 'stream_chunk_kb', fallback=256) * 1024
+
+# Where a JSON string ends or has an escape, and the bytes that change the structure outside of strings
+_STRING_SPECIAL = re.compile(rb'["\\]')
+_STRUCTURAL = re.compile(rb'["{}\[\],:]')
+
+_spool_lock = threading.Lock()
+_spool_ready = False
+
+
+def spool_directory():
+    """spool_dir, created and cleared of images a previous run left behind on first use"""
+    global _spool_ready
+    with _spool_lock:
+        if not _spool_ready:
+            os.makedirs(spool_dir, exist_ok=True)
+            for name in os.listdir(spool_dir):
+                if name.startswith('webui-'):
+                    os.remove(os.path.join(spool_dir, name))
+            _spool_ready = True
+    return spool_dir
+
+
+class SpooledImage:
+    """A decoded image of a webui response, kept in a file under spool_dir until it is uploaded"""
+    def __init__(self):
+        fd, self.path = tempfile.mkstemp(prefix='webui-', suffix='.png', dir=spool_directory())
+        self.file = os.fdopen(fd, 'wb')
+        self.size = 0
+
+    def write(self, data):
+        self.file.write(data)
+        self.size += len(data)
+
+    def finish(self):
+        self.file.close()
+
+    def read(self):
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    def close(self):
+        """Remove the file, safe to call more than once"""
+        self.file.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    def __repr__(self):
+        return f"SpooledImage({self.path}, {self.size} bytes)"
+
+
+class Base64Writer:
+    """Decodes base64 text written in arbitrary pieces into out"""
+    def __init__(self, out):
+        self.out = out
+        self.pending = b''
+
+    def write(self, data):
+        if self.pending:
+            data = self.pending + data
+        # only whole groups of 4 characters decode on their own
+        cut = len(data) - len(data) % 4
+        self.pending = data[cut:]
+        if cut:
+            self.out.write(binascii.a2b_base64(data[:cut]))
+
+    def close(self):
+        if self.pending:
+            self.out.write(binascii.a2b_base64(self.pending + b'=' * (-len(self.pending) % 4)))
+            self.pending = b''
+
+
+class ResponseParser:
+    """Incremental parser of a webui response
+
+    feed() takes the body in chunks as they arrive. The strings of the top-level
+    "images" array are base64-decoded as they stream by into one SpooledImage each,
+    everything else is collected and parsed when close() returns the response, with
+    "images" as the list of SpooledImage. Peak memory is a chunk plus the small
+    fields, whatever the size and number of images.
+    """
+    def __init__(self):
+        self.rest = bytearray()
+        self.images = []
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        # 'key', 'image' or 'other' for the string being read
+        self.kind = None
+        self.key = bytearray()
+        self.last_key = None
+        self.expect_key = False
+        # depth inside the images array, None outside of it
+        self.images_depth = None
+        self.image = None
+        self.decoder = None
+        self.decode_seconds = 0.0
+
+    def feed(self, data):
+        i, n = 0, len(data)
+        while i < n:
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                    self._string(data[i:i + 1], escaped=True)
+                    i += 1
+                    continue
+                m = _STRING_SPECIAL.search(data, i)
+                end = m.start() if m else n
+                if end > i:
+                    self._string(data[i:end])
+                if m is None:
+                    return
+                if data[end] == 0x5c:
+                    self.escape = True
+                    if self.kind != 'image':
+                        self._emit(b'\\')
+                else:
+                    self._end_string()
+                i = end + 1
+                continue
+
+            m = _STRUCTURAL.search(data, i)
+            end = m.start() if m else n
+            if end > i and self.images_depth is None:
+                self._emit(data[i:end])
+            if m is None:
+                return
+            self._structural(data[end:end + 1])
+            i = end + 1
+
+    def _structural(self, c):
+        if c == b'"':
+            self.in_string = True
+            if self.images_depth is not None and self.depth == self.images_depth:
+                self.kind = 'image'
+                start = time.perf_counter()
+                self.image = SpooledImage()
+                self.images.append(self.image)
+                self.decoder = Base64Writer(self.image)
+                self.decode_seconds += time.perf_counter() - start
+                return
+            if self.depth == 1 and self.expect_key:
+                self.kind = 'key'
+                self.key.clear()
+            else:
+                self.kind = 'other'
+        elif c in (b'{', b'['):
+            self._emit(c)
+            if c == b'[' and self.depth == 1 and self.last_key == b'images' and not self.expect_key:
+                self.images_depth = 2
+            self.depth += 1
+            if self.depth == 1:
+                self.expect_key = True
+            return
+        elif c in (b'}', b']'):
+            if self.images_depth is not None and self.depth == self.images_depth:
+                self.images_depth = None
+            self.depth -= 1
+        elif c == b',':
+            if self.depth == 1:
+                self.expect_key = True
+            if self.images_depth is not None:
+                return
+        elif c == b':':
+            if self.depth == 1:
+                self.expect_key = False
+        self._emit(c)
+
+    def _string(self, data, escaped=False):
+        if self.kind == 'image':
+            # base64 has no escapes apart from an optional \/
+            if escaped and data != b'/':
+                return
+            start = time.perf_counter()
+            self.decoder.write(data)
+            self.decode_seconds += time.perf_counter() - start
+            return
+        if self.kind == 'key':
+            self.key += data
+        self._emit(data)
+
+    def _end_string(self):
+        self.in_string = False
+        if self.kind == 'image':
+            start = time.perf_counter()
+            self.decoder.close()
+            self.image.finish()
+            self.decode_seconds += time.perf_counter() - start
+            self.image = self.decoder = None
+            return
+        if self.kind == 'key':
+            self.last_key = bytes(self.key)
+        self._emit(b'"')
+
+    def _emit(self, data):
+        if self.images_depth is None:
+            self.rest += data
+
+    def close(self):
+        """The parsed response, raises ValueError if the body was not a complete JSON object"""
+        if self.in_string or self.depth:
+            raise ValueError("webui response ended early")
+        response = json.loads(self.rest)
+        if not isinstance(response, dict):
+            raise ValueError(f"unexpected webui response: {bytes(self.rest[:200])}")
+        response['images'] = self.images
+        metrics.stage_seconds.labels('decode').observe(self.decode_seconds)
+        return response
+
+    def discard(self):
+        """Remove the images spooled so far"""
+        for image in self.images:
+            image.close()
+        self.images = []
+
+
+def parse_response(chunks, trace=None):
+    """Parse a webui response body given as an iterable of bytes, see ResponseParser
+
+    The seconds spent decoding images are stored in trace["decode"] if a dict is given.
+    """
+    parser = ResponseParser()
+    try:
+        for chunk in chunks:
+            parser.feed(chunk)
+        response = parser.close()
+        if trace is not None:
+            trace['decode'] = parser.decode_seconds
+        return response
+    except Exception:
+        parser.discard()
+        raise
+
+
+def spool(data):
+    """SpooledImage holding data, for images that didn't come from a webui response"""
+    image = SpooledImage()
+    image.write(data)
+    image.finish()
+    return image
@@ -0,0 +1,193 @@
+import threading
+import time
+import logging
+
+import scheduler.sd_api as sd_api
+import scheduler.clients as clients
+import scheduler.metrics as metrics
+from scheduler.backends import get_backends
+from scheduler.conf import schedulerConfig
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger('warmup')
+
+# 启动时先等待 webui 就绪、加载模型并运行一次预热推理, 之后才开始消费队列
+enabled = schedulerConfig.getboolean('warmup', 'enabled', fallback=True)
+# 最多等待 webui 多少秒, 超时仍没有可用的 webui 则退出, 由 supervisord 重启
+timeout = schedulerConfig.getint('warmup', 'timeout', fallback=900)
+poll_interval = schedulerConfig.getfloat('warmup', 'poll_interval', fallback=5)
+# 预先加载的默认模型, 为空则使用 webui 已加载的模型
+checkpoint = schedulerConfig.get('warmup', 'checkpoint', fallback='')
+# 预热推理的步数和图片边长, steps = 0 不运行预热推理
+steps = schedulerConfig.getint('warmup', 'steps', fallback=1)
+size = schedulerConfig.getint('warmup', 'size', fallback=256)
+
+# AWS clients the pipeline uses on its first message
+WARM_CLIENTS = ('sqs', 's3', 'dynamodb')
+
+
+class Readiness:
+    """Startup progress of the scheduler, served on /ready
+
+    state goes starting -> warming -> ready, or failed when no webui came up in
+    time, and draining -> drained once the instance is going away. phases holds the seconds of each startup step per backend, seconds
+    the time from process start until the queue is polled.
+    """
+    def __init__(self):
+        self.started = time.time()
+        self.state = "starting"
+        self.phases = {}
+        self.seconds = None
+        self.lock = threading.Lock()
+
+    def begin(self, started=None):
+        if started is not None:
+            self.started = started
+        self.state = "warming"
+
+    def record(self, backend, phase, seconds):
+        with self.lock:
+            self.phases.setdefault(backend, {})[phase] = round(seconds, 3)
+
+    def ready(self):
+        self.seconds = time.time() - self.started
+        self.state = "ready"
+
+    def fail(self):
+        self.seconds = time.time() - self.started
+        self.state = "failed"
+
+    def draining(self):
+        self.state = "draining"
+
+    def drained(self):
+        self.state = "drained"
+
+    def is_ready(self):
+        return self.state == "ready"
+
+    def status(self):
+        with self.lock:
+            return {
+                "state": self.state,
+                "seconds": round(self.seconds, 3) if self.seconds is not None else None,
+                "phases": {backend: dict(phases) for backend, phases in self.phases.items()},
+            }
+
+
+# Singleton instance
+readiness = Readiness()
+
+def get_readiness():
+    return readiness
+
+
+def warm_clients():
+    """Create the shared AWS clients before the first message, which resolves the credentials"""
+    start = time.time()
+    try:
+        for service in WARM_CLIENTS:
+            clients.client(service)
+    except Exception as e:
+        logger.warning(f"Failed to warm the AWS clients: {e}")
+    readiness.record("aws", "clients", time.time() - start)
+
+
+def wait_for_webui(url, deadline):
+    """Block until the webui at url answers its options endpoint, return its options"""
+    while True:
+        try:
+            # the probe session doesn't retry, we poll at our own pace
+            response = clients.http_session('probe').get(f'{url}/sdapi/v1/options', timeout=(2, 30))
+            response.raise_for_status()
+            return response.json()
+        except Exception as e:
+            if time.time() > deadline:
+                raise TimeoutError(f"webui {url} not reachable after {timeout}s: {e}")
+            logger.info(f"Waiting for webui {url}: {e}")
+            time.sleep(poll_interval)
+
+
+def warm_backend(url, deadline):
+    """Wait for one webui, load the default checkpoint and run a warm-up inference"""
+    start = time.time()
+    options = wait_for_webui(url, deadline)
+    readiness.record(url, "webui", time.time() - start)
+
+    if checkpoint and options.get("sd_model_checkpoint") != checkpoint:
+        phase = time.time()
+        sd_api.set_options({"sd_model_checkpoint": checkpoint}, url)
+        readiness.record(url, "checkpoint", time.time() - phase)
+        logger.info(f"Loaded checkpoint {checkpoint} on {url} in {time.time() - phase:.1f}s")
+
+    if steps > 0:
+        phase = time.time()
+        # the first inference pays for CUDA kernel compilation and allocator growth, not a user task
+        response = sd_api.call_webui('/sdapi/v1/txt2img', {
+            "prompt": "warm-up",
+            "steps": steps,
+            "width": size,
+            "height": size,
+            "save_images": False,
+        }, url)
+        if not response.get("images"):
+            raise RuntimeError(f"warm-up inference on {url} returned no images: {response}")
+        sd_api.release_images(response["images"])
+        readiness.record(url, "inference", time.time() - phase)
+    readiness.record(url, "total", time.time() - start)
+
+
+def run(started=None):
+    """Warm the webui backends, return once the first one is ready
+
+    Backends are warmed in parallel and stay out of rotation until their warm-up
+    finished, so polling starts with the first warm GPU and the others join as
+    they become ready. Raises if none became ready within the timeout. started
+    is the process start time the time-to-ready is measured from.
+    """
+    readiness.begin(started)
+    metrics.time_to_ready.set_function(lambda: readiness.seconds if readiness.is_ready() else None)
+    backends = get_backends()
+    if not enabled:
+        readiness.ready()
+        return readiness.status()
+
+    deadline = time.time() + timeout
+    results = {}
+    lock = threading.Lock()
+    done = threading.Event()
+
+    def warm(backend):
+        ok = False
+        try:
+            warm_backend(backend.url, deadline)
+            ok = True
+        except Exception as e:
+            logger.error(f"Warm-up of webui {backend.url} failed: {e}")
+        backends.set_warmed(backend.url, ok)
+        with lock:
+            results[backend.url] = ok
+            if ok or len(results) == len(backends):
+                done.set()
+
+    for backend in backends:
+        backends.set_warmed(backend.url, False)
+    threading.Thread(target=warm_clients, daemon=True).start()
+    for backend in backends:
+        threading.Thread(target=warm, args=(backend,), daemon=True).start()
+    done.wait()
+
+    with lock:
+        warm_count = sum(results.values())
+    if not warm_count:
+        readiness.fail()
+        raise RuntimeError(f"no webui became ready within {timeout}s")
+
+    readiness.ready()
+    logger.info(f"Ready after {readiness.seconds:.1f}s with {warm_count}/{len(backends)} webuis warm: "
+                f"{readiness.status()['phases']}")
+    return readiness.status()
@@ -0,0 +1,62 @@
+import pytest
+
+from scheduler.conf import schedulerConfig
+
+# The scheduler modules read [aws] when they are imported. conf.ini is only
+# found when pytest runs from server/api-scheduler, and no test talks to AWS.
+if not schedulerConfig.has_section('aws'):
+    schedulerConfig.add_section('aws')
+for key, value in {
+    'region': 'us-east-1',
+    'queue_url': 'https://sqs.us-east-1.amazonaws.com/123456789012/sd_task_queue',
+    'dynamodb_table_name': 'sd_tasks',
+    'bucket_name': 'sd-test',
+    'cloudfront': 'https://cdn.test/',
+}.items():
+    if not schedulerConfig.has_option('aws', key):
+        schedulerConfig.set('aws', key, value)
+
+
+@pytest.fixture
+def spool_dir(tmp_path, monkeypatch):
+    """A fresh streaming.spool_dir for the decoded images"""
+    import scheduler.streaming as streaming
+    directory = tmp_path / 'spool'
+    monkeypatch.setattr(streaming, 'spool_dir', str(directory))
+    monkeypatch.setattr(streaming, '_spool_ready', False)
+    return directory
+
+
+@pytest.fixture
+def aws(monkeypatch):
+    """moto stand-ins behind the shared clients of scheduler.clients, skipped without moto"""
+    moto = pytest.importorskip('moto')
+    import scheduler.clients as clients
+    with moto.mock_aws():
+        monkeypatch.setattr(clients, '_clients', {})
+        monkeypatch.setattr(clients, '_aws_session', None)
+        yield clients
+
+
+@pytest.fixture
+def tasks_table(aws):
+    """The task table, put(taskId, **attributes) adds a row with string attributes"""
+    import scheduler.sd_dynamodb as sd_dynamodb
+    dynamodb = aws.client('dynamodb')
+    dynamodb.create_table(
+        TableName=sd_dynamodb.table_name,
+        KeySchema=[{'AttributeName': 'taskId', 'KeyType': 'HASH'}],
+        AttributeDefinitions=[{'AttributeName': 'taskId', 'AttributeType': 'S'}],
+        BillingMode='PAY_PER_REQUEST'
+    )
+
+    class Table:
+        def put(self, taskId, **attributes):
+            item = {'taskId': {'S': taskId}}
+            item.update({k: {'N': str(v)} if isinstance(v, int) else {'S': v} for k, v in attributes.items()})
+            dynamodb.put_item(TableName=sd_dynamodb.table_name, Item=item)
+
+        def get(self, taskId):
+            item = dynamodb.get_item(TableName=sd_dynamodb.table_name, Key={'taskId': {'S': taskId}}).get('Item', {})
+            return {k: next(iter(v.values())) for k, v in item.items()}
+    return Table()
@@ -0,0 +1,76 @@
+import pytest
+
+import scheduler.failures as failures
+from scheduler.backends import BackendPool
+
+
+def pool(n=3, **kwargs):
+    return BackendPool([f'http://gpu{i}' for i in range(n)], **kwargs)
+
+
+def urls(backends):
+    return [b.url for b in backends]
+
+
+def test_least_outstanding_first():
+    p = pool()
+    taken = [p.acquire() for _ in range(4)]
+    # idle backends first, longest idle first, then the least loaded again
+    assert urls(taken) == ['http://gpu0', 'http://gpu1', 'http://gpu2', 'http://gpu0']
+    p.release(taken[1], True)
+    assert p.acquire().url == 'http://gpu1'
+
+
+def test_prefer_breaks_ties_only():
+    p = pool()
+    prefer_gpu2 = lambda b: b.url == 'http://gpu2'
+    assert p.acquire(prefer_gpu2).url == 'http://gpu2'
+    # gpu2 is busy now, an idle backend beats the preferred one
+    assert p.acquire(prefer_gpu2).url == 'http://gpu0'
+
+
+def test_failing_backend_leaves_the_rotation_for_the_cooldown(monkeypatch):
+    p = pool(2, failure_threshold=2, cooldown=30)
+    gpu0, gpu1 = p.backends
+    for _ in range(2):
+        with pytest.raises(ConnectionError):
+            with p.lease(lambda b: b is gpu0):
+                raise ConnectionError("webui died")
+    assert gpu0.failures == 2 and not gpu0.available(gpu0.down_until - 1)
+    assert [p.acquire().url for _ in range(2)] == ['http://gpu1', 'http://gpu1']
+    # after the cooldown the next call tries it again, a success resets the count
+    gpu0.down_until = 0
+    with p.lease(lambda b: b is gpu0) as backend:
+        assert backend is gpu0
+    assert gpu0.failures == 0
+
+
+def test_permanent_errors_dont_count_against_the_backend():
+    p = pool(1, failure_threshold=1)
+    with pytest.raises(failures.PermanentError):
+        with p.lease():
+            raise failures.PermanentError("rejected payload")
+    backend, = p.backends
+    assert backend.failures == 0 and backend.outstanding == 0 and backend.down_until == 0
+
+
+def test_no_backend_available_uses_the_one_back_first():
+    p = pool(2)
+    gpu0, gpu1 = p.backends
+    gpu0.down_until, gpu1.down_until = 2e9 + 20, 2e9 + 10
+    assert p.acquire() is gpu1
+    p.set_healthy('http://gpu1', False)
+    # an unhealthy backend comes after one that is only cooling down
+    assert p.acquire() is gpu0
+
+
+def test_warm_up_gates_the_rotation():
+    p = pool(2)
+    gpu0, gpu1 = p.backends
+    gpu0.warmed = False
+    p.set_warmed('http://gpu0', False)
+    p.set_healthy('http://gpu0', True)
+    assert not gpu0.healthy
+    assert urls(p.acquire() for _ in range(2)) == ['http://gpu1', 'http://gpu1']
+    p.set_warmed('http://gpu0', True)
+    assert gpu0.healthy and p.acquire() is gpu0
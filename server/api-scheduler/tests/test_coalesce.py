@@ -0,0 +1,92 @@
+import json
+
+import pytest
+
+import scheduler.coalesce as coalesce
+
+TXT2IMG = '/sdapi/v1/txt2img'
+
+
+class Image:
+    def __init__(self, name):
+        self.name = name
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def task(**payload):
+    return {"api": TXT2IMG, "payload": dict({"prompt": "a cat", "steps": 20}, **payload)}
+
+
+def test_group_key_ignores_seed_and_batch_size():
+    assert coalesce.group_key(task(seed=1)) == coalesce.group_key(task(seed=7, batch_size=2))
+    assert coalesce.group_key(task(seed=1)) != coalesce.group_key(task(seed=1, prompt="a dog"))
+
+
+@pytest.mark.parametrize('t', [
+    {"api": '/sdapi/v1/img2img', "payload": {"prompt": "a cat"}},
+    task(n_iter=2),
+    task(script_name="x/y/z plot"),
+    task(alwayson_scripts={"controlnet": {"args": []}}),
+    task(subseed_strength=0.3),
+])
+def test_group_key_none_for_tasks_that_cant_merge(t):
+    assert coalesce.group_key(t) is None
+
+
+def test_random_seeds_join_freely():
+    assert coalesce.can_join([{"seed": -1}], {}, 4)
+    assert coalesce.can_join([{}, {"batch_size": 2}], {"seed": -1}, 4)
+
+
+def test_random_and_fixed_seeds_dont_mix():
+    assert not coalesce.can_join([{"seed": -1}], {"seed": 5}, 4)
+    assert not coalesce.can_join([{"seed": 5}], {"seed": -1}, 4)
+
+
+def test_fixed_seed_joins_only_where_it_continues_the_batch():
+    # the webui renders image i of a batch with seed + i
+    batch = [{"seed": 100, "batch_size": 2}, {"seed": 102}]
+    assert coalesce.can_join(batch, {"seed": 103}, 8)
+    assert coalesce.can_join(batch, {"seed": 103, "batch_size": 2}, 8)
+    assert not coalesce.can_join(batch, {"seed": 102}, 8)
+    assert not coalesce.can_join(batch, {"seed": 104}, 8)
+
+
+def test_max_batch_size():
+    assert coalesce.can_join([{"batch_size": 3}], {}, 4)
+    assert not coalesce.can_join([{"batch_size": 3}], {"batch_size": 2}, 4)
+
+
+def test_merge():
+    payloads = [{"prompt": "a", "seed": 100, "batch_size": 2}, {"prompt": "a", "seed": 102}]
+    merged = coalesce.merge(payloads)
+    assert merged == {"prompt": "a", "seed": 100, "batch_size": 3, "n_iter": 1}
+    assert payloads[0]["batch_size"] == 2
+
+
+def test_split_continues_the_seeds():
+    payloads = [{"seed": 100, "batch_size": 2}, {"seed": 102}, {"seed": 103, "batch_size": 2}]
+    images = [Image(i) for i in range(5)]
+    texts = [f"Seed: {100 + i}" for i in range(5)]
+    responses = coalesce.split({"images": images, "info": json.dumps({"infotexts": texts})}, payloads)
+    assert [[image.name for image in r["images"]] for r in responses] == [[0, 1], [2], [3, 4]]
+    assert [json.loads(r["info"])["infotexts"] for r in responses] == [
+        ["Seed: 100", "Seed: 101"], ["Seed: 102"], ["Seed: 103", "Seed: 104"]]
+
+
+def test_split_drops_the_grid():
+    payloads = [{"batch_size": 2}, {}]
+    grid, *images = [Image(i) for i in range(4)]
+    texts = ["grid", "Seed: 1", "Seed: 2", "Seed: 3"]
+    responses = coalesce.split({"images": [grid] + images, "info": json.dumps({"infotexts": texts})}, payloads)
+    assert grid.closed
+    assert [r["images"] for r in responses] == [images[:2], images[2:]]
+    assert json.loads(responses[1]["info"])["infotexts"] == ["Seed: 3"]
+
+
+def test_split_rejects_a_short_response():
+    with pytest.raises(Exception):
+        coalesce.split({"images": [Image(0)]}, [{}, {}])
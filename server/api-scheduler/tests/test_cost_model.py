@@ -0,0 +1,120 @@
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import scheduler.cost_model as cost_model
+from scheduler.cost_model import CostModel, work
+from scheduler.pipeline import Pipeline
+
+
+def task(api='/sdapi/v1/txt2img', **payload):
+    return {"api": api, "payload": payload}
+
+
+def test_work():
+    assert work(task()) == 20
+    assert work(task(steps=30, batch_size=2, n_iter=2)) == 120
+    assert work(task(width=1024, height=1024)) == 80
+    # img2img runs steps * denoising_strength
+    assert work(task(init_images=["x"], denoising_strength=0.5)) == 10
+    # a hires pass at twice the size with its denoising strength
+    assert work(task(enable_hr=True, hr_scale=2, denoising_strength=0.5)) == 20 + 10 * 4
+    units = {"alwayson_scripts": {"controlnet": {"args": [{"enabled": True}, {"enabled": False}, {}]}}}
+    assert work(task(**units), controlnet_weight=0.5) == 20 * 2
+
+
+def test_prediction_before_calibration():
+    model = CostModel(seconds_per_step=0.1, overhead=2)
+    assert model.predict(task()) == pytest.approx(2 + 0.1 * 20)
+    assert model.predict(task(steps=100)) == pytest.approx(2 + 0.1 * 100)
+
+
+def test_fit_follows_the_observed_calls():
+    model = CostModel(seconds_per_step=0.05, overhead=1, smoothing=0.1)
+    # the GPU really takes 0.2 s per step plus 3 s per call
+    for _ in range(20):
+        for steps in (10, 30, 60, 120):
+            model.record([task(steps=steps)], 3 + 0.2 * steps)
+    rate, overhead = model.coefficients('txt2img')
+    assert rate == pytest.approx(0.2, rel=0.05)
+    assert overhead == pytest.approx(3, rel=0.1)
+    assert model.predict(task(steps=50)) == pytest.approx(13, rel=0.05)
+    assert model.error < 0.05
+
+
+def test_fit_per_api():
+    model = CostModel(seconds_per_step=0.05, overhead=1, smoothing=0.2)
+    for _ in range(30):
+        for steps in (10, 50):
+            model.record([task('/sdapi/v1/img2img', steps=steps, init_images=["x"], denoising_strength=1)], 0.5 * steps)
+    assert model.predict(task('/sdapi/v1/img2img', steps=20, init_images=["x"], denoising_strength=1)) == pytest.approx(10, rel=0.1)
+    assert model.predict(task(steps=20)) == pytest.approx(2)
+
+
+def test_merged_call_is_one_observation_of_the_summed_work():
+    model = CostModel(seconds_per_step=0.05, overhead=0, smoothing=0.2)
+    for _ in range(30):
+        model.record([task(steps=20), task(steps=20)], 8)
+        model.record([task(steps=20)], 4)
+    assert model.predict(task(steps=40)) == pytest.approx(8, rel=0.05)
+
+
+def test_record_ignores_empty_calls():
+    model = CostModel()
+    model.record([], 5)
+    model.record([task()], 0)
+    assert model.error is None
+
+
+def test_visibility_is_bounded(monkeypatch):
+    monkeypatch.setattr(cost_model, 'visibility_margin', 3)
+    monkeypatch.setattr(cost_model, 'visibility_min', 60)
+    monkeypatch.setattr(cost_model, 'visibility_max', 3600)
+    assert cost_model.visibility(1) == 60
+    assert cost_model.visibility(100) == 300
+    assert cost_model.visibility(10000) == 3600
+
+
+def pipeline(shortest_first=True, max_bypass=2, max_wait=120):
+    # _select only reads these
+    return SimpleNamespace(shortest_first=shortest_first, max_bypass=max_bypass, max_wait=max_wait, models=None)
+
+
+def job(cost, priority=0, age=0):
+    return SimpleNamespace(cost=cost, priority=priority, bypassed=0, received_at=time.time() - age)
+
+
+def test_shortest_first():
+    jobs = [job(10), job(1), job(5)]
+    assert Pipeline._select(pipeline(), jobs) == 1
+    assert [j.bypassed for j in jobs] == [1, 0, 0]
+
+
+def test_fifo_without_shortest_first():
+    jobs = [job(10), job(1)]
+    assert Pipeline._select(pipeline(shortest_first=False), jobs) == 0
+
+
+def test_bypass_limit():
+    p = pipeline(max_bypass=2)
+    long = job(100)
+    buffer = [long]
+    order = []
+    # short tasks keep arriving behind the long one
+    for n in range(4):
+        buffer.append(job(1))
+        order.append(buffer.pop(Pipeline._select(p, buffer)))
+    assert order.index(long) == 2
+    assert long.bypassed == 2
+
+
+def test_priority_before_cost():
+    jobs = [job(1, priority=1), job(10, priority=0)]
+    assert Pipeline._select(pipeline(), jobs) == 1
+    assert jobs[0].bypassed == 0
+
+
+def test_max_wait_takes_the_oldest():
+    jobs = [job(100, age=200), job(1)]
+    assert Pipeline._select(pipeline(max_wait=120), jobs) == 0
@@ -0,0 +1,151 @@
+import queue
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import scheduler.drain as drain
+from scheduler.drain import Drainer
+from scheduler.pipeline import Pipeline
+
+
+class Readiness:
+    def __init__(self, events):
+        self.events = events
+
+    def draining(self):
+        self.events.append('draining')
+
+    def drained(self):
+        self.events.append('drained')
+
+
+class Thread:
+    def __init__(self, events, name):
+        self.events = events
+        self.name = name
+
+    def join(self, timeout=None):
+        self.events.append(f'join {self.name}')
+
+
+class Buffer:
+    def __init__(self, events, *batches):
+        self.events = events
+        self.batches = list(batches)
+
+    def drain(self):
+        self.events.append('buffer')
+        return self.batches.pop(0) if self.batches else []
+
+
+def stopped(events, name):
+    return SimpleNamespace(stop=lambda: events.append(f'stop {name}'))
+
+
+@pytest.fixture
+def events(monkeypatch):
+    events = []
+    monkeypatch.setattr(drain, 'get_readiness', lambda: Readiness(events))
+    return events
+
+
+def drainer(events, lifecycle_hook=''):
+    d = Drainer(SimpleNamespace(instance_id='i-0'), deadline=30, interval=0, lifecycle_hook=lifecycle_hook)
+    d._complete_lifecycle_action = lambda: events.append('lifecycle')
+    return d
+
+
+def test_sigterm_drains_between_the_readiness_changes(events):
+    d = drainer(events, lifecycle_hook='hook')
+    d.request('SIGTERM')
+    d.run(SimpleNamespace(drain=lambda deadline: events.append(f'drain {deadline}')))
+    # the lifecycle action is only completed after a lifecycle termination
+    assert events == ['draining', 'drain 30', 'drained']
+
+
+def test_lifecycle_termination_completes_the_action(events):
+    d = drainer(events, lifecycle_hook='hook')
+    d.request('lifecycle')
+    d.run(SimpleNamespace(drain=lambda deadline: events.append('drain')))
+    assert events == ['draining', 'drain', 'drained', 'lifecycle']
+
+
+def test_later_requests_are_ignored(events):
+    d = drainer(events)
+    d.request('SIGTERM')
+    d.request('spot')
+    assert d.reason == 'SIGTERM'
+
+
+def pipeline(events, inflight=(), buffered=()):
+    # drain() and stop() only touch these
+    p = object.__new__(Pipeline)
+    p.inflight = {id(job): job for job in inflight}
+    p.inferring_lock = threading.Lock()
+    p.posting = 0
+    p.posts_closed = False
+    p.draining = False
+    p.running = True
+    p.poll_threads = [Thread(events, 'poll')]
+    p.inference_threads = [Thread(events, 'inference')]
+    p.buffer = Buffer(events, list(buffered))
+    return p
+
+
+def job(name):
+    return SimpleNamespace(taskId=name, returned=False)
+
+
+def test_drain_returns_the_buffer_before_waiting_for_the_inferences():
+    events = []
+    waiting, rendering = job('waiting'), job('rendering')
+    p = pipeline(events, inflight=[rendering], buffered=[waiting])
+    p._return = lambda jobs: events.append(('return', [j.taskId for j in jobs]))
+    p.stop = lambda: events.append('stop')
+    p.drain(0)
+    assert p.draining
+    assert events == [
+        'join poll', 'buffer', ('return', ['waiting']),
+        'join inference', 'buffer', ('return', []),
+        # still rendering at the deadline, its result is dropped by the inference worker
+        ('return', ['rendering']),
+        'stop',
+    ]
+    assert rendering.returned and not waiting.returned
+
+
+def test_stop_posts_the_results_rendered_after_it_began():
+    events = []
+    rendering = job('rendering')
+    p = pipeline(events, inflight=[rendering])
+    p.post_queue = queue.Queue()
+    p._finish = lambda j: events.append(f'finish {j.taskId}')
+    p.spool = SimpleNamespace(drain=lambda timeout: events.append('spool drain') or True,
+                              stop=lambda: events.append('stop spool'))
+    p.status = stopped(events, 'status')
+    p.heartbeat = stopped(events, 'heartbeat')
+    p.deleter = stopped(events, 'deleter')
+    p.progress = None
+    p.scaling = None
+    p.post_threads = [threading.Thread(target=p._post_loop, daemon=True)]
+    p.post_threads[0].start()
+
+    def infer():
+        # longer than a post worker waits on an empty post_queue
+        time.sleep(1.5)
+        # as _infer hands a finished job to the post workers
+        with p.inferring_lock:
+            p.inflight.pop(id(rendering))
+            p.posting += 1
+        p.post_queue.put(rendering)
+        with p.inferring_lock:
+            p.posting -= 1
+    worker = threading.Thread(target=infer)
+    worker.start()
+    p.stop()
+    worker.join()
+    assert not p.running and p.posts_closed
+    assert events == ['finish rendering', 'spool drain', 'stop spool', 'stop status', 'stop heartbeat',
+                      'stop deleter']
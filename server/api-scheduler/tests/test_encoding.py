@@ -0,0 +1,64 @@
+import io
+import json
+
+import pytest
+from PIL import Image, PngImagePlugin
+
+import scheduler.encoding as encoding
+import scheduler.failures as failures
+import scheduler.sd_api as sd_api
+
+
+def png(text=None):
+    info = None
+    if text is not None:
+        info = PngImagePlugin.PngInfo()
+        info.add_text("parameters", text)
+        info.add_text("Software", "webui")
+    buf = io.BytesIO()
+    Image.new('RGB', (64, 64), 'red').save(buf, format='PNG', pnginfo=info)
+    return buf.getvalue()
+
+
+def texts(data):
+    """(keyword, text) of every text chunk, in file order"""
+    f = io.BytesIO(data)
+    result = []
+    for offset, size, keyword in encoding._png_chunks(f):
+        if keyword is not None:
+            f.seek(offset + 8)
+            result.append((keyword.decode(), f.read(size - 12).split(b'\0')[-1].decode('utf-8')))
+    return result
+
+
+def test_options_defaults_and_overrides():
+    opts = encoding.options({"format": "JPG", "quality": 150, "thumbnails": [256, 64, 256]})
+    assert opts["format"] == "jpeg" and opts["quality"] == 100 and opts["thumbnails"] == [64, 256]
+    assert encoding.options()["format"] == encoding.default_format
+
+
+@pytest.mark.parametrize('output', [
+    {"format": "gif"}, {"quality": "high"}, {"thumbnails": [0]}, {"thumbnails": ["big"]}, "webp",
+])
+def test_invalid_output_fails_the_task_before_rendering(output):
+    with pytest.raises(ValueError):
+        encoding.options(output)
+    with pytest.raises(failures.PermanentError):
+        sd_api.parse_task(json.dumps({"api": "/sdapi/v1/txt2img", "payload": {}, "output": output}))
+
+
+def test_png_text_is_added():
+    data = encoding.png_with_text(png(), "parameters", "a cat, Steps: 20")
+    assert Image.open(io.BytesIO(data)).text == {"parameters": "a cat, Steps: 20"}
+
+
+def test_png_text_replaces_the_existing_chunk(tmp_path):
+    path = tmp_path / 'image.png'
+    path.write_bytes(png("old parameters"))
+    encoding.append_png_text(str(path), "parameters", "a cat, 猫")
+    data = path.read_bytes()
+    assert texts(data) == [("Software", "webui"), ("parameters", "a cat, 猫")]
+    image = Image.open(io.BytesIO(data))
+    image.load()
+    assert image.getpixel((0, 0)) == (255, 0, 0)
+    assert encoding.png_with_text(data, "parameters", "x") == encoding.png_with_text(png("y"), "parameters", "x")
@@ -0,0 +1,205 @@
+import json
+import threading
+from types import SimpleNamespace
+
+import pytest
+import requests
+from botocore.exceptions import ClientError
+
+import scheduler.failures as failures
+import scheduler.sd_dynamodb as sd_dynamodb
+from scheduler.pipeline import Job, Pipeline
+from scheduler.status_writer import StatusWriter
+
+
+def response(status, body):
+    r = requests.Response()
+    r.status_code = status
+    r._content = json.dumps(body).encode() if not isinstance(body, bytes) else body
+    return r
+
+
+def client_error(code):
+    return ClientError({'Error': {'Code': code, 'Message': code}}, 'GetObject')
+
+
+@pytest.mark.parametrize('status, body, permanent', [
+    (500, {"error": "RuntimeError"}, False),
+    (503, b'<html>bad gateway</html>', False),
+    (429, {"detail": "busy"}, False),
+    (422, {"detail": "sampler_name: unknown sampler"}, True),
+    (500, {"errors": "CUDA out of memory. Tried to allocate 2.00 GiB"}, True),
+])
+def test_webui_errors(status, body, permanent):
+    error = failures.webui_error(response(status, body))
+    assert failures.is_permanent(error) is permanent
+    assert str(status) in str(error)
+
+
+@pytest.mark.parametrize('error, permanent', [
+    (failures.PermanentError("bad"), True),
+    (failures.TransientError("busy"), False),
+    (requests.ConnectionError("refused"), False),
+    (client_error('NoSuchKey'), True),
+    (client_error('ThrottlingException'), False),
+    # a response cut short, or anything else not recognized, is retried
+    (ValueError("truncated"), False),
+    (KeyError("images"), False),
+])
+def test_is_permanent(error, permanent):
+    assert failures.is_permanent(error) is permanent
+
+
+def test_cause_decides():
+    try:
+        try:
+            raise client_error('NoSuchKey')
+        except ClientError as e:
+            raise Exception("failed to fetch input image s3://in/x.png") from e
+    except Exception as e:
+        assert failures.is_permanent(e)
+
+
+def test_backoff_grows_and_is_capped(monkeypatch):
+    monkeypatch.setattr(failures.random, 'uniform', lambda a, b: b)
+    monkeypatch.setattr(failures, 'backoff_base', 10)
+    monkeypatch.setattr(failures, 'backoff_max', 900)
+    assert [failures.backoff(n) for n in (1, 2, 3, 10)] == [10, 20, 40, 900]
+
+
+@pytest.fixture
+def queues(aws, monkeypatch):
+    sqs = aws.client('sqs')
+    queue_url = sqs.create_queue(QueueName='sd-task-queue')['QueueUrl']
+    dlq_url = sqs.create_queue(QueueName='sd-task-dlq')['QueueUrl']
+    monkeypatch.setattr(failures, 'dlq_url', dlq_url)
+    monkeypatch.setattr(failures, 'max_receives', 3)
+    return SimpleNamespace(sqs=sqs, queue_url=queue_url, dlq_url=dlq_url)
+
+
+def pipeline(sqs, deleted):
+    # _drop only touches these; the status writer isn't started, so it writes in the caller
+    p = object.__new__(Pipeline)
+    p.sqs_client = sqs
+    p.owner = 'w1'
+    p.heartbeat = SimpleNamespace(untrack=lambda job: None)
+    p.status = StatusWriter(backoff=0.001)
+    p.deleter = SimpleNamespace(add=deleted.append)
+    return p
+
+
+def received(queues, receives=1):
+    queues.sqs.send_message(QueueUrl=queues.queue_url, MessageBody=json.dumps({"taskId": "t"}))
+    for _ in range(receives):
+        message, = queues.sqs.receive_message(QueueUrl=queues.queue_url, VisibilityTimeout=0,
+                                              AttributeNames=['All'])['Messages']
+    job = Job(message, queues.queue_url)
+    job.taskId = 't'
+    return job
+
+
+def claimed(tasks_table):
+    tasks_table.put('t', taskStatus='waiting')
+    sd_dynamodb.claimTask('t', 'w1', 300)
+
+
+def test_permanent_failure_is_dead_lettered(queues, tasks_table):
+    claimed(tasks_table)
+    deleted = []
+    job = received(queues)
+    job.claimed = True
+    pipeline(queues.sqs, deleted)._drop(job, failures.PermanentError("webui returned 422"))
+    assert tasks_table.get('t')['taskStatus'] == 'failed'
+    dead, = queues.sqs.receive_message(QueueUrl=queues.dlq_url, MessageAttributeNames=['All'])['Messages']
+    assert json.loads(dead['Body']) == {"taskId": "t"}
+    assert dead['MessageAttributes']['error']['StringValue'] == "webui returned 422"
+    assert deleted == [job]
+
+
+def test_transient_failure_is_retried_with_backoff(queues, tasks_table, monkeypatch):
+    claimed(tasks_table)
+    delays = []
+    deleted = []
+    job = received(queues)
+    p = pipeline(queues.sqs, deleted)
+    monkeypatch.setattr(p, '_retry_later', lambda job, delay: delays.append(delay))
+    p._drop(job, failures.TransientError("webui returned 503"))
+    row = tasks_table.get('t')
+    assert row['taskStatus'] == 'waiting' and row['errorMessage'] == "webui returned 503"
+    assert len(delays) == 1 and deleted == []
+    assert 'Messages' not in queues.sqs.receive_message(QueueUrl=queues.dlq_url)
+
+
+def test_transient_failure_on_the_last_delivery_is_final(queues, tasks_table):
+    claimed(tasks_table)
+    deleted = []
+    job = received(queues, receives=3)
+    pipeline(queues.sqs, deleted)._drop(job, failures.TransientError("webui returned 503"))
+    assert tasks_table.get('t')['taskStatus'] == 'failed'
+    assert len(queues.sqs.receive_message(QueueUrl=queues.dlq_url)['Messages']) == 1
+
+
+class Buffer:
+    """Hands out one job, then stops the pipeline"""
+    def __init__(self, p, job):
+        self.p = p
+        self.job = job
+
+    def take(self, timeout=1):
+        job, self.job = self.job, None
+        if job is None:
+            self.p.running = False
+        return job
+
+
+def merged_pipeline(jobs, fail):
+    """A pipeline whose inference loop merges jobs into one call; fail(names) is the error of a call or None"""
+    p = object.__new__(Pipeline)
+    p.running, p.draining = True, False
+    p.inferring_lock = threading.Lock()
+    p.inflight = {}
+    p.buffer = Buffer(p, jobs[0])
+    p.calls, p.dropped, p.posted = [], [], []
+    p._claim = lambda job: True
+    p._take_compatible = lambda batch: batch.extend(jobs[1:])
+
+    def infer(batch):
+        names = [j.taskId for j in batch]
+        p.calls.append(names)
+        error = fail(names)
+        if error:
+            raise error
+        p.posted.extend(names)
+    p._infer = infer
+    p._drop = lambda job, error=None: p.dropped.append((job.taskId, failures.is_permanent(error)))
+    return p
+
+
+def jobs(*names):
+    return [SimpleNamespace(taskId=name, returned=False) for name in names]
+
+
+def test_merged_call_out_of_memory_runs_the_tasks_alone():
+    oom = failures.webui_error(response(500, {"errors": "CUDA out of memory"}))
+    # only the merged call and the task with the huge batch run out of memory
+    p = merged_pipeline(jobs('a', 'big', 'c'), lambda names: oom if len(names) > 1 or names == ['big'] else None)
+    p._inference_loop()
+    assert p.calls == [['a', 'big', 'c'], ['a'], ['big'], ['c']]
+    assert p.posted == ['a', 'c']
+    assert p.dropped == [('big', True)]
+    assert p.inflight == {}
+
+
+def test_merged_call_transient_failure_retries_every_task():
+    p = merged_pipeline(jobs('a', 'b'), lambda names: failures.TransientError("webui returned 503"))
+    p._inference_loop()
+    assert p.calls == [['a', 'b']]
+    assert p.dropped == [('a', False), ('b', False)]
+
+
+def test_single_task_out_of_memory_is_permanent():
+    oom = failures.webui_error(response(500, {"errors": "CUDA out of memory"}))
+    p = merged_pipeline(jobs('a'), lambda names: oom)
+    p._inference_loop()
+    assert p.calls == [['a']]
+    assert p.dropped == [('a', True)]
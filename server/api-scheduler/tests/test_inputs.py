@@ -0,0 +1,101 @@
+import base64
+import os
+
+import pytest
+
+import scheduler.inputs as inputs
+from scheduler.inputs import InputCache
+
+CDN = 'https://cdn.test/'
+
+
+class Bucket:
+    """sd_s3.get_object_if_changed over a dict of (bucket, key) -> (data, etag)"""
+    def __init__(self, objects):
+        self.objects = objects
+        self.gets = []
+
+    def get_object_if_changed(self, bucket, key, etag=None):
+        self.gets.append((key, etag))
+        data, current = self.objects[(bucket, key)]
+        return (None, etag) if etag == current else (data, current)
+
+
+@pytest.fixture
+def bucket(monkeypatch):
+    objects = Bucket({
+        ('in', 'pose.png'): (b'pose', '"e1"'),
+        ('images', 'ref.png'): (b'ref', '"e2"'),
+    })
+    monkeypatch.setattr(inputs.sd_s3, 'get_object_if_changed', objects.get_object_if_changed)
+    monkeypatch.setattr(inputs.sd_s3, 'cloudfront', CDN)
+    monkeypatch.setattr(inputs.sd_s3, 'bucket_name', 'images')
+    return objects
+
+
+def b64(data):
+    return base64.b64encode(data).decode()
+
+
+def test_parse_ref(bucket):
+    assert inputs.parse_ref('s3://in/pose.png') == ('in', 'pose.png')
+    assert inputs.parse_ref(CDN + 'ref.png') == ('images', 'ref.png')
+    assert inputs.parse_ref('s3://in') is None
+    assert inputs.parse_ref('iVBORw0KGgo=') is None
+
+
+def test_resolves_only_image_fields(tmp_path, bucket):
+    cache = InputCache(str(tmp_path), 1 << 20)
+    unit = {"enabled": True, "input_image": CDN + 'ref.png', "image": {"image": 's3://in/pose.png'},
+            "module": 's3://in/pose.png'}
+    task = {"api": "/sdapi/v1/img2img", "payload": {
+        "init_images": ['s3://in/pose.png', 'iVBORw0KGgo='],
+        "mask": CDN + 'ref.png',
+        "prompt": 's3://in/pose.png',
+        "hr_prompt": 's3://in/pose.png',
+        "script_args": ['s3://in/pose.png'],
+        "alwayson_scripts": {"controlnet": {"args": [unit]}},
+    }}
+    assert cache.resolve(task) == 4
+    payload = task["payload"]
+    assert payload["init_images"] == [b64(b'pose'), 'iVBORw0KGgo=']
+    assert payload["mask"] == b64(b'ref')
+    assert unit["input_image"] == b64(b'ref') and unit["image"] == {"image": b64(b'pose')}
+    # free text and script args are passed on as they are
+    assert payload["prompt"] == payload["hr_prompt"] == unit["module"] == 's3://in/pose.png'
+    assert payload["script_args"] == ['s3://in/pose.png']
+
+
+def test_fetches_once_and_revalidates_by_etag(tmp_path, bucket):
+    cache = InputCache(str(tmp_path), 1 << 20, revalidate=0)
+    assert cache.fetch('in', 'pose.png') == b'pose'
+    assert cache.fetch('in', 'pose.png') == b'pose'
+    assert bucket.gets == [('pose.png', None), ('pose.png', '"e1"')]
+    assert cache.stats == {"hits": 1, "misses": 1, "evictions": 0}
+    # overwritten in S3
+    bucket.objects[('in', 'pose.png')] = (b'pose2', '"e3"')
+    assert cache.fetch('in', 'pose.png') == b'pose2'
+
+
+def test_trusts_the_cache_within_revalidate(tmp_path, bucket):
+    cache = InputCache(str(tmp_path), 1 << 20, revalidate=60)
+    cache.fetch('in', 'pose.png')
+    cache.fetch('in', 'pose.png')
+    assert len(bucket.gets) == 1
+
+
+def test_evicts_the_least_recently_used(tmp_path, bucket):
+    cache = InputCache(str(tmp_path), 6)
+    cache.fetch('in', 'pose.png')
+    cache.fetch('images', 'ref.png')
+    assert list(cache.files) == ['e2']
+    assert cache.stats["evictions"] == 1
+    assert os.listdir(tmp_path) == ['e2']
+
+
+def test_restart_keeps_the_files_and_drops_partial_writes(tmp_path, bucket):
+    InputCache(str(tmp_path), 1 << 20).fetch('in', 'pose.png')
+    (tmp_path / 'e9.1.tmp').write_bytes(b'partial')
+    cache = InputCache(str(tmp_path), 1 << 20)
+    assert dict(cache.files) == {'e1': 4}
+    assert not (tmp_path / 'e9.1.tmp').exists()
@@ -0,0 +1,106 @@
+from types import SimpleNamespace
+
+import scheduler.heartbeat as heartbeat
+import scheduler.sd_dynamodb as sd_dynamodb
+from scheduler.heartbeat import VisibilityHeartbeat
+
+
+def test_claims_a_waiting_task(tasks_table):
+    tasks_table.put('t', taskStatus='waiting')
+    assert sd_dynamodb.claimTask('t', 'w1', 300) == {"claimed": True, "taskStatus": "processing"}
+    row = tasks_table.get('t')
+    assert row['taskStatus'] == 'processing' and row['taskOwner'] == 'w1'
+    # a duplicate delivery to the same worker claims it again
+    assert sd_dynamodb.claimTask('t', 'w1', 300)["claimed"]
+
+
+def test_duplicate_delivery_of_a_running_task_is_skipped(tasks_table):
+    tasks_table.put('t', taskStatus='waiting')
+    sd_dynamodb.claimTask('t', 'w1', 300)
+    assert sd_dynamodb.claimTask('t', 'w2', 300) == {"claimed": False, "taskStatus": "processing"}
+    assert tasks_table.get('t')['taskOwner'] == 'w1'
+
+
+def test_expired_lease_is_claimed_by_another_worker(tasks_table):
+    tasks_table.put('t', taskStatus='waiting')
+    sd_dynamodb.claimTask('t', 'w1', -10)
+    assert sd_dynamodb.claimTask('t', 'w2', 300)["claimed"]
+    assert not sd_dynamodb.renewLease('t', 'w1', 300)
+
+
+def test_finished_and_failed_tasks_are_not_claimed(tasks_table):
+    tasks_table.put('done', taskStatus='finished')
+    tasks_table.put('poison', taskStatus='failed')
+    assert sd_dynamodb.claimTask('done', 'w1', 300) == {"claimed": False, "taskStatus": "finished"}
+    assert sd_dynamodb.claimTask('poison', 'w1', 300) == {"claimed": False, "taskStatus": "failed"}
+
+
+def test_renew_and_release_only_by_the_owner(tasks_table):
+    tasks_table.put('t', taskStatus='waiting')
+    sd_dynamodb.claimTask('t', 'w1', 10)
+    lease = int(tasks_table.get('t')['leaseUntil'])
+    assert not sd_dynamodb.renewLease('t', 'w2', 300)
+    assert sd_dynamodb.renewLease('t', 'w1', 300)
+    assert int(tasks_table.get('t')['leaseUntil']) > lease
+    assert not sd_dynamodb.releaseTask('t', 'w2')
+    assert sd_dynamodb.releaseTask('t', 'w1')
+    row = tasks_table.get('t')
+    assert row['taskStatus'] == 'waiting' and 'taskOwner' not in row
+
+
+class SQS:
+    def __init__(self, failed=()):
+        self.calls = []
+        self.failed = failed
+
+    def change_message_visibility_batch(self, QueueUrl, Entries):
+        self.calls.append((QueueUrl, [(e['ReceiptHandle'], e['VisibilityTimeout']) for e in Entries]))
+        return {'Failed': [{'Id': e['Id'], 'Message': 'gone'} for e in Entries if e['ReceiptHandle'] in self.failed]}
+
+
+def job(name, queue_url='q', claimed=True):
+    return SimpleNamespace(taskId=name, receipt_handle=name, queue_url=queue_url, claimed=claimed,
+                           visibility_timeout=None, visible_at=None)
+
+
+def test_beat_extends_the_jobs_close_to_reappearing(monkeypatch):
+    renewed = []
+    monkeypatch.setattr(heartbeat.sd_dynamodb, 'renewLease',
+                        lambda taskId, owner, lease: renewed.append((taskId, owner, lease)) or True)
+    sqs = SQS()
+    beat = VisibilityHeartbeat(sqs, 'w1', visibility_timeout=100)
+    due, fresh, unclaimed = job('due'), job('fresh'), job('unclaimed', queue_url='q2', claimed=False)
+    for j in (due, fresh, unclaimed):
+        beat.track(j)
+    due.visible_at -= 60
+    unclaimed.visible_at -= 60
+    beat.beat()
+    assert sorted(sqs.calls) == [('q', [('due', 100)]), ('q2', [('unclaimed', 100)])]
+    assert renewed == [('due', 'w1', 100)]
+    # retimed jobs are extended by their own timeout on the next beat
+    sqs.calls.clear()
+    beat.retime(fresh, 30)
+    beat.beat()
+    assert sqs.calls == [('q', [('fresh', 30)])]
+
+
+def test_beat_keeps_going_when_a_renewal_or_extension_fails(monkeypatch):
+    renewed = []
+
+    def renew(taskId, owner, lease):
+        if taskId == 'broken':
+            raise ConnectionError("DynamoDB is down")
+        renewed.append(taskId)
+        return True
+    monkeypatch.setattr(heartbeat.sd_dynamodb, 'renewLease', renew)
+    beat = VisibilityHeartbeat(SQS(failed={'gone'}), 'w1', visibility_timeout=100)
+    jobs = [job('broken'), job('ok'), job('gone')]
+    for j in jobs:
+        beat.track(j)
+        j.visible_at -= 60
+    stale = jobs[2].visible_at
+    beat.beat()
+    assert renewed == ['ok', 'gone']
+    assert jobs[1].visible_at > stale + 60
+    # a message that failed to extend is retried on the next beat
+    assert jobs[2].visible_at == stale
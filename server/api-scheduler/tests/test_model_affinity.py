@@ -0,0 +1,104 @@
+import threading
+import time
+
+import pytest
+
+import scheduler.model_affinity as model_affinity
+from scheduler.model_affinity import ModelTracker
+
+A = ('a.safetensors', None)
+B = ('b.safetensors', None)
+
+
+@pytest.fixture
+def webui(monkeypatch):
+    """Options endpoint of one webui with A loaded, set_options blocks until release is set"""
+    state = {"model": A, "swaps": [], "release": threading.Event(), "swapping": threading.Event()}
+
+    def set_options(options, url=None):
+        state["swapping"].set()
+        state["release"].wait(5)
+        state["model"] = (options["sd_model_checkpoint"], options["sd_vae"])
+        state["swaps"].append(state["model"])
+    monkeypatch.setattr(model_affinity.sd_api, 'get_options',
+                        lambda url=None: {"sd_model_checkpoint": state["model"][0], "sd_vae": state["model"][1]})
+    monkeypatch.setattr(model_affinity.sd_api, 'set_options', set_options)
+    return state
+
+
+def call(tracker, model, events, name, hold=None):
+    def run():
+        with tracker.use(model):
+            events.append(f'start {name}')
+            if hold:
+                hold.wait(5)
+            events.append(f'end {name}')
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread
+
+
+def wait_for(condition):
+    end = time.time() + 5
+    while not condition():
+        assert time.time() < end
+        time.sleep(0.01)
+
+
+def test_calls_on_the_loaded_model_run_together(webui):
+    tracker = ModelTracker()
+    events, hold = [], threading.Event()
+    threads = [call(tracker, A, events, n, hold) for n in ('1', '2')]
+    wait_for(lambda: events.count('start 1') + events.count('start 2') == 2)
+    hold.set()
+    for thread in threads:
+        thread.join()
+    assert webui["swaps"] == []
+
+
+def test_swap_waits_for_the_running_calls_and_isnt_overtaken(webui):
+    tracker = ModelTracker()
+    webui["release"].set()
+    events, hold = [], threading.Event()
+    running = call(tracker, A, events, 'a1', hold)
+    wait_for(lambda: 'start a1' in events)
+    swapping = call(tracker, B, events, 'b')
+    wait_for(lambda: tracker.waiting.get(None))
+    # arrives after the swap and needs the loaded model, still waits its turn
+    late = call(tracker, A, events, 'a2')
+    wait_for(lambda: len(tracker.waiting[None]) == 2)
+    assert 'start a2' not in events
+    hold.set()
+    for thread in (running, swapping, late):
+        thread.join()
+    assert events == ['start a1', 'end a1', 'start b', 'end b', 'start a2', 'end a2']
+    assert webui["swaps"] == [B, A]
+    assert tracker.stats["swaps"] == 2
+
+
+def test_lock_isnt_held_during_the_swap(webui):
+    tracker = ModelTracker()
+    events = []
+    swapping = call(tracker, B, events, 'b')
+    assert webui["swapping"].wait(5)
+    # the loaded model can be read while the options request runs
+    assert tracker.loaded_on(None) == A
+    assert tracker.swapping[None]
+    webui["release"].set()
+    swapping.join()
+    assert tracker.loaded_on(None) == B and not tracker.swapping[None]
+
+
+def test_failed_swap_lets_the_next_call_in(webui, monkeypatch):
+    tracker = ModelTracker()
+
+    def fail(options, url=None):
+        raise ConnectionError("webui restarted")
+    monkeypatch.setattr(model_affinity.sd_api, 'set_options', fail)
+    with pytest.raises(ConnectionError):
+        with tracker.use(B):
+            pass
+    assert tracker.loaded_on(None) is None
+    with tracker.use(A):
+        assert tracker.loaded_on(None) == A
+    assert tracker.users[None] == 0
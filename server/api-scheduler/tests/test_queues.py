@@ -0,0 +1,84 @@
+import random
+from collections import Counter
+
+import pytest
+
+import scheduler.queues as queues
+from scheduler.conf import schedulerConfig
+from scheduler.queues import QueuePoller, TaskQueue
+
+
+class SQS:
+    """receive_message of queues holding the given messages"""
+    def __init__(self, messages):
+        self.messages = messages
+        self.calls = []
+
+    def receive_message(self, QueueUrl, MaxNumberOfMessages, WaitTimeSeconds, **kwargs):
+        self.calls.append((QueueUrl, WaitTimeSeconds))
+        found = self.messages.get(QueueUrl, [])[:MaxNumberOfMessages]
+        return {'Messages': [{'Body': body, 'Attributes': {'SentTimestamp': '1000'}} for body in found]}
+
+
+def task_queues(*weights):
+    return [TaskQueue(f'q{i}', f'url{i}', priority=i, weight=w) for i, w in enumerate(weights)]
+
+
+def test_priority_takes_the_first_queue_with_messages():
+    sqs = SQS({'url1': ['bulk'], 'url0': ['urgent']})
+    poller = QueuePoller(sqs, task_queues(1, 1, 1), wait_time=10)
+    received = poller.receive(10, 300)
+    assert [(m['Body'], q.name) for m, q in received] == [('urgent', 'q0')]
+    assert sqs.calls == [('url0', 0)]
+
+
+def test_priority_long_polls_only_the_last_queue():
+    sqs = SQS({})
+    poller = QueuePoller(sqs, task_queues(1, 1, 1), wait_time=10)
+    assert poller.receive(10, 300) == []
+    assert sqs.calls == [('url0', 0), ('url1', 0), ('url2', 10)]
+
+
+def test_weighted_sweeps_follow_the_weights(monkeypatch):
+    monkeypatch.setattr(queues, 'random', random.Random(7))
+    sqs = SQS({'url0': ['a'], 'url1': ['b']})
+    poller = QueuePoller(sqs, task_queues(3, 1), mode='weighted')
+    served = Counter(q.name for _ in range(2000) for m, q in poller.receive(1, 300))
+    assert served['q0'] / 2000 == pytest.approx(0.75, abs=0.05)
+    # both are still polled first now and then
+    assert served['q1'] > 0
+
+
+def test_received_and_completed_are_recorded(monkeypatch):
+    monkeypatch.setattr(queues.time, 'time', lambda: 11.0)
+    q, = task_queues(1)
+    poller = QueuePoller(SQS({'url0': ['a']}), [q])
+    poller.receive(10, 300)
+    poller.record_completed('url0', 1.0)
+    poller.record_completed('unknown', 1.0)
+    summary = poller.summary()['q0']
+    assert summary['received'] == 1 and summary['queue_wait_avg'] == pytest.approx(10)
+    assert summary['completed'] == 1 and summary['latency_avg'] == pytest.approx(10)
+
+
+@pytest.fixture
+def sections():
+    names = ['queue.interactive', 'queue.batch']
+    schedulerConfig.read_dict({
+        'queue.interactive': {'url': 'https://sqs/interactive'},
+        'queue.batch': {'url': 'https://sqs/batch', 'weight': '0.25'},
+    })
+    yield
+    for name in names:
+        schedulerConfig.remove_section(name)
+
+
+def test_load_queues_in_section_order(sections):
+    loaded = queues.load_queues()
+    assert [(q.name, q.url, q.priority, q.weight) for q in loaded] == [
+        ('interactive', 'https://sqs/interactive', 0, 1), ('batch', 'https://sqs/batch', 1, 0.25)]
+
+
+def test_load_queues_falls_back_to_the_aws_queue():
+    q, = queues.load_queues()
+    assert (q.name, q.url) == ('default', schedulerConfig.get('aws', 'queue_url'))
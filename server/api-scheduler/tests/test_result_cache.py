@@ -0,0 +1,70 @@
+from types import SimpleNamespace
+
+import pytest
+
+import scheduler.result_cache as result_cache
+import scheduler.sd_s3 as sd_s3
+from scheduler.result_cache import ResultCache
+
+TXT2IMG = '/sdapi/v1/txt2img'
+RES = {"cnt": 1, "images": ["cdn/out/t-1.png"], "error": ""}
+
+
+def task(**payload):
+    return {"api": TXT2IMG, "payload": dict({"prompt": "a cat", "seed": 42}, **payload)}
+
+
+def checkpoint(name):
+    return {"override_settings": {"sd_model_checkpoint": name}}
+
+
+@pytest.fixture
+def bucket(aws, monkeypatch):
+    """The image bucket in moto, manifests are written right away instead of on the upload pool"""
+    aws.client('s3').create_bucket(Bucket=sd_s3.bucket_name,
+                                   CreateBucketConfiguration={'LocationConstraint': aws.client('s3').meta.region_name})
+    monkeypatch.setattr(result_cache.sd_api, 'upload_pool', SimpleNamespace(submit=lambda f, *args: f(*args)))
+    return sd_s3.bucket_name
+
+
+def test_random_seeds_are_not_cached():
+    cache = ResultCache()
+    assert cache.key(task(seed=-1), 'a.safetensors') is None
+    assert cache.key(task(seed=-1, subseed_strength=0.5, subseed=-1), 'a.safetensors') is None
+
+
+def test_model_comes_from_the_override_or_the_tracker():
+    cache = ResultCache()
+    # without either, the checkpoint depends on the webui the task lands on
+    assert cache.key(task()) is None
+    assert cache.key(task(**checkpoint('a.safetensors'))) is not None
+    assert cache.key(task(), 'a.safetensors') != cache.key(task(), 'b.safetensors')
+    assert cache.key(task(), 'a.safetensors') == cache.key(task(save_images=True), 'a.safetensors')
+    assert cache.key(task(), 'a.safetensors') != cache.key(task(steps=30), 'a.safetensors')
+
+
+def test_local_entries_expire(monkeypatch):
+    cache = ResultCache(ttl=10)
+    cache._remember('k', {"created": 0, "res": RES})
+    monkeypatch.setattr(cache, '_read_manifest', lambda key: None)
+    assert cache.get('k') is None
+    assert cache.stats["evictions"] == 1 and cache.stats["misses"] == 1
+
+
+def test_lru_keeps_max_entries(monkeypatch):
+    cache = ResultCache(max_entries=2)
+    monkeypatch.setattr(result_cache.sd_api, 'upload_pool', SimpleNamespace(submit=lambda f, *args: None))
+    for key in ('a', 'b', 'c'):
+        cache.put(key, RES)
+    assert list(cache.entries) == ['b', 'c']
+
+
+def test_manifests_are_shared_between_instances(bucket):
+    key = ResultCache().key(task(), 'a.safetensors')
+    ResultCache().put(key, RES)
+    other = ResultCache()
+    assert other.get(key) == RES
+    assert other.stats["persistent_hits"] == 1
+    assert other.get(key) == RES
+    assert other.stats["local_hits"] == 1
+    assert other.get('missing') is None
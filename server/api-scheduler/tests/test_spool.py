@@ -0,0 +1,135 @@
+import os
+import threading
+
+import pytest
+
+import scheduler.spool as spool
+from scheduler.spool import OutputSpool
+
+
+@pytest.fixture
+def uploads(monkeypatch):
+    """Keys uploaded through sd_s3, each uploaded file's uri is cdn/<key>"""
+    keys = []
+
+    def upload(key, path, content_type):
+        assert os.path.exists(path)
+        keys.append(key)
+        return f"cdn/{key}"
+    monkeypatch.setattr(spool.sd_s3, 'upload_file_to_s3', upload)
+    return keys
+
+
+def files(tmp_path, count, thumbnails=()):
+    """Encoded files of one task as sd_api.encode_files returns them"""
+    result = []
+    for image in range(1, count + 1):
+        for size in (None,) + tuple(thumbnails):
+            path = tmp_path / f"encoded-{image}-{size}"
+            path.write_bytes(os.urandom(100))
+            suffix = f"-{size}" if size else ""
+            result.append({"path": str(path), "key": f"out/t-{image}{suffix}.png", "content_type": "image/png",
+                           "image": image, "thumbnail": size})
+    return result
+
+
+def new_spool(tmp_path):
+    return OutputSpool(str(tmp_path / 'spool'), 1 << 30, workers=2, backoff=0.01, max_backoff=0.01)
+
+
+def resume_into(resumed, done):
+    def resume(record):
+        resumed.append(record)
+        record.on_uploaded = lambda r: done.set()
+        record.on_failed = lambda error: done.set()
+    return resume
+
+
+def listing(tmp_path):
+    return os.listdir(tmp_path / 'spool' / 'journal'), os.listdir(tmp_path / 'spool' / 'files')
+
+
+def test_resumes_the_records_of_a_crashed_run(tmp_path, uploads):
+    crashed = new_spool(tmp_path)
+    # the uploaders never ran, like a process killed right after add()
+    crashed.add("t", files(tmp_path, 2, thumbnails=[64]), True, {"taskId": "t", "owner": "w1"}, None, None)
+    assert [len(entries) for entries in listing(tmp_path)] == [1, 4]
+
+    restarted = new_spool(tmp_path)
+    resumed, done = [], threading.Event()
+    restarted.start(resume_into(resumed, done))
+    try:
+        assert done.wait(5)
+        record, = resumed
+        assert record.context == {"taskId": "t", "owner": "w1"}
+        assert sorted(uploads) == sorted(["out/t-1.png", "out/t-1-64.png", "out/t-2.png", "out/t-2-64.png"])
+        assert record.res == {"cnt": 2, "images": ["cdn/out/t-1.png", "cdn/out/t-2.png"], "error": "",
+                              "thumbnails": [{"64": "cdn/out/t-1-64.png"}, {"64": "cdn/out/t-2-64.png"}]}
+        assert restarted.stats["resumed"] == 1
+        restarted.remove(record)
+        assert listing(tmp_path) == ([], [])
+        assert restarted.bytes == 0
+    finally:
+        restarted.stop()
+
+
+def test_uploaded_record_is_finished_without_uploading_again(tmp_path, uploads):
+    first = new_spool(tmp_path)
+    uploaded = threading.Event()
+    first.start()
+    first.add("t", files(tmp_path, 1), False, {"taskId": "t"}, lambda record: uploaded.set(), None)
+    assert uploaded.wait(5)
+    # killed before the task's status was written and the record removed
+    first.stop()
+    assert uploads == ["out/t-1.png"]
+    assert [len(entries) for entries in listing(tmp_path)] == [1, 0]
+
+    restarted = new_spool(tmp_path)
+    resumed, done = [], threading.Event()
+    restarted.start(resume_into(resumed, done))
+    try:
+        assert done.wait(5)
+        assert resumed[0].res["images"] == ["cdn/out/t-1.png"]
+        assert uploads == ["out/t-1.png"]
+    finally:
+        restarted.stop()
+
+
+def test_drops_what_a_crash_tore(tmp_path, uploads):
+    crashed = new_spool(tmp_path)
+    record = crashed.add("t", files(tmp_path, 1), False, {}, None, None)
+    # a file of a record whose journal was never written, and a journal write cut short
+    (tmp_path / 'spool' / 'files' / 'orphan').write_bytes(b'x')
+    (tmp_path / 'spool' / 'journal' / 'torn.json.tmp').write_text('{"id": ')
+    (tmp_path / 'spool' / 'journal' / 'garbage.json').write_text('{"id": ')
+    os.remove(tmp_path / 'spool' / 'files' / record.files[0]["name"])
+
+    restarted = new_spool(tmp_path)
+    resumed = []
+    restarted.start(resumed.append)
+    try:
+        # the record lost its only file, it can't be uploaded
+        assert resumed == []
+        assert listing(tmp_path) == ([], [])
+        assert uploads == []
+    finally:
+        restarted.stop()
+
+
+def test_gives_up_after_max_attempts(tmp_path, monkeypatch):
+    def upload(key, path, content_type):
+        raise ConnectionError("S3 is down")
+    monkeypatch.setattr(spool.sd_s3, 'upload_file_to_s3', upload)
+    output_spool = OutputSpool(str(tmp_path / 'spool'), 1 << 30, workers=1, backoff=0.01, max_backoff=0.01,
+                               max_attempts=3)
+    errors = []
+    failed = threading.Event()
+    output_spool.start()
+    try:
+        output_spool.add("t", files(tmp_path, 1), False, {}, None, lambda error: (errors.append(error), failed.set()))
+        assert failed.wait(5)
+        assert isinstance(errors[0], ConnectionError)
+        assert output_spool.stats["retries"] == 2
+        assert listing(tmp_path) == ([], [])
+    finally:
+        output_spool.stop()
@@ -0,0 +1,104 @@
+import json
+
+import pytest
+
+import scheduler.sd_dynamodb as sd_dynamodb
+from scheduler.status_writer import StatusUpdate, StatusWriter
+
+
+def callbacks(events, name):
+    return dict(on_durable=lambda: events.append(f'{name} durable'),
+                on_failed=lambda: events.append(f'{name} failed'),
+                on_lost=lambda: events.append(f'{name} lost'))
+
+
+def writer(**kwargs):
+    return StatusWriter(backoff=0.001, max_backoff=0.001, **kwargs)
+
+
+def test_durable_after_the_write():
+    events = []
+    writer().put(StatusUpdate('finished', lambda: events.append('write') or True, **callbacks(events, 't')))
+    assert events == ['write', 't durable']
+
+
+def test_retries_with_backoff_then_gives_up():
+    events, attempts = [], []
+
+    def write():
+        attempts.append(1)
+        raise ConnectionError("throttled")
+    writer(max_attempts=3).put(StatusUpdate('finished', write, **callbacks(events, 't')))
+    assert len(attempts) == 3
+    assert events == ['t failed']
+
+
+def test_transient_error_is_retried_until_it_succeeds():
+    events, attempts = [], []
+
+    def write():
+        attempts.append(1)
+        if len(attempts) < 2:
+            raise ConnectionError("throttled")
+        return True
+    writer().put(StatusUpdate('finished', write, **callbacks(events, 't')))
+    assert events == ['t durable']
+
+
+def test_condition_failure_is_lost_and_not_retried():
+    events, attempts = [], []
+    writer().put(StatusUpdate('finished', lambda: attempts.append(1) or False, **callbacks(events, 't')))
+    assert attempts == [1]
+    assert events == ['t lost']
+
+
+def test_callback_errors_dont_stop_the_writer():
+    events = []
+    w = writer()
+    w.start()
+    w.put(StatusUpdate('finished', lambda: True, on_durable=lambda: 1 / 0))
+    w.put(StatusUpdate('finished', lambda: True, on_durable=lambda: events.append('second')))
+    w.stop()
+    assert events == ['second']
+
+
+def test_stop_writes_everything_queued():
+    events = []
+    w = writer(capacity=10, workers=1)
+    w.start()
+    for n in range(10):
+        w.put(StatusUpdate('finished', lambda: True, on_durable=lambda n=n: events.append(n)))
+    w.stop()
+    assert sorted(events) == list(range(10))
+    assert len(w) == 0
+
+
+def test_final_writes_are_conditional_on_the_owner(tasks_table):
+    for taskId in ('mine', 'theirs', 'done'):
+        tasks_table.put(taskId, taskStatus='waiting')
+    sd_dynamodb.claimTask('mine', 'w1', 300)
+    sd_dynamodb.claimTask('theirs', 'w2', 300)
+    sd_dynamodb.claimTask('done', 'w1', 300)
+    assert sd_dynamodb.finishTask('done', 'w1', {"cnt": 1})
+    events = []
+    w = writer()
+    w.finish('mine', 'w1', {"cnt": 1}, {"total": 1.5}, **callbacks(events, 'mine'))
+    w.finish('theirs', 'w1', {"cnt": 1}, **callbacks(events, 'theirs'))
+    w.fail('done', 'w1', "late failure", **callbacks(events, 'done'))
+    assert events == ['mine durable', 'theirs lost', 'done lost']
+    mine = tasks_table.get('mine')
+    assert mine['taskStatus'] == 'finished' and json.loads(mine['processRes']) == {"cnt": 1}
+    assert tasks_table.get('theirs')['taskStatus'] == 'processing'
+    assert tasks_table.get('done')['taskStatus'] == 'finished'
+
+
+@pytest.mark.parametrize('kind, status', [('retry', 'waiting'), ('fail', 'failed')])
+def test_errors_release_the_task(tasks_table, kind, status):
+    tasks_table.put('t', taskStatus='waiting')
+    sd_dynamodb.claimTask('t', 'w1', 300)
+    events = []
+    getattr(writer(), kind)('t', 'w1', "webui crashed", **callbacks(events, 't'))
+    assert events == ['t durable']
+    row = tasks_table.get('t')
+    assert row['taskStatus'] == status and row['errorMessage'] == "webui crashed" and row['attempts'] == '1'
+    assert 'taskOwner' not in row
@@ -0,0 +1,91 @@
+import base64
+import json
+import os
+
+import pytest
+
+import scheduler.streaming as streaming
+
+
+IMAGES = [os.urandom(n) for n in (1, 2, 3, 1000, 3001)]
+INFO = json.dumps({"infotexts": ['a "quoted" \\ prompt, café'], "seed": 42})
+
+
+def body(images=IMAGES, info=INFO, escape_slashes=False):
+    encoded = [base64.b64encode(image).decode() for image in images]
+    text = json.dumps({"images": encoded, "parameters": {"prompt": "x", "steps": 2}, "info": info})
+    if escape_slashes:
+        # JSON encoders other than Python's write / as \/
+        text = text.replace('/', '\\/')
+    return text.encode()
+
+
+def chunked(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+def decoded(response):
+    images = [image.read() for image in response['images']]
+    for image in response['images']:
+        image.close()
+    return images
+
+
+@pytest.mark.parametrize('size', [1, 2, 3, 5, 7, 64, 4096])
+def test_chunk_boundaries(spool_dir, size):
+    # small chunks split escapes, keys and base64 groups at every offset
+    response = streaming.parse_response(chunked(body(), size))
+    assert decoded(response) == IMAGES
+    assert json.loads(response['info']) == json.loads(INFO)
+    assert response['parameters'] == {"prompt": "x", "steps": 2}
+
+
+@pytest.mark.parametrize('size', [1, 3, 4096])
+def test_escaped_slashes_in_base64(spool_dir, size):
+    data = body(escape_slashes=True)
+    assert b'\\/' in data
+    response = streaming.parse_response(chunked(data, size))
+    assert decoded(response) == IMAGES
+    assert json.loads(response['info']) == json.loads(INFO)
+
+
+def test_images_go_to_the_spool(spool_dir):
+    response = streaming.parse_response([body()])
+    assert all(os.path.dirname(image.path) == str(spool_dir) for image in response['images'])
+    assert [image.size for image in response['images']] == [len(image) for image in IMAGES]
+    decoded(response)
+    assert os.listdir(spool_dir) == []
+
+
+def test_images_key_only_at_top_level(spool_dir):
+    data = json.dumps({"parameters": {"images": ["aGVsbG8="]}, "images": []}).encode()
+    response = streaming.parse_response(chunked(data, 3))
+    assert response['images'] == []
+    assert response['parameters'] == {"images": ["aGVsbG8="]}
+
+
+@pytest.mark.parametrize('cut', [1, 10, 2000, 4500])
+def test_truncated_body(spool_dir, cut):
+    data = body()
+    with pytest.raises(ValueError):
+        streaming.parse_response(chunked(data[:len(data) - cut], 7))
+    # the images decoded before the body ended are removed
+    assert os.listdir(spool_dir) == []
+
+
+def test_not_an_object(spool_dir):
+    with pytest.raises(ValueError):
+        streaming.parse_response([b'[1, 2]'])
+
+
+def test_base64_writer_pieces():
+    class Out(bytearray):
+        write = bytearray.extend
+    data = os.urandom(100)
+    text = base64.b64encode(data)
+    out = Out()
+    writer = streaming.Base64Writer(out)
+    for piece in chunked(text, 3):
+        writer.write(piece)
+    writer.close()
+    assert bytes(out) == data
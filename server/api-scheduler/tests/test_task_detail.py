@@ -0,0 +1,63 @@
+import json
+
+import pytest
+
+import scheduler.failures as failures
+import scheduler.sd_s3 as sd_s3
+import scheduler.sd_task_detail as sd_task_detail
+
+REQUEST = {"api": "/sdapi/v1/txt2img", "payload": {"prompt": "a cat"}}
+
+
+def message(**info):
+    return json.dumps(dict({"taskId": "t"}, **info))
+
+
+@pytest.fixture
+def s3(aws):
+    client = aws.client('s3')
+    for bucket in (sd_s3.bucket_name, 'requests'):
+        client.create_bucket(Bucket=bucket, CreateBucketConfiguration={'LocationConstraint': client.meta.region_name})
+    return client
+
+
+def test_dynamodb_is_the_default(tasks_table):
+    tasks_table.put('t', requestData=json.dumps(REQUEST), taskStatus='waiting')
+    detail = sd_task_detail.get(message())
+    assert detail == {"errno": 200, "taskId": "t", "requestData": json.dumps(REQUEST), "taskStatus": "waiting"}
+    assert sd_task_detail.get(message(storage="dynamodb", taskId="missing"))["errno"] == 404
+
+
+def test_inline_skips_the_table():
+    detail = sd_task_detail.get(message(storage="inline", requestData=REQUEST))
+    assert detail["errno"] == 200 and json.loads(detail["requestData"]) == REQUEST
+    assert detail["taskStatus"] is None
+    assert sd_task_detail.get(message(storage="inline", requestData=json.dumps(REQUEST)))["requestData"] == json.dumps(REQUEST)
+    assert sd_task_detail.get(message(storage="inline"))["errno"] == 400
+
+
+def test_s3_reads_the_request_object(s3):
+    s3.put_object(Bucket=sd_s3.bucket_name, Key='sd/in/t.json', Body=json.dumps(REQUEST).encode())
+    s3.put_object(Bucket='requests', Key='sd/in/t.json', Body=b'{"api": "other"}')
+    assert sd_task_detail.get(message(storage="s3", key='sd/in/t.json'))["requestData"] == json.dumps(REQUEST)
+    assert sd_task_detail.get(message(storage="s3", key='sd/in/t.json', bucket='requests'))["requestData"] == '{"api": "other"}'
+    assert sd_task_detail.get(message(storage="s3", key='sd/in/missing.json'))["errno"] == 404
+
+
+def test_unknown_storage():
+    assert sd_task_detail.get(message(storage="redis"))["errno"] == 400
+
+
+@pytest.mark.parametrize('body', ['not json', '[1]', '{"storage": "inline"}'])
+def test_malformed_messages_are_permanent(body):
+    with pytest.raises(failures.PermanentError):
+        sd_task_detail.get(body)
+
+
+def test_register_a_storage(monkeypatch):
+    monkeypatch.setattr(sd_task_detail, 'storages', dict(sd_task_detail.storages))
+
+    @sd_task_detail.register("memory")
+    def from_memory(info):
+        return {"errno": 200, "taskId": info["taskId"], "requestData": "{}", "taskStatus": None}
+    assert sd_task_detail.get(message(storage="memory"))["requestData"] == "{}"
@@ -1,15 +1,25 @@
 import { DynamoDBClient, PutItemCommand, GetItemCommand } from "@aws-sdk/client-dynamodb";
 import { SQSClient, SendMessageCommand } from "@aws-sdk/client-sqs";
+import { S3Client, PutObjectCommand } from "@aws-sdk/client-s3";
 // import { v4 as uuidv4 } from 'uuid';
 
 // 初始化客户端
 const dynamoClient = new DynamoDBClient();
 const sqsClient = new SQSClient();
+const s3Client = new S3Client();
 
 // 从环境变量获取配置
 const TABLE_NAME = process.env.DYNAMODB_TABLE || 'sd_tasks';
 const QUEUE_URL = process.env.QUEUE_URL;
 const CLOUDFRONT_DOMAIN = process.env.CLOUDFRONT_DOMAIN;
+// 序列化后不超过该字节数的消息直接带上请求(storage=inline), worker 不用再读取 DynamoDB
+// 超过 SQS 消息上限 256KB 时总是改用 dynamodb, 0 表示总是使用 dynamodb
+const INLINE_MAX_BYTES = parseInt(process.env.INLINE_MAX_BYTES || '200000', 10);
+const SQS_MAX_BYTES = 256 * 1024;
+// 超过该字节数的请求放不进 DynamoDB 记录(上限 400KB), 保存到 REQUEST_BUCKET 的 REQUEST_PREFIX 下(storage=s3)
+const DYNAMODB_MAX_BYTES = parseInt(process.env.DYNAMODB_MAX_BYTES || '350000', 10);
+const REQUEST_BUCKET = process.env.REQUEST_BUCKET;
+const REQUEST_PREFIX = process.env.REQUEST_PREFIX || 'sd/in/';
 
 // 生成UUID v4
 function uuidv4() {
@@ -41,14 +51,31 @@ const submitTask = async (event) => {
       }
     };
 
-    // 准备SQS参数
-    const taskInfo = {
-      taskId: taskId,
-      storage: "dynamodb"
-    };
-    
+    // 准备SQS参数, 按序列化后的大小选择 inline, dynamodb 或 s3
+    let messageBody = JSON.stringify({ taskId: taskId, storage: "inline", requestData: event.body });
+    const messageBytes = Buffer.byteLength(messageBody);
+    if (messageBytes > INLINE_MAX_BYTES || messageBytes > SQS_MAX_BYTES) {
+      messageBody = JSON.stringify({ taskId: taskId, storage: "dynamodb" });
+      if (Buffer.byteLength(event.body || '') > DYNAMODB_MAX_BYTES) {
+        if (!REQUEST_BUCKET) {
+          throw new Error(`request of ${Buffer.byteLength(event.body)} bytes is too large without REQUEST_BUCKET`);
+        }
+        const key = `${REQUEST_PREFIX}${taskId}.json`;
+        await s3Client.send(new PutObjectCommand({
+          Bucket: REQUEST_BUCKET,
+          Key: key,
+          Body: event.body,
+          ContentType: "application/json"
+        }));
+        messageBody = JSON.stringify({ taskId: taskId, storage: "s3", bucket: REQUEST_BUCKET, key: key });
+        // 记录中只保存请求的位置
+        delete dbParams.Item.requestData;
+        dbParams.Item.requestKey = { S: `s3://${REQUEST_BUCKET}/${key}` };
+      }
+    }
+
     const sqsParams = {
-      MessageBody: JSON.stringify(taskInfo),
+      MessageBody: messageBody,
       QueueUrl: QUEUE_URL
     };
 